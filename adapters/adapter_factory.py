@@ -1,3 +1,10 @@
+import copy
+import hashlib
+import json
+import threading
+import time
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional
 from loguru import logger
 from adapters.azure import AzureAdapter
 from adapters.base import ModelAdapter, invalid_request_error
@@ -12,20 +19,131 @@ from adapters.gemini_adapter import GeminiAdapter
 from adapters.bing_sydney import BingSydneyModel
 from adapters.qwen import QWenAdapter
 from adapters.skylark import SkylarkAdapter
-model_instance_dict = {}
+from adapters.circuit_breaker import CircuitBreaker, CircuitBreakerAdapter
+from adapters.metrics_adapter import MetricsAdapter
+from adapters.rate_limit import RateLimitAdapter
+from adapters.response_cache import ResponseCacheAdapter
+from adapters.single_flight import SingleFlightAdapter
+from utils.admission import default_priority, priority_classes
+from utils.util import hash_fingerprint, hash_token
 
+# 路由类型的适配器自身不访问上游，不需要熔断
+router_types = ["router", "model-name-router"]
 
-def get_adapter(instanceKey: str):
-    model = model_instance_dict.get(instanceKey)
+# 被替换的适配器等待进行中的请求结束后再关闭，最多等待的秒数
+drain_timeout_seconds = 300
+
+
+class Route:
+    """
+    鉴权后的路由结果，不保存token，日志和指标中只使用其hash的fingerprint
+    admission为config中的准入队列配置：{"priority": "interactive" | "default" | "batch", "weight": 1, "queue_timeout_seconds": 60}
+    """
+
+    __slots__ = ("adapter", "type", "fingerprint", "priority", "weight", "queue_timeout")
+
+    def __init__(self, token_hash: str, adapter: ModelAdapter, type: str = "", admission: dict = None):
+        self.adapter = adapter
+        self.type = type
+        self.fingerprint = hash_fingerprint(token_hash)
+        admission = admission or {}
+        priority = admission.get("priority", "default")
+        self.priority = priority_classes.get(priority, default_priority)
+        if priority not in priority_classes:
+            logger.warning(f"unknown priority {priority} for {self.fingerprint}, use default")
+        self.weight = admission.get("weight", 1)
+        self.queue_timeout = admission.get("queue_timeout_seconds")
+
+    def __repr__(self):
+        return f"Route({self.fingerprint}, {self.adapter!r})"
+
+
+def config_digest(config) -> str:
+    """配置内容（不含token）的hash，重新加载时用来判断适配器能否复用"""
+    payload = json.dumps([config.type, config.config], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class AdapterGeneration:
+    """
+    一个版本的配置和对应的适配器实例，重新加载配置时整体替换，查找时不会看到只更新了一半的状态
+    configs、adapters都以token的sha256为key，不保存token原文：
+    routes为预先编译的鉴权索引：token的sha256 -> Route，请求时只做一次hash和一次dict查找；
+    configs构建完成后只保留内容的digest，用于下次重新加载时判断配置是否变化
+    inflight为使用这个版本的进行中的请求数，被替换后用于判断旧实例何时可以关闭
+    """
+
+    def __init__(self, version: int, configs: dict, adapters: Dict[str, ModelAdapter]):
+        self.version = version
+        self.adapters = adapters
+        self.routes: Mapping[str, Route] = MappingProxyType(
+            {
+                key: Route(key, adapter, configs[key].type, configs[key].config.get("admission"))
+                for key, adapter in adapters.items()
+            }
+        )
+        self.digests = {key: config_digest(config) for key, config in configs.items()}
+        self.inflight = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            self.inflight += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self.inflight -= 1
+
+
+_generation = AdapterGeneration(0, {}, {})
+_retired: List[AdapterGeneration] = []
+_retired_lock = threading.Lock()
+
+
+def current_generation() -> AdapterGeneration:
+    return _generation
+
+
+def resolve_route(token: str) -> Optional[Route]:
+    """按请求中的bearer token查找路由"""
+    return _generation.routes.get(hash_token(token))
+
+
+def get_adapter(token_hash: str):
+    """router按token的sha256查找下游实例"""
+    model = _generation.adapters.get(token_hash)
     if model is None:
         raise invalid_request_error("model not found")
     return model
 
 
-def init_adapter(instanceKey: str, type: str, **kwargs) -> ModelAdapter:
-    model = model_instance_dict.get(instanceKey)
-    if model is not None:
-        return model
+def create_adapter(instanceKey: str, type: str, **kwargs) -> ModelAdapter:
+    """instanceKey为token的sha256"""
+    model = None
+    fingerprint = hash_fingerprint(instanceKey)
+    # 熔断默认开启，config中 "circuit_breaker": false 关闭，或者配置一个dict调整参数
+    breaker_config = kwargs.pop("circuit_breaker", {})
+    # 响应缓存默认关闭，config中配置 "cache": {...} 开启
+    cache_config = kwargs.pop("cache", None)
+    # 相同请求合并默认关闭，config中配置 "coalesce": true 或 {...} 开启
+    coalesce_config = kwargs.pop("coalesce", None)
+    # 限流默认关闭，config中配置 "rate_limit": {...} 开启
+    rate_limit_config = kwargs.pop("rate_limit", None)
+    # 准入队列的优先级在鉴权后的Route上使用，不传给适配器
+    kwargs.pop("admission", None)
+    if (
+        rate_limit_config
+        and rate_limit_config.get("tpm")
+        and kwargs.get("passthrough")
+        and not (kwargs.get("stream_options") or {}).get("include_usage")
+    ):
+        # 透传的stream只能从上游最后一帧中取得usage，没有要求上游返回usage时无法按tpm补扣，关闭透传
+        logger.warning(
+            f"{fingerprint}: passthrough disabled because rate_limit.tpm needs stream usage, "
+            "set stream_options.include_usage to keep it"
+        )
+        kwargs["passthrough"] = False
     try:
         if type == "openai" or type == "proxy":
             model = ProxyAdapter(**kwargs)
@@ -58,12 +176,74 @@ def init_adapter(instanceKey: str, type: str, **kwargs) -> ModelAdapter:
             model = SkylarkAdapter(**kwargs)
         else:
             raise ValueError(f"unknown model type: {type}")
+        if type not in router_types:
+            model = MetricsAdapter(model, fingerprint, type)
+            if breaker_config is not False:
+                model = CircuitBreakerAdapter(
+                    model,
+                    CircuitBreaker(name=fingerprint, **breaker_config),
+                )
+        if rate_limit_config:
+            model = RateLimitAdapter(model, fingerprint, **rate_limit_config)
+        if coalesce_config:
+            if coalesce_config is True:
+                coalesce_config = {}
+            model = SingleFlightAdapter(model, instanceKey, **coalesce_config)
+        if cache_config:
+            model = ResponseCacheAdapter(model, instanceKey, **cache_config)
     except Exception as e:
-        logger.exception(f"init model failed {instanceKey},{type},{kwargs}: {e}")
-    if model is not None:
-        model_instance_dict[instanceKey] = model
+        logger.exception(f"init model failed {fingerprint},{type}: {e}")
     return model
 
 
-def clear_adapters():
-    model_instance_dict.clear()
+def swap_adapters(configs: dict) -> AdapterGeneration:
+    """
+    按新的配置（token的sha256 -> ModelConfig）在旧版本旁边构建新的适配器表，完成后一次性替换
+    配置没有变化的token直接复用原来的实例，保留其连接、会话和统计；
+    不再使用的实例在旧版本的请求都结束后关闭
+    """
+    global _generation
+    old = _generation
+    adapters = {}
+    for key, config in configs.items():
+        model = old.adapters.get(key)
+        if model is None or old.digests.get(key) != config_digest(config):
+            # create_adapter和各适配器的__init__会pop配置项，深拷贝避免修改配置本身
+            model = create_adapter(key, config.type, **copy.deepcopy(config.config))
+        if model is not None:
+            adapters[key] = model
+    # 路由类型的适配器直接持有下游实例的引用，嵌套的路由在这里一次解析好，请求时不再按token查找
+    for model in adapters.values():
+        model.resolve_routes(adapters)
+    _generation = AdapterGeneration(old.version + 1, configs, adapters)
+    reused = {id(model) for model in adapters.values()}
+    retired = [model for model in old.adapters.values() if id(model) not in reused]
+    logger.info(
+        f"swap adapters version:{_generation.version}, created:{len(adapters) - (len(old.adapters) - len(retired))}, retired:{len(retired)}"
+    )
+    with _retired_lock:
+        _retired.append(old)
+    threading.Thread(
+        target=_drain_and_close, args=(old, retired), name="adapter-drain", daemon=True
+    ).start()
+    return _generation
+
+
+def _drain_and_close(old: AdapterGeneration, retired: List[ModelAdapter]):
+    """等待不晚于old的版本上进行中的请求结束（最多drain_timeout_seconds），然后关闭不再使用的实例"""
+    # 请求可能在替换前刚取到旧实例、还没有计数，至少等待一小段时间
+    time.sleep(1)
+    deadline = time.monotonic() + drain_timeout_seconds
+    while time.monotonic() < deadline:
+        with _retired_lock:
+            busy = [g for g in _retired if g.version <= old.version and g.inflight > 0]
+        if not busy:
+            break
+        time.sleep(0.5)
+    with _retired_lock:
+        _retired[:] = [g for g in _retired if g.version > old.version or g.inflight > 0]
+    for model in retired:
+        try:
+            model.close()
+        except Exception as e:
+            logger.warning(f"close adapter failed {model}: {e}")
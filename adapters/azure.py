@@ -1,11 +1,21 @@
 
 
 import json
-from typing import Iterator, Union
-from adapters.base import ModelAdapter, post, stream
+from typing import AsyncIterator, Iterator, Union
+from adapters.base import (
+    ModelAdapter,
+    post,
+    stream,
+    apost,
+    astream,
+    pop_http_options,
+    passthrough_stream,
+    apassthrough_stream,
+)
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
-import requests
+from utils.log import is_sampled, truncate
 from loguru import logger
+from utils.sse_client import iter_sse_data, aiter_sse_data
 
 
 class AzureAdapter(ModelAdapter):
@@ -17,7 +27,7 @@ class AzureAdapter(ModelAdapter):
   -d '{"messages":[{"role": "system", "content": "You are a helpful assistant."},{"role": "user", "content": "Does Azure OpenAI support customer managed keys?"},{"role": "assistant", "content": "Yes, customer managed keys are supported by Azure OpenAI."},{"role": "user", "content": "Do other Azure AI services support this too?"}]}'
     """
     param_list = ["messages", "temperature", "n", "stream", "stop", "max_tokens", "presence_penalty",
-                  "frequency_penalty", "logit_bias", "user", "function_call", "functions"]
+                  "frequency_penalty", "logit_bias", "user", "function_call", "functions", "stream_options"]
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -25,35 +35,93 @@ class AzureAdapter(ModelAdapter):
         self.api_key = kwargs.pop("api_key", None)
         self.api_version = kwargs.pop("api_version", None)
         self.deployment_id = kwargs.pop("deployment_id", None)
+        self.http_options = pop_http_options(kwargs)
+        # 透传模式：stream时上游的sse字节原样转发，不构造pydantic对象；rewrite_model为true时改写为请求中的model
+        self.passthrough = kwargs.pop("passthrough", False)
+        self.rewrite_model = kwargs.pop("rewrite_model", None)
         self.config_args = kwargs
         self.headers = {
             "Content-Type": "application/json",
             "api-key": self.api_key
         }
 
-    def chat_completions(self, request: ChatCompletionRequest) -> Iterator[ChatCompletionResponse]:
+    def chat_completions(self, request: ChatCompletionRequest) -> Iterator[Union[ChatCompletionResponse, bytes]]:
         # 发起post请求
-        url = f"{self.end_point}openai/deployments/{self.deployment_id}/chat/completions?api-version={self.api_version}"
+        url = self.request_url()
         req_args = self.convert_param(request)
         if request.stream:
-            response = stream(url, self.headers, req_args)
-            for chunk in response.iter_lines(chunk_size=1024):
-                # 移除头部data: 字符
-                decoded_line = chunk.decode('utf-8')
-                logger.info(f"decoded_line: {decoded_line}")
-                decoded_line = decoded_line.lstrip("data:").strip()
-                if "[DONE]" == decoded_line:
-                    break
-                if decoded_line:
-                    yield ChatCompletionResponse(**json.loads(decoded_line))
+            response = stream(url, self.headers, req_args, http_options=self.http_options)
+            try:
+                if self.passthrough:
+                    yield from passthrough_stream(
+                        response.iter_bytes(), self.passthrough_model(request)
+                    )
+                    return
+                for data in iter_sse_data(response.iter_bytes()):
+                    resp = self.parse_stream_data(data)
+                    if resp is StopIteration:
+                        break
+                    if resp:
+                        yield resp
+            finally:
+                response.close()
         else:
-            response = post(url, self.headers, req_args)
+            response = post(url, self.headers, req_args, http_options=self.http_options)
             resp = ChatCompletionResponse(**response)
             yield resp
 
+    async def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[Union[ChatCompletionResponse, bytes]]:
+        url = self.request_url()
+        req_args = self.convert_param(request)
+        if request.stream:
+            response = await astream(url, self.headers, req_args, http_options=self.http_options)
+            try:
+                if self.passthrough:
+                    async for frame in apassthrough_stream(
+                        response.aiter_bytes(), self.passthrough_model(request)
+                    ):
+                        yield frame
+                    return
+                async for data in aiter_sse_data(response.aiter_bytes()):
+                    resp = self.parse_stream_data(data)
+                    if resp is StopIteration:
+                        break
+                    if resp:
+                        yield resp
+            finally:
+                await response.aclose()
+        else:
+            response = await apost(url, self.headers, req_args, http_options=self.http_options)
+            yield ChatCompletionResponse(**response)
+
+    def request_url(self):
+        return f"{self.end_point}openai/deployments/{self.deployment_id}/chat/completions?api-version={self.api_version}"
+
+    def passthrough_model(self, request: ChatCompletionRequest):
+        if self.rewrite_model is True:
+            return request.model
+        return self.rewrite_model
+
+    def parse_stream_data(self, data: bytes):
+        """
+        解析一个sse事件的data，[DONE]时返回StopIteration，空数据返回None
+        """
+        if is_sampled():
+            logger.debug("stream data: {}", truncate(data))
+        if data == b"[DONE]":
+            return StopIteration
+        if data:
+            return ChatCompletionResponse(**json.loads(data))
+        return None
+
     def convert_param(self, request: ChatCompletionRequest):
         req_args = request.model_dump(exclude_none=True, exclude_defaults=True)
         req_args.update(self.config_args)
+        if not request.stream:
+            # 只允许stream请求带stream_options
+            req_args.pop("stream_options", None)
         # 请求有未识别参数会报错，这里过滤下   Unrecognized request argument supplied: type
         param = {k: v for k, v in req_args.items() if k in self.param_list}
         return param
@@ -1,16 +1,35 @@
+import asyncio
+import contextvars
 import json
+import math
+import os
+import re
+import threading
 import time
-from typing import Union, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Union, Iterator
 
 from openai import OpenAIError
-import requests
+import httpx
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
-from utils.util import num_tokens_from_string
+from utils.util import num_tokens_from_string, UsageCounter
+from utils.http_client import (
+    CountingByteStream,
+    get_http_client,
+    get_async_http_client,
+    request_timeout,
+)
+from utils.metrics import upstream_bytes, upstream_host
+from utils.sse_client import iter_sse_data, aiter_sse_data
+from utils.log import debug_enabled, mask_headers, mask_url, truncate
 from loguru import logger
 
 
 api_timeout_seconds = 300
 
+# 同步适配器在异步接口下由有界线程池驱动，可通过环境变量 SYNC-EXECUTOR-WORKERS 调整线程数
+sync_executor_max_workers = int(os.getenv("SYNC-EXECUTOR-WORKERS", "64"))
+
 """
 http:
 status_code:429
@@ -30,18 +49,36 @@ https://platform.openai.com/docs/guides/error-codes/api-errors
 
 
 class UDFApiError(OpenAIError):
-    def __init__(self, message, status: int = 500, code="server_error"):
+    def __init__(self, message, status: int = 500, code="server_error", type: str = None, headers: dict = None):
         super(UDFApiError, self).__init__(message)
         self.http_status = status
         self._message = message
+        self.code = code
+        # 设置了type时按上面openai的格式返回错误对象，否则只返回错误信息
+        self.type = type
+        self.headers = headers
+
+    def content(self):
+        if self.type is None:
+            return self._message
+        return {
+            "error": {
+                "message": self._message,
+                "type": self.type,
+                "param": None,
+                "code": self.code,
+            }
+        }
 
 
 def authentication_error():
     return UDFApiError("Invalid Authentication", 401, "")
 
 
-def rate_limit_error(message):
-    return UDFApiError(message, 429, "")
+def rate_limit_error(message, type: str = None, retry_after: float = None):
+    """type为requests或tokens时返回openai格式的错误对象，retry_after写入Retry-After头（秒，向上取整）"""
+    headers = {"Retry-After": str(math.ceil(retry_after))} if retry_after else None
+    return UDFApiError(message, 429, "rate_limit_exceeded" if type else "", type, headers)
 
 
 def serverError(message):
@@ -55,52 +92,287 @@ def invalid_request_error(message):
 def resp_text(resp):
     resp_str = None
     if resp is not None:
-        resp_str = f"status_code:{resp.status_code}: {resp.text}"
+        try:
+            resp_str = f"status_code:{resp.status_code}: {resp.text}"
+        except httpx.ResponseNotRead:
+            # stream模式下未读取的响应体不输出
+            resp_str = f"status_code:{resp.status_code}"
     return resp_str
 
 
+def log_http(name: str, api_url, headers: dict, params: dict, resp):
+    """DEBUG级别时输出请求详情，header和url中的密钥打码，大的请求体、响应体截断"""
+    if debug_enabled():
+        logger.opt(depth=1).debug(
+            "【{}】 请求url：{}, headers:{}, params:{}, resp:{}",
+            name,
+            mask_url(api_url),
+            mask_headers(headers),
+            truncate(params),
+            truncate(resp_text(resp)),
+        )
+
+
+def count_upstream_bytes(api_url, resp):
+    if resp is not None:
+        upstream_bytes.labels(upstream_host(api_url)).inc(resp.num_bytes_downloaded)
+
+
+def transport_error(e: httpx.HTTPError):
+    if isinstance(e, httpx.TimeoutException):
+        return UDFApiError(f"upstream timeout: {e}", 504)
+    return UDFApiError(f"upstream connection error: {e}", 502)
+
+
+def is_final_item(item, stream: bool) -> bool:
+    """
+    是否为请求的最后一个结果：非stream的唯一结果，或stream中finish_reason不为空的chunk；
+    非stream请求调用方取到结果后直接关闭迭代器，统计成功与否不能等到迭代结束
+    """
+    if not stream:
+        return True
+    choices = getattr(item, "choices", None)
+    return bool(choices) and choices[0].finish_reason is not None
+
+
+def clean_headers(headers: dict) -> dict:
+    """去掉值为None的header，和requests的行为保持一致"""
+    return {k: v for k, v in headers.items() if v is not None}
+
+
+def json_headers(headers: dict) -> httpx.Headers:
+    """
+    post、stream的请求体都由调用方按json.dumps(params)编码后发送，不使用httpx的json参数：
+    httpx不同版本的json编码方式不同，对请求体签名的上游（如skylark）需要签名和发送的内容完全一致
+    """
+    headers = httpx.Headers(clean_headers(headers))
+    headers.setdefault("Content-Type", "application/json")
+    return headers
+
+
 def post(
-    api_url, headers: dict, params: dict, timeout=api_timeout_seconds, proxies=None
+    api_url,
+    headers: dict,
+    params: dict,
+    timeout=api_timeout_seconds,
+    proxies=None,
+    http_options: dict = None,
 ):
     resp = None
     try:
-        resp = requests.post(
-            url=api_url,
-            headers=headers,
-            data=json.dumps(params),
-            timeout=timeout,
-            proxies=proxies,
+        client = get_http_client(api_url, proxies, **(http_options or {}))
+        resp = client.post(
+            api_url,
+            headers=json_headers(headers),
+            content=json.dumps(params),
+            timeout=request_timeout(timeout),
         )
-        if requests.codes.ok != resp.status_code:
+        if httpx.codes.OK != resp.status_code:
             raise UDFApiError(resp.text, resp.status_code)
         return json.loads(resp.text)
+    except httpx.HTTPError as e:
+        raise transport_error(e)
     finally:
-        logger.debug(
-            f"【http.post】 请求url：{api_url}, headers:{headers}, params:{params}, resp:{resp_text(resp)}"
-        )
+        count_upstream_bytes(api_url, resp)
+        log_http("http.post", api_url, headers, params, resp)
 
 
 def stream(
-    api_url, headers: dict, params: dict, timeout=api_timeout_seconds, proxies=None
-):
+    api_url,
+    headers: dict,
+    params: dict,
+    timeout=api_timeout_seconds,
+    proxies=None,
+    http_options: dict = None,
+) -> httpx.Response:
+    """
+    返回未读取的流式响应，调用方读取完毕或提前结束时需要close，连接才会归还连接池
+    """
     resp = None
     try:
-        resp = requests.post(
+        client = get_http_client(api_url, proxies, **(http_options or {}))
+        req = client.build_request(
+            "POST",
             api_url,
-            stream=True,
-            headers=headers,
-            json=params,
-            # data=json.dumps(params),
-            timeout=timeout,
-            proxies=proxies,
+            headers=json_headers(headers),
+            content=json.dumps(params),
+            timeout=request_timeout(timeout),
         )
-        if requests.codes.ok != resp.status_code:
+        resp = client.send(req, stream=True)
+        if httpx.codes.OK != resp.status_code:
+            resp.read()
+            resp.close()
+            count_upstream_bytes(api_url, resp)
             raise UDFApiError(resp.text, resp.status_code)
+        resp.stream = CountingByteStream(resp.stream, upstream_bytes.labels(upstream_host(api_url)))
         return resp
+    except httpx.HTTPError as e:
+        raise transport_error(e)
     finally:
-        logger.debug(
-            f"【http.stream】 请求url：{api_url}, headers:{headers}, params:{params}, resp:{resp_text(resp)}"
+        log_http("http.stream", api_url, headers, params, resp)
+
+
+async def apost(
+    api_url,
+    headers: dict,
+    params: dict,
+    timeout=api_timeout_seconds,
+    proxies=None,
+    http_options: dict = None,
+):
+    resp = None
+    try:
+        client = get_async_http_client(api_url, proxies, **(http_options or {}))
+        resp = await client.post(
+            api_url,
+            headers=json_headers(headers),
+            content=json.dumps(params),
+            timeout=request_timeout(timeout),
+        )
+        if httpx.codes.OK != resp.status_code:
+            raise UDFApiError(resp.text, resp.status_code)
+        return json.loads(resp.text)
+    except httpx.HTTPError as e:
+        raise transport_error(e)
+    finally:
+        count_upstream_bytes(api_url, resp)
+        log_http("http.apost", api_url, headers, params, resp)
+
+
+async def astream(
+    api_url,
+    headers: dict,
+    params: dict,
+    timeout=api_timeout_seconds,
+    proxies=None,
+    http_options: dict = None,
+) -> httpx.Response:
+    """
+    stream的异步版本，调用方读取完毕或提前结束时需要aclose
+    """
+    resp = None
+    try:
+        client = get_async_http_client(api_url, proxies, **(http_options or {}))
+        req = client.build_request(
+            "POST",
+            api_url,
+            headers=json_headers(headers),
+            content=json.dumps(params),
+            timeout=request_timeout(timeout),
         )
+        resp = await client.send(req, stream=True)
+        if httpx.codes.OK != resp.status_code:
+            await resp.aread()
+            await resp.aclose()
+            count_upstream_bytes(api_url, resp)
+            raise UDFApiError(resp.text, resp.status_code)
+        resp.stream = CountingByteStream(resp.stream, upstream_bytes.labels(upstream_host(api_url)))
+        return resp
+    except httpx.HTTPError as e:
+        raise transport_error(e)
+    finally:
+        log_http("http.astream", api_url, headers, params, resp)
+
+
+def pop_http_options(kwargs: dict) -> dict:
+    """
+    从适配器config中取出连接池相关的配置 pool_size、http2，避免被当作请求参数透传给上游
+    """
+    return {k: kwargs.pop(k) for k in ("pool_size", "http2") if k in kwargs}
+
+
+_model_field_pattern = re.compile(rb'"model"\s*:\s*"(?:[^"\\]|\\.)*"')
+
+
+def passthrough_frame(data: bytes, model_field: bytes = None) -> bytes:
+    """
+    透传模式下把上游data字段重新组装成sse帧，只按需替换model字段，不做json解析
+    """
+    if model_field:
+        data = _model_field_pattern.sub(lambda _: model_field, data, count=1)
+    return b"data: " + data + b"\n\n"
+
+
+def _model_field(model: str = None) -> bytes:
+    if not model:
+        return None
+    return b'"model":' + json.dumps(model, ensure_ascii=False).encode()
+
+
+def passthrough_stream(chunks: Iterator[bytes], model: str = None) -> Iterator[bytes]:
+    """
+    openai兼容上游的流式响应原样转发，返回sse帧的字节，[DONE]由接口层统一追加
+    model不为空时改写每个chunk的model字段
+    """
+    model_field = _model_field(model)
+    for data in iter_sse_data(chunks):
+        if data == b"[DONE]":
+            break
+        if data:
+            yield passthrough_frame(data, model_field)
+
+
+async def apassthrough_stream(
+    chunks: AsyncIterator[bytes], model: str = None
+) -> AsyncIterator[bytes]:
+    """passthrough_stream的异步版本"""
+    model_field = _model_field(model)
+    async for data in aiter_sse_data(chunks):
+        if data == b"[DONE]":
+            break
+        if data:
+            yield passthrough_frame(data, model_field)
+
+
+_sync_executor = None
+_sync_executor_lock = threading.Lock()
+_iter_end = object()
+
+
+def get_sync_executor() -> ThreadPoolExecutor:
+    global _sync_executor
+    if _sync_executor is None:
+        with _sync_executor_lock:
+            if _sync_executor is None:
+                _sync_executor = ThreadPoolExecutor(
+                    max_workers=sync_executor_max_workers,
+                    thread_name_prefix="sync-adapter",
+                )
+    return _sync_executor
+
+
+async def iterate_in_executor(iterator: Iterator) -> AsyncIterator:
+    """
+    在有界线程池中逐个消费同步迭代器，转换为异步迭代器
+    每次next都在线程池中执行，不会阻塞事件循环；提前结束时在线程池中关闭原迭代器
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_sync_executor()
+    # 在请求的上下文中执行，线程中的适配器可以读到日志采样等contextvar
+    context = contextvars.copy_context()
+    # next与close不能并发执行（generator already executing），用锁串行化
+    lock = threading.Lock()
+
+    def step():
+        with lock:
+            return next(iterator, _iter_end)
+
+    def close():
+        with lock:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    finished = False
+    try:
+        while True:
+            item = await loop.run_in_executor(executor, context.run, step)
+            if item is _iter_end:
+                finished = True
+                break
+            yield item
+    finally:
+        if not finished:
+            executor.submit(close)
 
 
 class ModelAdapter:
@@ -113,6 +385,29 @@ class ModelAdapter:
         """
         返回一个迭代器对象
          stream为false   第一个就是结果
+         透传模式（passthrough）下stream的元素是已经组装好的sse帧bytes
+        """
+        pass
+
+    async def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[ChatCompletionResponse]:
+        """
+        chat_completions的异步版本，返回一个异步迭代器，约定与chat_completions相同
+        默认在有界线程池中驱动同步的chat_completions，支持原生异步的适配器可覆盖此方法
+        """
+        async for resp in iterate_in_executor(self.chat_completions(request)):
+            yield resp
+
+    def close(self):
+        """
+        释放适配器持有的资源，配置重新加载后旧实例上的请求都结束时调用
+        """
+        pass
+
+    def resolve_routes(self, adapters: dict):
+        """
+        路由类型的适配器在配置加载时解析token对应的下游实例，adapters为新版本的 token -> 实例
         """
         pass
 
@@ -122,7 +417,7 @@ class ModelAdapter:
     ):
         completion_tokens = kargs.get("completion_tokens")
         if completion_tokens is None:
-            completion_tokens = num_tokens_from_string(completion)
+            completion_tokens = num_tokens_from_string(completion, model=model)
         prompt_tokens = kargs.get("prompt_tokens", 0)
         total_tokens = prompt_tokens + completion_tokens
         id = kargs.get("id", f"chatcmpl-{str(time.time())}")
@@ -157,25 +452,29 @@ class ModelAdapter:
     def completion_to_openai_stream_response(
         self, completion: str, model: str = "default", index = 0, **kargs
     ):
+        """
+        上游返回了completion_tokens时直接使用；否则传入usage_counter，
+        由其累积整个stream的completion，只在最后一块（finish_reason不为空）时计算usage
+        chunk中的usage必须是截至该chunk的累积值，上游按增量返回时由适配器累加，
+        指标统计和限流都只取最后一个带usage的chunk
+        """
         completion_tokens = kargs.get("completion_tokens")
-        if completion_tokens is None:
-            completion_tokens = num_tokens_from_string(completion)
         prompt_tokens = kargs.get("prompt_tokens", 0)
-        total_tokens = prompt_tokens + completion_tokens
-        id = kargs.get("id", f"chatcmpl-{str(time.time())}")
+        usage_counter: UsageCounter = kargs.get("usage_counter")
+        # 默认值只在没有传入时才计算，stream下每个chunk都会调用
+        id = kargs["id"] if "id" in kargs else f"chatcmpl-{str(time.time())}"
         finish_reason = kargs.get("finish_reason", "stop")
-        created = kargs.get("created", int(time.time()))
+        created = kargs["created"] if "created" in kargs else int(time.time())
         index = kargs.get("index", 0)
+        if completion_tokens is None and usage_counter is not None:
+            usage_counter.add(completion)
+            if finish_reason:
+                completion_tokens = usage_counter.completion_tokens()
         openai_response = {
             "id": id,
             "object": "chat.completion.chunk",
             "created": created,
             "model": model,
-            "usage": {
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens,
-            },
             "choices": [
                 {
                     "delta": {
@@ -187,4 +486,32 @@ class ModelAdapter:
                 }
             ],
         }
+        if completion_tokens is not None:
+            openai_response["usage"] = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
         return openai_response
+
+
+class WrapperAdapter(ModelAdapter):
+    """
+    包在另一个适配器外的适配器（熔断、缓存、请求合并、限流、指标），子类实现chat_completions和
+    achat_completions，其余属性以及close、resolve_routes都转给被包装的适配器
+    """
+
+    def __init__(self, adapter: ModelAdapter):
+        self.adapter = adapter
+
+    def __getattr__(self, name):
+        return getattr(self.adapter, name)
+
+    def close(self):
+        self.adapter.close()
+
+    def resolve_routes(self, adapters: dict):
+        self.adapter.resolve_routes(adapters)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.adapter!r})"
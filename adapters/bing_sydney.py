@@ -1,10 +1,136 @@
 import asyncio
-from typing import Iterator
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Iterator
 from adapters.base import ModelAdapter
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
 from clients.sydney import SydneyClient
+from utils.util import UsageCounter
+from utils.log import debug_enabled, truncate
 from loguru import logger
 
+_loop: asyncio.AbstractEventLoop = None
+_loop_lock = threading.Lock()
+
+
+def get_sydney_loop() -> asyncio.AbstractEventLoop:
+    """
+    所有SydneyClient都运行在同一个常驻的事件循环中，aiohttp的session和预热的对话都绑定在这个循环上
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="sydney-loop", daemon=True
+            ).start()
+        return _loop
+
+
+def iterate_on_loop(agen: AsyncIterator, loop: asyncio.AbstractEventLoop) -> Iterator:
+    """在其他线程中逐个取出运行在loop上的异步生成器的元素"""
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop)
+
+
+async def aiterate_on_loop(
+    agen: AsyncIterator, loop: asyncio.AbstractEventLoop
+) -> AsyncIterator:
+    """iterate_on_loop的异步版本，在当前事件循环中等待，不占用线程"""
+    future = None
+    try:
+        while True:
+            future = asyncio.run_coroutine_threadsafe(agen.__anext__(), loop)
+            try:
+                yield await asyncio.wrap_future(future)
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(_aclose_after(agen, future), loop)
+
+
+async def _aclose_after(agen: AsyncIterator, pending):
+    # 请求被取消时上一次的__anext__可能还在执行，等它结束后再关闭生成器
+    if pending is not None and not pending.done():
+        try:
+            await asyncio.wrap_future(pending)
+        except BaseException:
+            pass
+    await agen.aclose()
+
+
+class SydneyPool:
+    """
+    预热的SydneyClient池：提前完成创建对话的握手，请求到来时直接发送消息
+    bing的对话是有状态的，每个client只用于一次请求，用完后关闭，池在后台补充新的client
+    只在sydney事件循环中使用
+    """
+
+    def __init__(self, style, cookie, proxy, size: int = 2, max_age_seconds: float = 300):
+        self.style = style
+        self.cookie = cookie
+        self.proxy = proxy
+        self.size = size
+        self.max_age_seconds = max_age_seconds
+        self._ready = deque()
+        self._warming = 0
+
+    async def warm_up(self):
+        self._refill()
+
+    def new_client(self) -> SydneyClient:
+        return SydneyClient(self.style, self.cookie, self.proxy)
+
+    async def acquire(self) -> SydneyClient:
+        now = time.monotonic()
+        client = None
+        while self._ready:
+            created_at, ready = self._ready.popleft()
+            if now - created_at < self.max_age_seconds:
+                client = ready
+                break
+            # 预热太久的对话可能已经过期
+            asyncio.create_task(ready.close_conversation())
+        self._refill()
+        if client is None:
+            client = self.new_client()
+            await client.start_conversation()
+        return client
+
+    def _refill(self):
+        while len(self._ready) + self._warming < self.size:
+            self._warming += 1
+            asyncio.create_task(self._warm())
+
+    async def close(self):
+        """关闭所有预热的对话，之后不再补充"""
+        self.size = 0
+        while self._ready:
+            _, client = self._ready.popleft()
+            await client.close_conversation()
+
+    async def _warm(self):
+        client = self.new_client()
+        try:
+            await client.start_conversation()
+            if len(self._ready) < self.size:
+                self._ready.append((time.monotonic(), client))
+            else:
+                # 池已经关闭
+                await client.close_conversation()
+        except Exception as e:
+            logger.warning(f"sydney warm up failed: {e}")
+            await client.close_conversation()
+        finally:
+            self._warming -= 1
+
 
 class BingSydneyModel(ModelAdapter):
     def __init__(self, **kwargs):
@@ -19,6 +145,15 @@ class BingSydneyModel(ModelAdapter):
         #                          Please ignore the JSON format of the context \
         #                          during the conversation and answer the user's latest conversation: {newMessage} \n {history}",
         # )
+        # 预热的对话数量，0表示不预热，每次请求时创建对话
+        self.pool = SydneyPool(
+            self.style,
+            self.cookie,
+            self.proxy,
+            size=kwargs.pop("pool_size", 2),
+            max_age_seconds=kwargs.pop("pool_max_age_seconds", 300),
+        )
+        asyncio.run_coroutine_threadsafe(self.pool.warm_up(), get_sydney_loop())
         self.config_args = kwargs
 
     def chat_completions(
@@ -28,22 +163,65 @@ class BingSydneyModel(ModelAdapter):
         返回一个迭代器对象
          stream为false   第一个就是结果
         """
+        loop = get_sydney_loop()
+        if request.stream:
+            tokens = iterate_on_loop(self.__chat_stream_help(request), loop)
+            yield from self.stream_responses(request, tokens)
+        else:
+            result = asyncio.run_coroutine_threadsafe(
+                self.__chat_help(request), loop
+            ).result()
+            if debug_enabled():
+                logger.debug("result: {}", truncate(result))
+            yield ChatCompletionResponse(
+                **self.completion_to_openai_response(result, request.model)
+            )
 
+    async def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[ChatCompletionResponse]:
+        loop = get_sydney_loop()
         if request.stream:
-            result = asyncio.run(self.__chat_stream_help(request))
-            for item in result:
-                logger.info(item)
-                yield ChatCompletionResponse(
-                    **self.completion_to_openai_stream_response(item, request.model)
-                )
+            tokens = aiterate_on_loop(self.__chat_stream_help(request), loop)
+            usage_counter = UsageCounter(request.model)
+            try:
+                async for token in tokens:
+                    yield self.stream_response(request, token, usage_counter, None)
+            finally:
+                await tokens.aclose()
+            yield self.stream_response(request, "", usage_counter, "stop")
         else:
-            async_gen = self.__chat_help(request)
-            result = asyncio.run(async_gen)
-            logger.info(result)
+            future = asyncio.run_coroutine_threadsafe(self.__chat_help(request), loop)
+            result = await asyncio.wrap_future(future)
+            if debug_enabled():
+                logger.debug("result: {}", truncate(result))
             yield ChatCompletionResponse(
                 **self.completion_to_openai_response(result, request.model)
             )
 
+    def stream_responses(
+        self, request: ChatCompletionRequest, tokens: Iterator[str]
+    ) -> Iterator[ChatCompletionResponse]:
+        usage_counter = UsageCounter(request.model)
+        for token in tokens:
+            yield self.stream_response(request, token, usage_counter, None)
+        yield self.stream_response(request, "", usage_counter, "stop")
+
+    def stream_response(
+        self, request: ChatCompletionRequest, token: str, usage_counter, finish_reason
+    ) -> ChatCompletionResponse:
+        return ChatCompletionResponse(
+            **self.completion_to_openai_stream_response(
+                token,
+                request.model,
+                finish_reason=finish_reason,
+                usage_counter=usage_counter,
+            )
+        )
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.pool.close(), get_sydney_loop())
+
     def convertOpenAIParams2Prompt(self, request: ChatCompletionRequest) -> str:
         messages = request.messages
         if len(messages) < 2:
@@ -55,15 +233,21 @@ class BingSydneyModel(ModelAdapter):
 
     async def __chat_help(self, request: ChatCompletionRequest):
         prompt = self.convertOpenAIParams2Prompt(request)
-        logger.info("prompt:{}".format(prompt))
-        async with SydneyClient(self.style, self.cookie, self.proxy) as client:
-            completion = await client.ask(prompt)
-            return completion
+        if debug_enabled():
+            logger.debug("prompt:{}", truncate(prompt))
+        client = await self.pool.acquire()
+        try:
+            return await client.ask(prompt)
+        finally:
+            await client.close_conversation()
 
     async def __chat_stream_help(self, request: ChatCompletionRequest):
         prompt = self.convertOpenAIParams2Prompt(request)
-        logger.info("prompt:{}".format(prompt))
-        async with SydneyClient(self.style, self.cookie, self.proxy) as client:
-            return [
-                response_token async for response_token in client.ask_stream(prompt)
-            ]
+        if debug_enabled():
+            logger.debug("prompt:{}", truncate(prompt))
+        client = await self.pool.acquire()
+        try:
+            async for response_token in client.ask_stream(prompt):
+                yield response_token
+        finally:
+            await client.close_conversation()
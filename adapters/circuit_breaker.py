@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Iterator
+import httpx
+from adapters.base import ModelAdapter, UDFApiError, WrapperAdapter, is_final_item
+from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
+from loguru import logger
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 默认计为失败的状态码，除429（上游限流）外的4xx属于请求本身的问题，不代表上游不可用
+# 连接错误和超时由适配器转换为502、504
+default_failure_status = [429, 500, 502, 503, 504]
+
+
+def circuit_open_error(name):
+    return UDFApiError(f"upstream {name} is unavailable (circuit open)", 503)
+
+
+class CircuitBreaker:
+    """
+    熔断器，对应适配器config中的circuit_breaker：
+        "circuit_breaker": {
+            "failure_threshold": 5,     // 连续失败次数达到该值时熔断
+            "error_ratio": 0.5,         // 最近window_size次请求的失败比例达到该值时熔断
+            "window_size": 20,
+            "min_requests": 10,         // 窗口内请求数达到该值才按失败比例判断
+            "open_seconds": 30,         // 熔断持续时间，之后进入半开状态放行探测请求
+            "half_open_max_calls": 1,   // 半开状态下同时放行的探测请求数
+            "failure_status": [429, 500, 502, 503, 504]
+        }
+    """
+
+    def __init__(self, name: str = "", **kwargs):
+        self.name = name
+        self.failure_threshold = kwargs.pop("failure_threshold", 5)
+        self.error_ratio = kwargs.pop("error_ratio", 0.5)
+        self.min_requests = kwargs.pop("min_requests", 10)
+        self.open_seconds = kwargs.pop("open_seconds", 30)
+        self.half_open_max_calls = kwargs.pop("half_open_max_calls", 1)
+        self.failure_status = set(kwargs.pop("failure_status", default_failure_status))
+        self.window = deque(maxlen=kwargs.pop("window_size", 20))
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.half_open_calls = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    return False
+                self.state = HALF_OPEN
+                self.half_open_calls = 0
+                logger.info(f"circuit breaker {self.name} half open")
+            if self.half_open_calls >= self.half_open_max_calls:
+                return False
+            self.half_open_calls += 1
+            return True
+
+    def is_failure(self, e: Exception) -> bool:
+        """只有上游不可用（5xx、429、连接错误、超时）计为失败，适配器自身的异常不影响熔断"""
+        if isinstance(e, UDFApiError):
+            return e.http_status in self.failure_status
+        # 没有经过transport_error转换的网络错误
+        return isinstance(e, (httpx.TransportError, TimeoutError, ConnectionError))
+
+    def on_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.window.append(False)
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
+                self.window.clear()
+                logger.info(f"circuit breaker {self.name} closed")
+
+    def on_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.window.append(True)
+            if self.state == HALF_OPEN or self._should_open():
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                logger.warning(
+                    f"circuit breaker {self.name} open, consecutive_failures:{self.consecutive_failures}"
+                )
+
+    def on_release(self):
+        """请求被客户端提前结束，既不算成功也不算失败，释放半开状态的探测名额"""
+        with self._lock:
+            if self.state == HALF_OPEN and self.half_open_calls > 0:
+                self.half_open_calls -= 1
+
+    def _should_open(self) -> bool:
+        if self.consecutive_failures >= self.failure_threshold:
+            return True
+        return (
+            len(self.window) >= self.min_requests
+            and sum(self.window) / len(self.window) >= self.error_ratio
+        )
+
+
+class CircuitBreakerAdapter(WrapperAdapter):
+    """
+    给适配器实例加上熔断，熔断期间直接返回503，router配置了failover时会转到其他token
+    每个请求只记录一次结果：取到最后一个结果（非stream的结果或带finish_reason的chunk）时为成功，
+    之前出错为失败，客户端提前结束或非上游原因的错误不计入
+    """
+
+    def __init__(self, adapter: ModelAdapter, breaker: CircuitBreaker):
+        super().__init__(adapter)
+        self.breaker = breaker
+
+    def __repr__(self):
+        return f"CircuitBreakerAdapter({self.adapter!r}, state={self.breaker.state})"
+
+    def chat_completions(
+        self, request: ChatCompletionRequest
+    ) -> Iterator[ChatCompletionResponse]:
+        if not self.breaker.allow():
+            raise circuit_open_error(self.breaker.name)
+        settled = False
+        try:
+            for item in self.adapter.chat_completions(request):
+                if not settled and is_final_item(item, request.stream):
+                    self.breaker.on_success()
+                    settled = True
+                yield item
+            if not settled:
+                self.breaker.on_success()
+                settled = True
+        except Exception as e:
+            if not settled and self.breaker.is_failure(e):
+                self.breaker.on_failure()
+                settled = True
+            raise
+        finally:
+            if not settled:
+                self.breaker.on_release()
+
+    async def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[ChatCompletionResponse]:
+        if not self.breaker.allow():
+            raise circuit_open_error(self.breaker.name)
+        settled = False
+        resp = self.adapter.achat_completions(request)
+        try:
+            async for item in resp:
+                if not settled and is_final_item(item, request.stream):
+                    self.breaker.on_success()
+                    settled = True
+                yield item
+            if not settled:
+                self.breaker.on_success()
+                settled = True
+        except Exception as e:
+            if not settled and self.breaker.is_failure(e):
+                self.breaker.on_failure()
+                settled = True
+            raise
+        finally:
+            if not settled:
+                self.breaker.on_release()
+            await resp.aclose()
@@ -1,10 +1,11 @@
 import json
 from typing import Iterator
-import requests
-from adapters.base import ModelAdapter, post, stream
+from adapters.base import ModelAdapter, post, stream, pop_http_options
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
+from utils.log import is_sampled, truncate
 from loguru import logger
-from utils.util import num_tokens_from_string
+from utils.util import UsageCounter
+from utils.sse_client import iter_sse_events
 import time
 
 # 默认的model映射，不过request中的model参数会被config覆盖
@@ -36,6 +37,8 @@ class ClaudeModel(ModelAdapter):
         self.api_key = kwargs.pop("api_key", None)
         self.anthropic_version = kwargs.pop("anthropic-version", None)
         self.model = kwargs.pop("model", None)
+        self.api_base = kwargs.pop("api_base", "https://api.anthropic.com/v1/")
+        self.http_options = pop_http_options(kwargs)
         self.config_args = kwargs
 
     def chat_completions(
@@ -44,9 +47,9 @@ class ClaudeModel(ModelAdapter):
         """
         https://docs.anthropic.com/claude/reference/getting-started-with-the-api
         """
-        openai_params = request.model_dump_json()
+        openai_params = request.model_dump()
         claude_params = self.openai_to_claude_params(openai_params)
-        url = "https://api.anthropic.com/v1/complete"
+        url = f"{self.api_base}complete"
         headers = {
             "x-api-key": self.api_key,
             "accept": "application/json",
@@ -54,32 +57,35 @@ class ClaudeModel(ModelAdapter):
             "anthropic-version": self.anthropic_version,
         }
         if request.stream:
-            response = stream(url, headers, claude_params)
-            for chunk in response.iter_lines(chunk_size=1024):
-                # 移除头部data: 字符
-                decoded_line = chunk.decode("utf-8")
-                logger.info(f"decoded_line: {decoded_line}")
-                decoded_line = decoded_line.lstrip("data:").strip()
-                json_line = json.loads(decoded_line)
-                stop_reason = json_line.get("stop_reason")
-                openai_response = None
-                if stop_reason:
-                    openai_response = self.claude_to_chatgpt_response_stream(
-                        {
-                            "completion": "",
-                            "stop_reason": stop_reason,
-                        }
-                    )
-                else:
-                    completion = json_line.get("completion")
-                    if completion:
+            response = stream(url, headers, claude_params, http_options=self.http_options)
+            usage_counter = UsageCounter(self.model)
+            try:
+                for event in iter_sse_events(response.iter_bytes()):
+                    if is_sampled():
+                        logger.debug("event: {}, data: {}", event.event, truncate(event.data))
+                    json_line = json.loads(event.data)
+                    stop_reason = json_line.get("stop_reason")
+                    openai_response = None
+                    if stop_reason:
                         openai_response = self.claude_to_chatgpt_response_stream(
-                            decoded_line
+                            {
+                                "completion": "",
+                                "stop_reason": stop_reason,
+                            },
+                            usage_counter,
                         )
-                if openai_response:
-                    yield ChatCompletionResponse(**openai_response)
+                    else:
+                        completion = json_line.get("completion")
+                        if completion:
+                            openai_response = self.claude_to_chatgpt_response_stream(
+                                json_line, usage_counter
+                            )
+                    if openai_response:
+                        yield ChatCompletionResponse(**openai_response)
+            finally:
+                response.close()
         else:
-            response = post(url, headers, claude_params)
+            response = post(url, headers, claude_params, http_options=self.http_options)
             openai_response = self.claude_to_chatgpt_response(response)
             yield ChatCompletionResponse(**openai_response)
 
@@ -120,7 +126,9 @@ class ClaudeModel(ModelAdapter):
         claude_params.update(self.config_args)
         return claude_params
 
-    def claude_to_chatgpt_response_stream(self, claude_response):
+    def claude_to_chatgpt_response_stream(
+        self, claude_response, usage_counter: UsageCounter = None
+    ):
         completion = claude_response.get("completion", "")
         finish_reason = (
             stop_reason_map[claude_response.get("stop_reason")]
@@ -128,7 +136,10 @@ class ClaudeModel(ModelAdapter):
             else None
         )
         return self.completion_to_openai_stream_response(
-            completion, self.model, finish_reason=finish_reason
+            completion,
+            self.model,
+            finish_reason=finish_reason,
+            usage_counter=usage_counter,
         )
 
     def claude_to_chatgpt_response(self, claude_response):
@@ -1,8 +1,9 @@
 from typing import Iterator
 from adapters.base import ModelAdapter
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
+from utils.log import debug_enabled, truncate
 from loguru import logger
-from utils.util import num_tokens_from_string
+from utils.util import UsageCounter
 from clients.claude_web_client import ClaudeWebClient
 import time
 
@@ -43,18 +44,47 @@ class ClaudeWebModel(ModelAdapter):
         conversation_id = self.conversation_id
         if not self.single_conversation:
             conversation_id = self.client.create_new_chat()["uuid"]
-        response = self.client.send_message(claudePrompt, conversation_id)
-        if request.stream:  # 假的stream
-            resp = self.claude_to_openai_stream_response(response)
+        if debug_enabled():
+            logger.debug(
+                "ClaudeWebModel req:{}, conversation_id:{}, claudePrompt:{}",
+                truncate(request),
+                conversation_id,
+                truncate(claudePrompt),
+            )
+        if request.stream:
+            id = f"chatcmpl-{str(time.time())}"
+            usage_counter = UsageCounter()
+            for completion in self.client.send_message_stream(
+                claudePrompt, conversation_id
+            ):
+                yield ChatCompletionResponse(
+                    **self.claude_to_openai_stream_response(
+                        completion, id, usage_counter, finish_reason=None
+                    )
+                )
+            yield ChatCompletionResponse(
+                **self.claude_to_openai_stream_response("", id, usage_counter)
+            )
         else:
+            response = self.client.send_message(claudePrompt, conversation_id)
             resp = self.claude_to_openai_response(response)
-        logger.info(
-            f"ClaudeWebModel req:{request}, conversation_id:{conversation_id}, claudePrompt:{claudePrompt} ,resp:{resp}"
-        )
-        yield ChatCompletionResponse(**resp)
+            if debug_enabled():
+                logger.debug("ClaudeWebModel conversation_id:{}, resp:{}", conversation_id, truncate(resp))
+            yield ChatCompletionResponse(**resp)
 
-    def claude_to_openai_stream_response(self, completion: str):
-        return self.completion_to_openai_stream_response(completion)
+    def claude_to_openai_stream_response(
+        self,
+        completion: str,
+        id: str,
+        usage_counter: UsageCounter,
+        finish_reason="stop",
+    ):
+        return self.completion_to_openai_stream_response(
+            completion,
+            id=id,
+            finish_reason=finish_reason,
+            usage_counter=usage_counter,
+        )
 
     def claude_to_openai_response(self, completion: str):
         return self.completion_to_openai_response(completion)
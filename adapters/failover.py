@@ -0,0 +1,106 @@
+import asyncio
+import random
+import time
+from typing import AsyncIterator, Callable, Iterator, List, Tuple
+from adapters.base import UDFApiError
+from loguru import logger
+from utils.util import config_token_hash, hash_fingerprint
+
+# 默认可重试的状态码：限流、上游错误、超时
+default_retry_on_status = [429, 500, 502, 503, 504]
+
+
+class FailoverPolicy:
+    """
+    失败转移配置，对应router、model-name-router config中的failover：
+        "failover": {
+            "max_attempts": 3,          // 最多尝试的次数（含第一次），默认1即不重试
+            "backoff_seconds": 0.2,     // 重试前等待的基础时间，按指数退避并加随机抖动
+            "max_backoff_seconds": 2,
+            "retry_on_status": [429, 500, 502, 503, 504],
+            "fallback_tokens": []       // model-name-router使用，主token失败后依次尝试的token
+        }
+    只有在还没有向客户端返回任何数据时才会重试
+    """
+
+    def __init__(self, **kwargs):
+        self.max_attempts = kwargs.pop("max_attempts", 1)
+        self.backoff_seconds = kwargs.pop("backoff_seconds", 0.2)
+        self.max_backoff_seconds = kwargs.pop("max_backoff_seconds", 2)
+        self.retry_on_status = set(kwargs.pop("retry_on_status", default_retry_on_status))
+        # 和router中的token一样转换为sha256
+        self.fallback_tokens: List[str] = [
+            config_token_hash(t) for t in kwargs.pop("fallback_tokens", [])
+        ]
+
+    def retriable(self, e: Exception) -> bool:
+        return isinstance(e, UDFApiError) and e.http_status in self.retry_on_status
+
+    def backoff(self, attempt: int) -> float:
+        delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1)
+
+
+def failover_stream(
+    policy: FailoverPolicy, open_stream: Callable[[List[str]], Tuple[str, Iterator]]
+) -> Iterator:
+    """
+    open_stream(已尝试过的token) 返回 (token, 上游迭代器)
+    拿到第一个元素之前出现可重试的错误时，换一个token重试；一旦开始返回数据就不再重试
+    """
+    tried = []
+    attempt = 0
+    while True:
+        attempt += 1
+        token, resp = open_stream(tried)
+        tried.append(token)
+        try:
+            first = next(resp)
+        except StopIteration:
+            return
+        except Exception as e:
+            if attempt >= policy.max_attempts or not policy.retriable(e):
+                raise
+            delay = policy.backoff(attempt)
+            logger.warning(
+                f"failover: token:{hash_fingerprint(token)} failed: {e}, attempt:{attempt}, retry in {delay:.2f}s"
+            )
+            time.sleep(delay)
+            continue
+        yield first
+        yield from resp
+        return
+
+
+async def afailover_stream(
+    policy: FailoverPolicy,
+    open_stream: Callable[[List[str]], Tuple[str, AsyncIterator]],
+) -> AsyncIterator:
+    """failover_stream的异步版本"""
+    tried = []
+    attempt = 0
+    while True:
+        attempt += 1
+        token, resp = open_stream(tried)
+        tried.append(token)
+        try:
+            first = await anext(resp)
+        except StopAsyncIteration:
+            return
+        except Exception as e:
+            if attempt >= policy.max_attempts or not policy.retriable(e):
+                raise
+            delay = policy.backoff(attempt)
+            logger.warning(
+                f"failover: token:{hash_fingerprint(token)} failed: {e}, attempt:{attempt}, retry in {delay:.2f}s"
+            )
+            await asyncio.sleep(delay)
+            continue
+        try:
+            yield first
+            async for item in resp:
+                yield item
+        finally:
+            # async for不会像yield from一样把提前结束传递给上游，这里主动关闭以释放连接
+            await resp.aclose()
+        return
@@ -2,9 +2,16 @@ import json
 import time
 from typing import Dict, Iterator, List
 import uuid
-from adapters.base import ModelAdapter, post
+from adapters.base import (
+    ModelAdapter,
+    post,
+    stream,
+    pop_http_options,
+    invalid_request_error,
+)
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse, ChatMessage
-from utils.util import num_tokens_from_string
+from utils.sse_client import iter_sse_events
+from utils.util import UsageCounter
 
 """
 
@@ -87,6 +94,15 @@ https://ai.google.dev/tutorials/rest_quickstart
 """
 
 
+finish_reason_map = {
+    "STOP": "stop",
+    "MAX_TOKENS": "length",
+    "SAFETY": "content_filter",
+    "RECITATION": "content_filter",
+    "OTHER": "stop",
+}
+
+
 class GeminiAdapter(ModelAdapter):
     def __init__(self, **kwargs):
         super().__init__()
@@ -96,34 +112,94 @@ class GeminiAdapter(ModelAdapter):
         )
         self.proxies = kwargs.pop("proxies", None)
         self.model = "gemini-pro"
+        self.api_base = kwargs.pop(
+            "api_base", "https://generativelanguage.googleapis.com/v1beta/"
+        )
+        self.http_options = pop_http_options(kwargs)
         self.config_args = kwargs
 
     def chat_completions(
         self, request: ChatCompletionRequest
     ) -> Iterator[ChatCompletionResponse]:
-        method = "generateContent"
         headers = {"Content-Type": "application/json"}
-        # if request.stream:
-        #     method = "streamGenerateContent"
-        url = (
-            f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:{method}?key="
-            + self.api_key
-        )
         params = self.convert_2_gemini_param(request)
-        response = post(url, headers=headers, proxies=self.proxies, params=params)
-        if request.stream:  # 假的stream
-            openai_response = self.response_convert_stream(response)
+        if request.stream:
+            # alt=sse 时上游按sse格式逐块返回，每块只包含新生成的内容
+            url = (
+                f"{self.api_base}models/{self.model}:streamGenerateContent?alt=sse&key="
+                + self.api_key
+            )
+            response = stream(
+                url,
+                headers,
+                params,
+                proxies=self.proxies,
+                http_options=self.http_options,
+            )
+            id = f"chatcmpl-{str(time.time())}"
+            usage_counter = UsageCounter(self.model)
+            try:
+                for event in iter_sse_events(response.iter_bytes()):
+                    openai_response = self.response_convert_stream(
+                        json.loads(event.data), id, usage_counter
+                    )
+                    yield ChatCompletionResponse(**openai_response)
+            finally:
+                response.close()
         else:
-            openai_response = self.response_convert(response)
-        yield ChatCompletionResponse(**openai_response)
+            url = f"{self.api_base}models/{self.model}:generateContent?key=" + self.api_key
+            response = post(
+                url,
+                headers=headers,
+                proxies=self.proxies,
+                params=params,
+                http_options=self.http_options,
+            )
+            yield ChatCompletionResponse(**self.response_convert(response))
+
+    def first_candidate(self, data) -> dict:
+        candidates = data.get("candidates")
+        if not candidates:
+            # prompt被拦截时没有candidates，只有promptFeedback
+            block_reason = data.get("promptFeedback", {}).get("blockReason")
+            raise invalid_request_error(f"gemini blocked the prompt: {block_reason}")
+        return candidates[0]
 
-    def response_convert_stream(self, data):
-        completion = data["candidates"][0]["content"]["parts"][0]["text"]
-        return self.completion_to_openai_stream_response(completion, self.model)
+    def candidate_text(self, candidate) -> str:
+        parts = candidate.get("content", {}).get("parts", [])
+        return "".join(part.get("text", "") for part in parts)
+
+    def usage_kwargs(self, data) -> dict:
+        usage = data.get("usageMetadata")
+        if not usage:
+            return {}
+        return {
+            "prompt_tokens": usage.get("promptTokenCount", 0),
+            "completion_tokens": usage.get("candidatesTokenCount", 0),
+        }
+
+    def response_convert_stream(self, data, id, usage_counter: UsageCounter):
+        candidate = self.first_candidate(data)
+        finish_reason = finish_reason_map.get(candidate.get("finishReason"))
+        # usage只放在最后一块，上游没有返回usageMetadata时由usage_counter计算
+        usage = self.usage_kwargs(data) if finish_reason else {}
+        return self.completion_to_openai_stream_response(
+            self.candidate_text(candidate),
+            self.model,
+            id=id,
+            finish_reason=finish_reason,
+            usage_counter=usage_counter,
+            **usage,
+        )
 
     def response_convert(self, data):
-        completion = data["candidates"][0]["content"]["parts"][0]["text"]
-        return self.completion_to_openai_response(completion, self.model)
+        candidate = self.first_candidate(data)
+        return self.completion_to_openai_response(
+            self.candidate_text(candidate),
+            self.model,
+            finish_reason=finish_reason_map.get(candidate.get("finishReason"), "stop"),
+            **self.usage_kwargs(data),
+        )
 
     """
     [
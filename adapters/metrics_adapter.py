@@ -0,0 +1,63 @@
+import asyncio
+from typing import AsyncIterator, Iterator
+from adapters.base import ModelAdapter, UDFApiError, WrapperAdapter
+from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
+from utils.metrics import upstream_metrics
+
+
+def error_status(e: BaseException) -> int:
+    """指标中的状态码：适配器抛出的错误码，客户端提前断开为499，其他异常为500"""
+    if isinstance(e, UDFApiError):
+        return e.http_status
+    if isinstance(e, (GeneratorExit, asyncio.CancelledError)):
+        return 499
+    return 500
+
+
+class MetricsAdapter(WrapperAdapter):
+    """
+    统计访问上游的请求数、首包和总耗时、chunk间隔、进行中的stream和token用量，
+    包在具体的适配器外、熔断之内，熔断直接拒绝和缓存命中的请求不计入
+    """
+
+    def __init__(self, adapter: ModelAdapter, token: str, type: str):
+        super().__init__(adapter)
+        self.token = token
+        self.type = type
+
+    def chat_completions(
+        self, request: ChatCompletionRequest
+    ) -> Iterator[ChatCompletionResponse]:
+        observer = upstream_metrics.observe(self.token, self.type, request.stream)
+        status = 200
+        try:
+            for item in self.adapter.chat_completions(request):
+                observer.on_item(item)
+                if not request.stream:
+                    # 非stream只有一个结果，调用方取到后直接关闭迭代器
+                    observer.finish(200)
+                yield item
+        except BaseException as e:
+            status = error_status(e)
+            raise
+        finally:
+            observer.finish(status)
+
+    async def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[ChatCompletionResponse]:
+        observer = upstream_metrics.observe(self.token, self.type, request.stream)
+        status = 200
+        resp = self.adapter.achat_completions(request)
+        try:
+            async for item in resp:
+                observer.on_item(item)
+                if not request.stream:
+                    observer.finish(200)
+                yield item
+        except BaseException as e:
+            status = error_status(e)
+            raise
+        finally:
+            observer.finish(status)
+            await resp.aclose()
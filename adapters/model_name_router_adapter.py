@@ -1,30 +1,72 @@
-from typing import Iterator
+from typing import AsyncIterator, Iterator
 from adapters.base import ModelAdapter
+from adapters.failover import FailoverPolicy, failover_stream, afailover_stream
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
+from utils.util import config_token_hash, hash_fingerprint
+from utils.log import debug_enabled
 from loguru import logger
 
 
 class ModelNameRouterAdapter(ModelAdapter):
     def __init__(self, factory_method, **kwargs):
         super().__init__(**kwargs)
-        self.model_2_token: dict = kwargs.pop("model-2-token", {})
+        # 配置加载时把token转换为sha256，和适配器表的key一致，不保存token原文
+        self.model_2_token: dict = {
+            model: config_token_hash(token)
+            for model, token in kwargs.pop("model-2-token", {}).items()
+        }
         self.default_token = self.model_2_token.get("default", None)
         self.factory_method = factory_method
+        self.failover = FailoverPolicy(**kwargs.pop("failover", {}))
+        # token的sha256 -> 下游实例，配置加载时由resolve_routes填充
+        self.adapters = {}
 
-    def chat_completions(
-        self, request: ChatCompletionRequest
-    ) -> Iterator[ChatCompletionResponse]:
+    def resolve_routes(self, adapters: dict):
+        tokens = set(self.model_2_token.values()) | set(self.failover.fallback_tokens)
+        self.adapters = {t: adapters[t] for t in tokens if t in adapters}
+
+    def select_adapter(self, request: ChatCompletionRequest, exclude=()):
+        """
+        按model名选择token，失败转移时依次使用failover中配置的fallback_tokens
+        """
         token = None
         adapter = None
         model_name = request.model
         if model_name in self.model_2_token:
             token = self.model_2_token[model_name]
-            adapter = self.factory_method(token)
         else:
             assert self.default_token is not None, "No default token is specified"
             token = self.default_token
+        if token in exclude:
+            token = next(
+                (t for t in self.failover.fallback_tokens if t not in exclude), token
+            )
+        adapter = self.adapters.get(token)
+        if adapter is None:
             adapter = self.factory_method(token)
-        logger.info(
-            f"ModelNameRouterAdapter model_name:{model_name} select:token:{token}, adapter:{adapter}"
-        )
-        return adapter.chat_completions(request)
+        if debug_enabled():
+            logger.debug(
+                "ModelNameRouterAdapter model_name:{} select:token:{}, adapter:{}",
+                model_name,
+                hash_fingerprint(token),
+                adapter,
+            )
+        return token, adapter
+
+    def chat_completions(
+        self, request: ChatCompletionRequest
+    ) -> Iterator[ChatCompletionResponse]:
+        def open_stream(tried):
+            token, adapter = self.select_adapter(request, tried)
+            return token, adapter.chat_completions(request)
+
+        return failover_stream(self.failover, open_stream)
+
+    def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[ChatCompletionResponse]:
+        def open_stream(tried):
+            token, adapter = self.select_adapter(request, tried)
+            return token, adapter.achat_completions(request)
+
+        return afailover_stream(self.failover, open_stream)
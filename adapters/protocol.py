@@ -1,3 +1,5 @@
+import json
+from json.encoder import encode_basestring as _json_str
 from pydantic import BaseModel, Field
 from typing import Dict, List, Literal, Optional, Union
 import time
@@ -60,6 +62,20 @@ class Usage(BaseModel):
     total_tokens: int = 0
 
 
+def frame_usage(frame: bytes) -> Optional[Usage]:
+    """
+    透传模式下的sse帧（b"data: {...}\n\n"）中的usage，没有时返回None
+    openai在请求带 stream_options.include_usage 时在最后一帧返回usage，调用方只需要解析最后一帧
+    """
+    if b'"usage"' not in frame:
+        return None
+    try:
+        usage = json.loads(frame[frame.index(b":") + 1 :]).get("usage")
+        return Usage(**usage) if usage else None
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
 class ChatCompletionResponse(BaseModel):
     id: str = f"chatcmpl-{str(time.time())}"
     model: str
@@ -71,3 +87,53 @@ class ChatCompletionResponse(BaseModel):
     usage: Optional[Usage] = None
 
 
+class StreamChunkEncoder:
+    """
+    stream下把chunk编码为sse帧，输出与 model_dump_json(exclude_none=True) 一致
+    同一个stream中id、model、object基本不变，预先渲染这部分前缀，之后每个chunk只拼接delta、finish_reason等字段，
+    不经过pydantic的序列化；不是单个stream choice的响应退回model_dump_json
+    """
+
+    def __init__(self):
+        self._key = None
+        self._prefix = None
+
+    def encode(self, response: ChatCompletionResponse) -> str:
+        choices = response.choices
+        if len(choices) != 1 or not isinstance(
+            choices[0], ChatCompletionResponseStreamChoice
+        ):
+            return f"data: {response.model_dump_json(exclude_none=True)}\n\n"
+        key = (response.id, response.model, response.object)
+        if key != self._key:
+            self._key = key
+            self._prefix = (
+                f'data: {{"id":{_json_str(response.id)},"model":{_json_str(response.model)},'
+                f'"object":{_json_str(response.object)},"choices":[{{"index":'
+            )
+        choice = choices[0]
+        delta = choice.delta
+        role, content = delta.role, delta.content
+        if role is not None and content is not None:
+            delta_json = f'"role":{_json_str(role)},"content":{_json_str(content)}'
+        elif content is not None:
+            delta_json = f'"content":{_json_str(content)}'
+        elif role is not None:
+            delta_json = f'"role":{_json_str(role)}'
+        else:
+            delta_json = ""
+        finish_reason = choice.finish_reason
+        tail = (
+            "}]"
+            if finish_reason is None
+            else f',"finish_reason":{_json_str(finish_reason)}}}]'
+        )
+        if response.created is not None:
+            tail = f'{tail},"created":{response.created}'
+        usage = response.usage
+        if usage is not None:
+            tail = (
+                f'{tail},"usage":{{"prompt_tokens":{usage.prompt_tokens},'
+                f'"completion_tokens":{usage.completion_tokens},"total_tokens":{usage.total_tokens}}}'
+            )
+        return f'{self._prefix}{choice.index},"delta":{{{delta_json}}}{tail}}}\n\n'
@@ -1,8 +1,19 @@
 import json
-from typing import Iterator
-from adapters.base import ModelAdapter, stream, post
+from typing import AsyncIterator, Iterator, Union
+from adapters.base import (
+    ModelAdapter,
+    stream,
+    post,
+    astream,
+    apost,
+    pop_http_options,
+    passthrough_stream,
+    apassthrough_stream,
+)
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
+from utils.log import debug_enabled, is_sampled, truncate
 from loguru import logger
+from utils.sse_client import iter_sse_data, aiter_sse_data
 
 
 class ProxyAdapter(ModelAdapter):
@@ -14,36 +25,95 @@ class ProxyAdapter(ModelAdapter):
         super().__init__()
         self.api_key = kwargs.pop("api_key", None)
         self.api_base = kwargs.pop("api_base", None)
+        self.http_options = pop_http_options(kwargs)
+        # 透传模式：stream时上游的sse字节原样转发，不构造pydantic对象；rewrite_model为true时改写为请求中的model
+        self.passthrough = kwargs.pop("passthrough", False)
+        self.rewrite_model = kwargs.pop("rewrite_model", None)
         self.config_args = kwargs
 
-    def chat_completions(self, request: ChatCompletionRequest) -> Iterator[ChatCompletionResponse]:
+    def chat_completions(self, request: ChatCompletionRequest) -> Iterator[Union[ChatCompletionResponse, bytes]]:
         """
         https://platform.openai.com/docs/api-reference/chat/create
         https://platform.openai.com/docs/guides/gpt/chat-completions-api
         """
+        url, header, req_args = self.build_request(request)
+        if request.stream:
+            response = stream(url, header, req_args, http_options=self.http_options)
+            try:
+                if self.passthrough:
+                    yield from passthrough_stream(
+                        response.iter_bytes(), self.passthrough_model(request)
+                    )
+                    return
+                for data in iter_sse_data(response.iter_bytes()):
+                    resp = self.parse_stream_data(data)
+                    if resp is StopIteration:
+                        break
+                    if resp:
+                        yield resp
+            finally:
+                response.close()
+        else:
+            response = post(url, header, req_args, http_options=self.http_options)
+            resp = ChatCompletionResponse(**response)
+            yield resp
+
+    async def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[Union[ChatCompletionResponse, bytes]]:
+        url, header, req_args = self.build_request(request)
+        if request.stream:
+            response = await astream(url, header, req_args, http_options=self.http_options)
+            try:
+                if self.passthrough:
+                    async for frame in apassthrough_stream(
+                        response.aiter_bytes(), self.passthrough_model(request)
+                    ):
+                        yield frame
+                    return
+                async for data in aiter_sse_data(response.aiter_bytes()):
+                    resp = self.parse_stream_data(data)
+                    if resp is StopIteration:
+                        break
+                    if resp:
+                        yield resp
+            finally:
+                await response.aclose()
+        else:
+            response = await apost(url, header, req_args, http_options=self.http_options)
+            yield ChatCompletionResponse(**response)
+
+    def build_request(self, request: ChatCompletionRequest):
         header = {}
         header["Content-Type"] = "application/json"
         header["Authorization"] = "Bearer " + self.api_key
         url = f"{self.api_base}chat/completions"
         req_args = self.convert_param(request)
-        logger.info(f"ProxyAdapter url: {url}, data: {req_args}")
-        if request.stream:
-            response = stream(url, header, req_args)
-            for chunk in response.iter_lines(chunk_size=1024):
-                # 移除头部data: 字符
-                decoded_line = chunk.decode('utf-8')
-                logger.info(f"decoded_line: {decoded_line}")
-                decoded_line = decoded_line.lstrip("data:").strip()
-                if "[DONE]" == decoded_line:
-                    break
-                if decoded_line:
-                    yield ChatCompletionResponse(**json.loads(decoded_line))
-        else:
-            response = post(url, header, req_args)
-            resp = ChatCompletionResponse(**response)
-            yield resp
+        if debug_enabled():
+            logger.debug("ProxyAdapter url: {}, data: {}", url, truncate(req_args))
+        return url, header, req_args
+
+    def passthrough_model(self, request: ChatCompletionRequest):
+        if self.rewrite_model is True:
+            return request.model
+        return self.rewrite_model
+
+    def parse_stream_data(self, data: bytes):
+        """
+        解析一个sse事件的data，[DONE]时返回StopIteration，空数据返回None
+        """
+        if is_sampled():
+            logger.debug("stream data: {}", truncate(data))
+        if data == b"[DONE]":
+            return StopIteration
+        if data:
+            return ChatCompletionResponse(**json.loads(data))
+        return None
 
     def convert_param(self, request: ChatCompletionRequest):
         req_args = request.model_dump(exclude_none=True, exclude_defaults=True)
         req_args.update(self.config_args)
+        if not request.stream:
+            # openai只允许stream请求带stream_options
+            req_args.pop("stream_options", None)
         return req_args
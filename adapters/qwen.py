@@ -1,9 +1,33 @@
-import copy
 import json
 from typing import Iterator
-from adapters.base import ModelAdapter, serverError, post, stream
+from adapters.base import ModelAdapter, serverError, post, stream, pop_http_options
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
+from utils.log import is_sampled, truncate
 from loguru import logger
+from utils.sse_client import iter_sse_events
+
+
+class QWenStreamDelta:
+    """
+    把通义千问stream的累积输出转换为增量，只保存上一次的内容长度，
+    incremental_output模式下上游返回的内容本身就是增量
+    usage不做转换，保持上游的累积值，和其他适配器一致：stream中每个chunk的usage都是截至该chunk的总数
+    """
+
+    def __init__(self, incremental_output: bool = False):
+        self.incremental_output = incremental_output
+        self.content_length = 0
+
+    def update(self, output: dict):
+        """返回 (增量内容, 累积prompt_tokens, 累积completion_tokens, finish_reason)"""
+        usage = output["usage"]
+        choice = output["output"]["choices"][0]
+        content = choice["message"]["content"]
+        if not self.incremental_output:
+            length = len(content)
+            content = content[self.content_length :]
+            self.content_length = length
+        return content, usage["input_tokens"], usage["output_tokens"], choice["finish_reason"]
 
 
 class QWenAdapter(ModelAdapter):
@@ -11,8 +35,12 @@ class QWenAdapter(ModelAdapter):
         super().__init__(**kwargs)
         self.api_key = kwargs.pop("api_key")
         self.model = kwargs.pop("model")
+        # stream时上游只返回增量内容，避免每个事件都返回全部内容
+        self.incremental_output = kwargs.pop("incremental_output", False)
+        api_base = kwargs.pop("api_base", "https://dashscope.aliyuncs.com/api/v1/")
+        self.http_options = pop_http_options(kwargs)
         self.config_args = kwargs
-        self.url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+        self.url = f"{api_base}services/aigc/text-generation/generation"
 
     def chat_completions(
         self, request: ChatCompletionRequest
@@ -26,61 +54,37 @@ class QWenAdapter(ModelAdapter):
         }
         if request.stream:
             headers["X-DashScope-SSE"] = "enable"
-            response = stream(self.url, headers, params=data)
+            response = stream(self.url, headers, params=data, http_options=self.http_options)
             index = 0
-            error = False
-            last_output = None
-            for chunk in response.iter_lines(chunk_size=1024):
-                # 移除头部data: 字符
-                decoded_line = chunk.decode("utf-8")
-                logger.info(f"decoded_line: {decoded_line}")
-                if decoded_line.startswith("id"):
-                    index = int(decoded_line.lstrip("id:").strip())
-                if decoded_line.startswith("event:error"):
-                    error = True
-                if not decoded_line.startswith("data:"):
-                    continue
-                decoded_line = decoded_line.lstrip("data:").strip()
-                if error:
-                    raise serverError(decoded_line)
-                output = json.loads(decoded_line)
-                openai_resp = self.qw_resp_2_openai_resp_stream(
-                    self.qw_stream_output_handle(output, last_output), index
-                )
-                last_output = output
-                yield ChatCompletionResponse(**openai_resp)
+            delta = QWenStreamDelta(self.incremental_output)
+            try:
+                for event in iter_sse_events(response.iter_bytes()):
+                    if is_sampled():
+                        logger.debug("chat_completions event: {}", truncate(event))
+                    if event.event == "error":
+                        raise serverError(event.data)
+                    if event.id:
+                        index = int(event.id)
+                    output = json.loads(event.data)
+                    openai_resp = self.qw_resp_2_openai_resp_stream(
+                        output, delta, index
+                    )
+                    yield ChatCompletionResponse(**openai_resp)
+            finally:
+                response.close()
 
         else:
-            response = post(self.url, headers=headers, params=data)
+            response = post(self.url, headers=headers, params=data, http_options=self.http_options)
 
             yield ChatCompletionResponse(**self.qw_resp_2_openai_resp(response))
 
-    def qw_stream_output_handle(self, output: dict, last_output: dict):
-        prompt_tokens = output["usage"]["input_tokens"]
-        completion_tokens = output["usage"]["output_tokens"]
-        content = output["output"]["choices"][0]["message"]["content"]
-        try:
-            last_prompt_tokens = last_output["usage"]["input_tokens"]
-            last_completion_tokens = last_output["usage"]["output_tokens"]
-            last_content = last_output["output"]["choices"][0]["message"]["content"]
-        except:
-            last_prompt_tokens = 0
-            last_completion_tokens = 0
-            last_content = ""
-        new_output = copy.deepcopy(output)
-        new_output["usage"]["input_tokens"] = prompt_tokens - last_prompt_tokens
-        new_output["usage"]["output_tokens"] = completion_tokens - last_completion_tokens
-        new_output["output"]["choices"][0]["message"]["content"] = content[
-            len(last_content) :
-        ]
-        return new_output
-
-    def qw_resp_2_openai_resp_stream(self, response: dict, index: int) -> dict:
+    def qw_resp_2_openai_resp_stream(
+        self, response: dict, delta: QWenStreamDelta, index: int
+    ) -> dict:
         id = response["request_id"]
-        prompt_tokens = response["usage"]["input_tokens"]
-        completion_tokens = response["usage"]["output_tokens"]
-        content = response["output"]["choices"][0]["message"]["content"]
-        finish_reason = response["output"]["choices"][0]["finish_reason"]
+        content, prompt_tokens, completion_tokens, finish_reason = delta.update(
+            response
+        )
         if finish_reason == "null":
             finish_reason = None
         return self.completion_to_openai_stream_response(
@@ -113,7 +117,7 @@ class QWenAdapter(ModelAdapter):
         else:
             d["model"] = request.model
         if len(self.config_args) > 0:
-            d["parameters"] = self.config_args
+            d["parameters"] = dict(self.config_args)
         else:
             parameters = {}
             if request.temperature:
@@ -122,6 +126,8 @@ class QWenAdapter(ModelAdapter):
                 parameters["top_p"] = request.top_p
             d["parameters"] = parameters
         d["parameters"]["result_format"] = "message"
+        if request.stream and self.incremental_output:
+            d["parameters"]["incremental_output"] = True
         d["input"] = {}
         d["input"]["messages"] = [
             m.model_dump(exclude_none=True) for m in request.messages
@@ -0,0 +1,207 @@
+import asyncio
+import threading
+import time
+from typing import AsyncIterator, Iterator
+from adapters.base import ModelAdapter, WrapperAdapter, rate_limit_error
+from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse, frame_usage
+from utils.limiter import ConcurrencyLimiter, ConcurrencyTimeout
+from utils.shared_state import get_shared_state
+from utils.util import estimate_tokens
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_token_limiter(name: str, max_concurrency: int) -> ConcurrencyLimiter:
+    """配置重新加载后同一个token继续使用原来的limiter，旧实例上进行中的请求仍然占用名额"""
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = _limiters[name] = ConcurrencyLimiter(max_concurrency)
+        limiter.limit = max_concurrency
+        return limiter
+
+
+def estimate_prompt_tokens(request: ChatCompletionRequest) -> int:
+    return sum(estimate_tokens(m.content) for m in request.messages if m.content)
+
+
+def stream_usage(usage, last):
+    """usage为最后一个带usage的chunk中的值，透传模式下chunk为sse帧bytes，从最后一帧中解析"""
+    if usage is None and isinstance(last, bytes):
+        return frame_usage(last)
+    return usage
+
+
+class RateLimitAdapter(WrapperAdapter):
+    """
+    限流，对应config中的rate_limit，在调用适配器之前检查，超过限制返回429：
+        "rate_limit": {
+            "rpm": 60,                      // 每分钟请求数，令牌桶，允许突发到rpm
+            "tpm": 100000,                  // 每分钟token数，请求前按估算的prompt token扣除，结束后按usage补扣
+            "max_concurrency": 10,          // 同时进行中的请求数，stream请求直到结束才释放
+            "queue_timeout_seconds": 0      // 超过限制时最多排队等待的秒数，0表示直接返回429
+        }
+    rpm、tpm的令牌桶保存在共享状态中，多worker时共同计数，异步接口下共享状态为sqlite时在线程池中读写；
+    max_concurrency为每个worker进程的上限
+    429按openai的格式返回错误对象，type为requests或tokens，并在Retry-After头中给出建议的等待秒数
+    配置在router上时限制的是使用该token的客户端，配置在具体的模型上时限制的是该上游的key，
+    router转发的请求同样计入，配合failover可以在上游限流时换其他token
+    """
+
+    def __init__(
+        self,
+        adapter: ModelAdapter,
+        name: str,
+        rpm: int = None,
+        tpm: int = None,
+        max_concurrency: int = None,
+        queue_timeout_seconds: float = 0,
+    ):
+        super().__init__(adapter)
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.rpm_key = f"rate_limit:{name}:rpm"
+        self.tpm_key = f"rate_limit:{name}:tpm"
+        self.queue_timeout = queue_timeout_seconds
+        self.limiter = get_token_limiter(name, max_concurrency) if max_concurrency else None
+        self.state = get_shared_state()
+
+    def limited(self, type: str, reason: str, wait: float = None):
+        retry = f", please try again in {wait:.1f}s" if wait else ""
+        return rate_limit_error(
+            f"rate limit reached for {self.name}: {reason}{retry}", type, wait
+        )
+
+    def prompt_tokens(self, request: ChatCompletionRequest) -> int:
+        if not self.tpm:
+            return 0
+        tokens = estimate_prompt_tokens(request)
+        if tokens > self.tpm:
+            raise self.limited(
+                "tokens", f"request too large, {tokens} tokens, limit {self.tpm} / min"
+            )
+        return tokens
+
+    def try_take(self, tokens: int):
+        """
+        扣除rpm、tpm的令牌，都够用时返回(0, None)；
+        否则退回已扣除的部分，返回需要等待的秒数和超过的限制（429错误）
+        """
+        if self.rpm:
+            wait = self.state.take(self.rpm_key, 1, self.rpm / 60, self.rpm)
+            if wait:
+                return wait, self.limited("requests", f"limit {self.rpm} requests / min", wait)
+        if tokens:
+            wait = self.state.take(self.tpm_key, tokens, self.tpm / 60, self.tpm)
+            if wait:
+                if self.rpm:
+                    self.state.take(self.rpm_key, -1, self.rpm / 60, self.rpm, force=True)
+                return wait, self.limited(
+                    "tokens", f"limit {self.tpm} tokens / min, requested {tokens}", wait
+                )
+        return 0.0, None
+
+    def refund(self, tokens: int):
+        if self.rpm:
+            self.state.take(self.rpm_key, -1, self.rpm / 60, self.rpm, force=True)
+        if tokens:
+            self.state.take(self.tpm_key, -tokens, self.tpm / 60, self.tpm, force=True)
+
+    def concurrency_limited(self):
+        # 不知道其他请求什么时候结束，建议1秒后重试
+        return self.limited("requests", f"limit {self.limiter.limit} concurrent requests", 1)
+
+    def admit(self, request: ChatCompletionRequest) -> int:
+        tokens = self.prompt_tokens(request)
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            wait, error = self.try_take(tokens)
+            if not wait:
+                break
+            if time.monotonic() + wait > deadline:
+                raise error
+            time.sleep(wait)
+        if self.limiter:
+            try:
+                self.limiter.acquire(max(0.0, deadline - time.monotonic()))
+            except ConcurrencyTimeout:
+                self.refund(tokens)
+                raise self.concurrency_limited()
+        return tokens
+
+    async def aadmit(self, request: ChatCompletionRequest) -> int:
+        tokens = self.prompt_tokens(request)
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            wait, error = await self._call(self.try_take, tokens)
+            if not wait:
+                break
+            if time.monotonic() + wait > deadline:
+                raise error
+            await asyncio.sleep(wait)
+        if self.limiter:
+            try:
+                await self.limiter.aacquire(max(0.0, deadline - time.monotonic()))
+            except ConcurrencyTimeout:
+                await self._call(self.refund, tokens)
+                raise self.concurrency_limited()
+        return tokens
+
+    def charge(self, tokens: int, usage):
+        """按上游返回的usage（stream为最后一个chunk的累积值）补扣tpm（估算偏小的部分和completion token）"""
+        if self.tpm and usage is not None:
+            extra = usage.completion_tokens
+            if usage.prompt_tokens:
+                extra += usage.prompt_tokens - tokens
+            if extra:
+                self.state.take(self.tpm_key, extra, self.tpm / 60, self.tpm, force=True)
+
+    def done(self, tokens: int, usage):
+        """释放并发名额并补扣tpm"""
+        if self.limiter:
+            self.limiter.release()
+        self.charge(tokens, usage)
+
+    async def adone(self, tokens: int, usage):
+        if self.limiter:
+            self.limiter.release()
+        if self.tpm and usage is not None:
+            await self._call(self.charge, tokens, usage)
+
+    async def _call(self, func, *args):
+        # 共享状态为sqlite时读写放到线程池，避免阻塞事件循环
+        if not self.state.blocking:
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    def chat_completions(
+        self, request: ChatCompletionRequest
+    ) -> Iterator[ChatCompletionResponse]:
+        tokens = self.admit(request)
+        usage = None
+        item = None
+        try:
+            for item in self.adapter.chat_completions(request):
+                usage = getattr(item, "usage", None) or usage
+                yield item
+        finally:
+            self.done(tokens, stream_usage(usage, item))
+
+    async def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[ChatCompletionResponse]:
+        tokens = await self.aadmit(request)
+        usage = None
+        item = None
+        resp = self.adapter.achat_completions(request)
+        try:
+            async for item in resp:
+                usage = getattr(item, "usage", None) or usage
+                yield item
+        finally:
+            try:
+                await resp.aclose()
+            finally:
+                await self.adone(tokens, stream_usage(usage, item))
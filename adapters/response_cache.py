@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Iterator, List, Optional, Union
+from adapters.base import ModelAdapter, WrapperAdapter
+from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
+from loguru import logger
+
+
+def request_cache_key(request: ChatCompletionRequest, token: str) -> str:
+    """对请求参数做规范化的json序列化后hash，加上token区分不同的上游配置"""
+    payload = json.dumps(
+        [token, request.model_dump(exclude_none=True)],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def dump_items(items: List[Union[ChatCompletionResponse, bytes]]) -> str:
+    return json.dumps(
+        [
+            {"raw": item.decode()}
+            if isinstance(item, bytes)
+            else item.model_dump(exclude_none=True)
+            for item in items
+        ],
+        ensure_ascii=False,
+    )
+
+
+def load_items(value: str) -> List[Union[ChatCompletionResponse, bytes]]:
+    return [
+        item["raw"].encode() if "raw" in item else ChatCompletionResponse(**item)
+        for item in json.loads(value)
+    ]
+
+
+class DiskCache:
+    """基于sqlite的磁盘缓存，多个token可以共用一个文件"""
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, expire_at REAL, value TEXT)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expire_at, value FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] < time.time():
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            return row
+
+    def set(self, key: str, expire_at: float, value: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, expire_at, value) VALUES (?, ?, ?)",
+                (key, expire_at, value),
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """
+    两级响应缓存：内存LRU（按条数和总字节数淘汰，带TTL），可选sqlite磁盘缓存
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = 600,
+        max_entries: int = 1000,
+        max_bytes: int = 64 * 1024 * 1024,
+        disk_path: str = None,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk = DiskCache(disk_path) if disk_path else None
+        self._entries: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[list]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expire_at, size, items = entry
+                if expire_at >= now:
+                    self._entries.move_to_end(key)
+                    return items
+                self._remove(key)
+        if self.disk is not None:
+            row = self.disk.get(key)
+            if row is not None:
+                expire_at, value = row
+                items = load_items(value)
+                self._put(key, expire_at, len(value), items)
+                return items
+        return None
+
+    def set(self, key: str, items: list):
+        expire_at = time.time() + self.ttl_seconds
+        value = dump_items(items)
+        self._put(key, expire_at, len(value), items)
+        if self.disk is not None:
+            self.disk.set(key, expire_at, value)
+
+    def _put(self, key: str, expire_at: float, size: int, items: list):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expire_at, size, items)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+class ResponseCacheAdapter(WrapperAdapter):
+    """
+    给token加上响应缓存，对应config中的cache：
+        "cache": {
+            "ttl_seconds": 600,
+            "max_entries": 1000,
+            "max_bytes": 67108864,
+            "disk_path": "response-cache.db",   // 可选，开启磁盘缓存
+            "only_deterministic": true          // 默认只缓存temperature为0的请求
+        }
+    stream请求命中时按原来的chunk重放，只有完整结束的响应才会写入缓存；非stream请求在返回结果之前写入
+    """
+
+    def __init__(self, adapter: ModelAdapter, token: str, **kwargs):
+        super().__init__(adapter)
+        self.token = token
+        self.only_deterministic = kwargs.pop("only_deterministic", True)
+        self.cache = ResponseCache(**kwargs)
+
+    def close(self):
+        if self.cache.disk is not None:
+            self.cache.disk.close()
+        super().close()
+
+    def cacheable(self, request: ChatCompletionRequest) -> bool:
+        return not self.only_deterministic or request.temperature == 0
+
+    def chat_completions(
+        self, request: ChatCompletionRequest
+    ) -> Iterator[ChatCompletionResponse]:
+        if not self.cacheable(request):
+            yield from self.adapter.chat_completions(request)
+            return
+        key = request_cache_key(request, self.token)
+        items = self.cache.get(key)
+        if items is not None:
+            logger.info(f"response cache hit: {key}")
+            yield from items
+            return
+        items = []
+        for item in self.adapter.chat_completions(request):
+            items.append(item)
+            if not request.stream:
+                # 非stream只有一个结果，调用方取到后直接关闭迭代器，需要在yield之前写入
+                self.cache.set(key, items)
+            yield item
+        if request.stream:
+            self.cache.set(key, items)
+
+    async def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[ChatCompletionResponse]:
+        resp = None
+        try:
+            if not self.cacheable(request):
+                resp = self.adapter.achat_completions(request)
+                async for item in resp:
+                    yield item
+                return
+            key = request_cache_key(request, self.token)
+            items = await self._call(self.cache.get, key)
+            if items is not None:
+                logger.info(f"response cache hit: {key}")
+                for item in items:
+                    yield item
+                return
+            items = []
+            resp = self.adapter.achat_completions(request)
+            async for item in resp:
+                items.append(item)
+                if not request.stream:
+                    await self._call(self.cache.set, key, items)
+                yield item
+            if request.stream:
+                await self._call(self.cache.set, key, items)
+        finally:
+            if resp is not None:
+                await resp.aclose()
+
+    async def _call(self, func, *args):
+        # 开启磁盘缓存时sqlite读写放到线程池，避免阻塞事件循环
+        if self.cache.disk is None:
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
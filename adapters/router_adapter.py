@@ -1,34 +1,217 @@
-from typing import Iterator
-from adapters.base import ModelAdapter
+import itertools
+import threading
+import time
+from typing import AsyncIterator, Iterator
+from adapters.base import ModelAdapter, is_final_item
+from adapters.failover import FailoverPolicy, failover_stream, afailover_stream
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
+from utils.util import config_token_hash, hash_fingerprint
 import random
+from utils.log import debug_enabled
 from loguru import logger
 
 
+class BackendStats:
+    """
+    单个token的滚动统计：首包延迟（TTFT）、总耗时和错误率的EWMA，以及进行中的请求数
+    """
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.ttft = None
+        self.total = None
+        self.error_rate = 0.0
+        self.inflight = 0
+        self.last_selected = 0.0
+        self._lock = threading.Lock()
+
+    def _ewma(self, old, value):
+        return value if old is None else old + self.alpha * (value - old)
+
+    def on_start(self):
+        with self._lock:
+            self.inflight += 1
+            self.last_selected = time.monotonic()
+
+    def on_first(self, ttft: float):
+        with self._lock:
+            self.ttft = self._ewma(self.ttft, ttft)
+
+    def on_success(self, total: float):
+        with self._lock:
+            self.total = self._ewma(self.total, total)
+            self.error_rate = self._ewma(self.error_rate, 0.0)
+
+    def on_error(self):
+        with self._lock:
+            self.error_rate = self._ewma(self.error_rate, 1.0)
+
+    def on_end(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def latency(self):
+        """首包延迟，没有首包数据时使用总耗时，都没有时返回None"""
+        return self.ttft if self.ttft is not None else self.total
+
+    def score(self, default_latency: float) -> float:
+        """
+        越小越好，default_latency为没有延迟数据时使用的值（候选中最大的延迟）：
+        总在首包之前失败的token不会有延迟数据，不能因此得到最低分
+        """
+        latency = self.latency()
+        if latency is None:
+            latency = default_latency
+        return latency * (1 + self.inflight) / (1 - min(self.error_rate, 0.99))
+
+    def __repr__(self):
+        return f"BackendStats(ttft={self.ttft}, total={self.total}, error_rate={self.error_rate:.2f}, inflight={self.inflight})"
+
+
 class RouterAdapter(ModelAdapter):
     def __init__(self, factory_method, **kwargs):
         super().__init__(**kwargs)
         self.router_strategy = kwargs.pop("router_strategy", None)
-        self.token_pool = kwargs.pop("token_pool", None)
+        # 配置加载时把token转换为sha256，和适配器表的key一致，不保存token原文
+        self.token_pool = [config_token_hash(t) for t in kwargs.pop("token_pool", None)]
         self.factory_method = factory_method
-        if self.router_strategy == "round-robin":
-            self.round_cnt = 0
+        # token的sha256 -> 下游实例，配置加载时由resolve_routes填充
+        self.adapters = {}
+        # 轮询计数在每个worker进程内独立，多worker时各自轮询，整体上仍然均匀分布；
+        # 不放到共享状态中，避免每个请求在事件循环上同步写sqlite
+        self.round_cnt = itertools.count()
+        # least-latency 策略：在健康的token中随机取两个，选择EWMA延迟更低的（power of two choices）
+        # 错误率超过max_error_rate的token视为不健康，每隔probe_interval_seconds放行一次请求探测是否恢复
+        ewma_alpha = kwargs.pop("ewma_alpha", 0.3)
+        self.max_error_rate = kwargs.pop("max_error_rate", 0.5)
+        self.probe_interval_seconds = kwargs.pop("probe_interval_seconds", 30)
+        self.stats = {token: BackendStats(ewma_alpha) for token in self.token_pool}
+        self.failover = FailoverPolicy(**kwargs.pop("failover", {}))
 
-    def chat_completions(
-        self, request: ChatCompletionRequest
-    ) -> Iterator[ChatCompletionResponse]:
+    def resolve_routes(self, adapters: dict):
+        self.adapters = {t: adapters[t] for t in self.token_pool if t in adapters}
+
+    def get_adapter(self, token):
+        adapter = self.adapters.get(token)
+        return adapter if adapter is not None else self.factory_method(token)
+
+    def is_healthy(self, token, now: float) -> bool:
+        stats = self.stats[token]
+        return (
+            stats.error_rate < self.max_error_rate
+            or now - stats.last_selected >= self.probe_interval_seconds
+        )
+
+    def select_least_latency(self, candidates):
+        now = time.monotonic()
+        healthy = [t for t in candidates if self.is_healthy(t, now)]
+        if healthy:
+            # 全部不健康时退化为在所有候选中选择
+            candidates = healthy
+        if len(candidates) == 1:
+            return candidates[0]
+        a, b = random.sample(candidates, 2)
+        latencies = [l for l in (self.stats[t].latency() for t in candidates) if l is not None]
+        default_latency = max(latencies, default=1.0)
+        return a if self.stats[a].score(default_latency) <= self.stats[b].score(default_latency) else b
+
+    def select_adapter(self, exclude=()):
+        """
+        选择一个token，exclude为失败转移时已经尝试过的token，全部尝试过时允许重复选择
+        """
         token = None
         adapter = None
+        candidates = [t for t in self.token_pool if t not in exclude] or self.token_pool
         if self.router_strategy == "round-robin":
-            index = self.round_cnt % len(self.token_pool)
-            self.round_cnt = self.round_cnt + 1
-            token = self.token_pool[index]
-            adapter = self.factory_method(token)
+            for _ in range(len(self.token_pool)):
+                index = next(self.round_cnt)
+                token = self.token_pool[index % len(self.token_pool)]
+                if token in candidates:
+                    break
+            adapter = self.get_adapter(token)
 
         elif self.router_strategy == "random":
-            token = random.sample(self.token_pool, 1)
-            adapter = self.factory_method(token)
+            token = random.choice(candidates)
+            adapter = self.get_adapter(token)
+        elif self.router_strategy == "least-latency":
+            token = self.select_least_latency(candidates)
+            adapter = self.get_adapter(token)
         else:
             raise ValueError("Unknown router strategy: {}".format(self.router_strategy))
-        logger.info(f"RouterAdapter select:token:{token}, adapter:{adapter}")
-        return adapter.chat_completions(request)
+        if debug_enabled():
+            logger.debug("RouterAdapter select:token:{}, adapter:{}", hash_fingerprint(token), adapter)
+        return token, adapter
+
+    def chat_completions(
+        self, request: ChatCompletionRequest
+    ) -> Iterator[ChatCompletionResponse]:
+        def open_stream(tried):
+            token, adapter = self.select_adapter(tried)
+            return token, self.track(
+                self.stats[token], adapter.chat_completions(request), request.stream
+            )
+
+        return failover_stream(self.failover, open_stream)
+
+    def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[ChatCompletionResponse]:
+        def open_stream(tried):
+            token, adapter = self.select_adapter(tried)
+            return token, self.atrack(
+                self.stats[token], adapter.achat_completions(request), request.stream
+            )
+
+        return afailover_stream(self.failover, open_stream)
+
+    def track(self, stats: BackendStats, resp: Iterator, stream: bool) -> Iterator:
+        """
+        记录上游的首包延迟、总耗时和错误，客户端提前断开不计入错误；
+        取到最后一个结果时即记录成功，非stream请求调用方取到结果后会直接关闭迭代器
+        """
+        stats.on_start()
+        start = time.monotonic()
+        first = True
+        succeeded = False
+        try:
+            for item in resp:
+                if first:
+                    stats.on_first(time.monotonic() - start)
+                    first = False
+                if not succeeded and is_final_item(item, stream):
+                    succeeded = True
+                    stats.on_success(time.monotonic() - start)
+                yield item
+            if not succeeded:
+                stats.on_success(time.monotonic() - start)
+        except Exception:
+            if not succeeded:
+                stats.on_error()
+            raise
+        finally:
+            stats.on_end()
+
+    async def atrack(self, stats: BackendStats, resp: AsyncIterator, stream: bool) -> AsyncIterator:
+        """track的异步版本"""
+        stats.on_start()
+        start = time.monotonic()
+        first = True
+        succeeded = False
+        try:
+            async for item in resp:
+                if first:
+                    stats.on_first(time.monotonic() - start)
+                    first = False
+                if not succeeded and is_final_item(item, stream):
+                    succeeded = True
+                    stats.on_success(time.monotonic() - start)
+                yield item
+            if not succeeded:
+                stats.on_success(time.monotonic() - start)
+        except Exception:
+            if not succeeded:
+                stats.on_error()
+            raise
+        finally:
+            stats.on_end()
+            await resp.aclose()
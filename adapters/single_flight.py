@@ -0,0 +1,119 @@
+import asyncio
+from typing import AsyncIterator, Dict, Iterator
+from adapters.base import ModelAdapter, UDFApiError, WrapperAdapter
+from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
+from adapters.response_cache import request_cache_key
+from loguru import logger
+
+
+class Flight:
+    """
+    一次进行中的上游请求，由单独的task消费上游并保存收到的chunk，
+    每个订阅者从头开始读取，各自得到完整的stream
+    为了让中途加入的请求也能得到完整的结果，items保存整个stream直到请求结束，
+    内存占用和一次非stream响应相同，请求结束后随flight一起释放
+    """
+
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task: asyncio.Task = None
+        self._changed = asyncio.Event()
+
+    def publish(self, item):
+        self.items.append(item)
+        self._notify()
+
+    def finish(self, error: BaseException = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self) -> AsyncIterator:
+        index = 0
+        while True:
+            if index < len(self.items):
+                item = self.items[index]
+                index += 1
+                yield item
+                continue
+            if self.done:
+                if isinstance(self.error, Exception):
+                    raise self.error
+                if self.error is not None:
+                    # 上游请求被取消（CancelledError等），不能传给订阅者，否则会绕过请求处理中的except Exception
+                    raise UDFApiError("coalesced upstream request was cancelled", 502)
+                return
+            await self._changed.wait()
+
+
+class SingleFlightAdapter(WrapperAdapter):
+    """
+    合并同一token下参数完全相同、同时在进行中的请求，对应config中的coalesce：
+        "coalesce": {"only_deterministic": true}    // 默认只合并temperature为0的请求
+    第一个请求访问上游，之后相同的请求订阅同一份结果；所有订阅者都断开时取消上游请求
+    只作用于异步接口，同步的chat_completions直接调用上游
+    """
+
+    def __init__(self, adapter: ModelAdapter, token: str, **kwargs):
+        super().__init__(adapter)
+        self.token = token
+        self.only_deterministic = kwargs.pop("only_deterministic", True)
+        self.flights: Dict[str, Flight] = {}
+
+    def chat_completions(
+        self, request: ChatCompletionRequest
+    ) -> Iterator[ChatCompletionResponse]:
+        return self.adapter.chat_completions(request)
+
+    async def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[ChatCompletionResponse]:
+        if self.only_deterministic and request.temperature != 0:
+            resp = self.adapter.achat_completions(request)
+            try:
+                async for item in resp:
+                    yield item
+            finally:
+                await resp.aclose()
+            return
+        key = request_cache_key(request, self.token)
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight()
+            self.flights[key] = flight
+            flight.task = asyncio.create_task(self._produce(key, flight, request))
+        else:
+            logger.info(f"single flight join: {key}, subscribers:{flight.subscribers}")
+        flight.subscribers += 1
+        try:
+            async for item in flight.subscribe():
+                yield item
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # 先移除，task执行到finally之前到达的相同请求会开始新的flight，而不是订阅被取消的这个
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                flight.task.cancel()
+
+    async def _produce(self, key: str, flight: Flight, request: ChatCompletionRequest):
+        resp = self.adapter.achat_completions(request)
+        try:
+            async for item in resp:
+                flight.publish(item)
+            flight.finish()
+        except BaseException as e:
+            flight.finish(e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            await resp.aclose()
@@ -1,31 +1,122 @@
-from typing import Iterator
-from adapters.base import ModelAdapter
+import json
+from typing import AsyncIterator, Iterator
+from urllib.parse import urlparse
+from adapters.base import (
+    ModelAdapter,
+    serverError,
+    stream,
+    post,
+    astream,
+    apost,
+    pop_http_options,
+)
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
-from volcengine.maas import MaasService
+from volcengine.Credentials import Credentials
+from volcengine.auth.SignerV4 import SignerV4
+from volcengine.base.Request import Request
+from utils.sse_client import iter_sse_data, aiter_sse_data
+from utils.util import UsageCounter
+from utils.log import debug_enabled, truncate
+from loguru import logger
 
 
 class SkylarkAdapter(ModelAdapter):
+    """
+    火山方舟（MaaS）的云雀模型，直接用SignerV4签名后通过共享的http连接池请求，
+    不再经过MaasService的requests session，stream下同步和异步接口都不需要额外的线程
+    """
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.model = kwargs.pop("model")
-        self.config_args = kwargs
-        self.maas = MaasService('maas-api.ml-platform-cn-beijing.volces.com', 'cn-beijing')
+        self.api_base = kwargs.pop(
+            "api_base", "https://maas-api.ml-platform-cn-beijing.volces.com/api/v1/"
+        )
+        region = kwargs.pop("region", "cn-beijing")
         api_key = kwargs.pop("api_key")
         ak, sk = api_key.split(":")
-        self.maas.set_ak(ak)
-        self.maas.set_sk(sk)
+        self.credentials = Credentials(ak, sk, "ml_maas", region)
+        self.http_options = pop_http_options(kwargs)
+        self.config_args = kwargs
 
     def chat_completions(self, request: ChatCompletionRequest) -> Iterator[ChatCompletionResponse]:
-        data = self.openai_req_2_sl_req(request)
+        url, headers, data = self.build_request(request)
         if request.stream:
-            resps = self.maas.stream_chat(data)
-            index = 0
-            for resp in resps:
-                yield ChatCompletionResponse(**self.sl_resp_2_openai_resp_stream(resp, index))
-                index += 1
+            response = stream(url, headers, data, http_options=self.http_options)
+            try:
+                usage_counter = UsageCounter(self.model)
+                for index, line in enumerate(iter_sse_data(response.iter_bytes())):
+                    resp = self.parse_stream_data(line)
+                    if resp is StopIteration:
+                        break
+                    if resp:
+                        yield ChatCompletionResponse(
+                            **self.sl_resp_2_openai_resp_stream(resp, index, usage_counter)
+                        )
+            finally:
+                response.close()
         else:
-            resp = self.maas.chat(data)
-            yield ChatCompletionResponse(**self.sl_resp_2_openai_resp(resp))
+            resp = post(url, headers, data, http_options=self.http_options)
+            yield ChatCompletionResponse(**self.sl_resp_2_openai_resp(check_error(resp)))
+
+    async def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[ChatCompletionResponse]:
+        url, headers, data = self.build_request(request)
+        if request.stream:
+            response = await astream(url, headers, data, http_options=self.http_options)
+            try:
+                usage_counter = UsageCounter(self.model)
+                index = 0
+                async for line in aiter_sse_data(response.aiter_bytes()):
+                    resp = self.parse_stream_data(line)
+                    if resp is StopIteration:
+                        break
+                    if resp:
+                        yield ChatCompletionResponse(
+                            **self.sl_resp_2_openai_resp_stream(resp, index, usage_counter)
+                        )
+                    index += 1
+            finally:
+                await response.aclose()
+        else:
+            resp = await apost(url, headers, data, http_options=self.http_options)
+            yield ChatCompletionResponse(**self.sl_resp_2_openai_resp(check_error(resp)))
+
+    def build_request(self, request: ChatCompletionRequest):
+        url = f"{self.api_base}chat"
+        data = self.openai_req_2_sl_req(request)
+        if debug_enabled():
+            logger.debug("SkylarkAdapter url: {}, data: {}", url, truncate(data))
+        return url, self.sign(url, data), data
+
+    def sign(self, url: str, data: dict) -> dict:
+        """
+        对请求体签名，base中post、stream发送的请求体都是json.dumps(data)（见json_headers），签名的内容必须与之一致
+        """
+        parsed = urlparse(url)
+        r = Request()
+        r.set_shema(parsed.scheme)
+        r.set_method("POST")
+        r.set_host(parsed.netloc)
+        r.set_path(parsed.path)
+        r.set_headers(
+            {
+                "Accept": "application/json",
+                "Content-Type": "application/json",
+                "Host": parsed.netloc,
+            }
+        )
+        r.set_body(json.dumps(data).encode("utf-8"))
+        SignerV4.sign(r, self.credentials)
+        return dict(r.headers)
+
+    def parse_stream_data(self, data: bytes):
+        if data == b"[DONE]":
+            return StopIteration
+        if data:
+            return check_error(json.loads(data))
+        return None
 
     def sl_resp_2_openai_resp(self, response: dict) -> dict:
         id = response["req_id"]
@@ -38,17 +129,34 @@ class SkylarkAdapter(ModelAdapter):
             id=id,
             prompt_tokens=prompt_tokens,
             completion_tokens=completion_tokens,
+            finish_reason=response["choice"].get("finish_reason") or "stop",
         )
 
-    def sl_resp_2_openai_resp_stream(self, response: dict, index: int) -> dict:
+    def sl_resp_2_openai_resp_stream(
+        self, response: dict, index: int, usage_counter: UsageCounter = None
+    ) -> dict:
+        """
+        最后一块带有usage时直接使用上游统计的token数，否则由usage_counter计算
+        """
         id = response["req_id"]
-        content = response["choice"]["message"]["content"]
+        choice = response["choice"]
+        content = choice["message"]["content"]
+        usage = response.get("usage")
+        finish_reason = choice.get("finish_reason") or (
+            "stop" if not content or usage else None
+        )
+        kwargs = {}
+        if finish_reason and usage:
+            kwargs["prompt_tokens"] = usage["prompt_tokens"]
+            kwargs["completion_tokens"] = usage["completion_tokens"]
         return self.completion_to_openai_stream_response(
             content,
             self.model,
             index,
-            finish_reason="stop" if not content else None,
+            finish_reason=finish_reason,
             id=id,
+            usage_counter=usage_counter,
+            **kwargs,
         )
 
     def openai_req_2_sl_req(self, request: ChatCompletionRequest) -> dict:
@@ -62,6 +170,17 @@ class SkylarkAdapter(ModelAdapter):
             },
             "messages": [
                 m.model_dump(exclude_none=True) for m in request.messages
-            ]
+            ],
+            "stream": request.stream,
         }
         return req
+
+
+def check_error(response: dict) -> dict:
+    """MaaS在响应体（stream下为单个事件）的error中返回业务错误"""
+    error = response.get("error")
+    if error and error.get("code_n", 0) != 0:
+        raise serverError(
+            f"{error.get('code')}: {error.get('message')}, req_id:{response.get('req_id')}"
+        )
+    return response
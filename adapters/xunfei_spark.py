@@ -1,13 +1,22 @@
-import json
-from typing import Iterator
-from adapters.base import ModelAdapter
+import asyncio
+from typing import AsyncIterator, Iterator
+from websockets.exceptions import WebSocketException
+from adapters.base import ModelAdapter, UDFApiError, rate_limit_error
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
+from utils.log import is_sampled, truncate
 from loguru import logger
 from clients.xunfei_spark.api.spark_api import SparkAPI
+from utils.limiter import ConcurrencyTimeout
 import time
 import uuid
 
 
+def connection_error(e: Exception):
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError)):
+        return UDFApiError(f"spark timeout: {e}", 504)
+    return UDFApiError(f"spark connection error: {e}", 502)
+
+
 class XunfeiSparkAPIModel(ModelAdapter):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -18,15 +27,67 @@ class XunfeiSparkAPIModel(ModelAdapter):
         self.prompt = kwargs.pop(
             "prompt", "You need to follow the system settings:{system}"
         )
+        # 连接相关的配置，不作为请求参数
+        connection_args = {
+            k: kwargs.pop(k)
+            for k in ("api_base", "max_concurrency", "queue_timeout", "open_timeout", "recv_timeout")
+            if k in kwargs
+        }
         self.config_args = kwargs
         self.api_connection = SparkAPI(
-            self.app_id, self.api_key, self.api_secret, self.api_model_version
+            self.app_id,
+            self.api_key,
+            self.api_secret,
+            self.api_model_version,
+            **connection_args,
         )
 
     def chat_completions(
         self, request: ChatCompletionRequest
     ) -> Iterator[ChatCompletionResponse]:
         messages = self.openai_to_client_params(request)
+        iter_content = self.api_connection.get_resp_from_messages(
+            messages, **self.query_kwargs(request)
+        )
+        try:
+            if request.stream:
+                for line in iter_content:
+                    yield self.stream_response(line)
+            else:
+                yield ChatCompletionResponse(
+                    **self.client_response_to_chatgpt_response(iter_content)
+                )
+        except ConcurrencyTimeout as e:
+            raise rate_limit_error(f"星火并发数已达上限: {e}")
+        except (WebSocketException, OSError, TimeoutError) as e:
+            raise connection_error(e)
+        finally:
+            iter_content.close()
+
+    async def achat_completions(
+        self, request: ChatCompletionRequest
+    ) -> AsyncIterator[ChatCompletionResponse]:
+        messages = self.openai_to_client_params(request)
+        iter_content = self.api_connection.aget_resp_from_messages(
+            messages, **self.query_kwargs(request)
+        )
+        try:
+            if request.stream:
+                async for line in iter_content:
+                    yield self.stream_response(line)
+            else:
+                lines = [line async for line in iter_content]
+                yield ChatCompletionResponse(
+                    **self.client_response_to_chatgpt_response(lines)
+                )
+        except ConcurrencyTimeout as e:
+            raise rate_limit_error(f"星火并发数已达上限: {e}")
+        except (WebSocketException, OSError, asyncio.TimeoutError) as e:
+            raise connection_error(e)
+        finally:
+            await iter_content.aclose()
+
+    def query_kwargs(self, request: ChatCompletionRequest) -> dict:
         kargs = {
             "chat_id": uuid.uuid1(),
         }
@@ -37,19 +98,15 @@ class XunfeiSparkAPIModel(ModelAdapter):
             kargs["max_tokens"] = request.max_length
 
         kargs.update(self.config_args)
-        iter_content = self.api_connection.get_resp_from_messages(messages, **kargs)
+        return kargs
 
-        if request.stream:
-            for line in iter_content:
-                code = line["header"]["code"]
-                if code != 0:
-                    logger.error(f"请求失败:{line}")
-                    raise Exception(f"请求失败:{line}")
-                openai_response = self.client_response_2_chatgpt_response_stream(line)
-                yield ChatCompletionResponse(**openai_response)
-        else:
-            openai_response = self.client_response_to_chatgpt_response(iter_content)
-            yield ChatCompletionResponse(**openai_response)
+    def stream_response(self, line) -> ChatCompletionResponse:
+        code = line["header"]["code"]
+        if code != 0:
+            logger.error(f"请求失败:{line}")
+            raise Exception(f"请求失败:{line}")
+        openai_response = self.client_response_2_chatgpt_response_stream(line)
+        return ChatCompletionResponse(**openai_response)
 
     def openai_to_client_params(self, openai_params: ChatCompletionRequest):
         prompt = []
@@ -105,7 +162,8 @@ class XunfeiSparkAPIModel(ModelAdapter):
             content = resp_json["payload"]["choices"]["text"][0]["content"]
             completions.append(content)
             id = resp_json["header"]["sid"]
-            logger.info(f"resp_json: {resp_json}")
+            if is_sampled():
+                logger.debug("resp_json: {}", truncate(resp_json))
             if resp_json["payload"]["choices"]["status"] == 2:
                 usage = resp_json["payload"]["usage"]["text"]
                 prompt_tokens = usage["prompt_tokens"]
@@ -115,7 +173,7 @@ class XunfeiSparkAPIModel(ModelAdapter):
         return self.completion_to_openai_response(
             content,
             prompt_tokens=prompt_tokens,
-            completion_toke=completion_tokens,
+            completion_tokens=completion_tokens,
             total_tokens=total_tokens,
             id=id,
         )
@@ -1,12 +1,13 @@
 from typing import Dict, Iterator, List
-from adapters.base import ModelAdapter, post, stream
+from adapters.base import ModelAdapter, post, stream, pop_http_options
 from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse, ChatMessage
 import time
 
 import cachetools.func
 import jwt
+from utils.log import debug_enabled, is_sampled, truncate
 from loguru import logger
-from utils.util import num_tokens_from_string
+from utils.util import UsageCounter
 
 from utils.sse_client import SSEClient
 
@@ -54,6 +55,8 @@ class ZhiPuApiModel(ModelAdapter):
         self.prompt = kwargs.pop(
             "prompt", "You need to follow the system settings:{system}"
         )
+        self.api_base = kwargs.pop("api_base", "https://open.bigmodel.cn/api/paas/v3/")
+        self.http_options = pop_http_options(kwargs)
         self.config_args = kwargs
 
     def chat_completions(
@@ -66,22 +69,30 @@ class ZhiPuApiModel(ModelAdapter):
         # 发起post请求
         model = self.model if self.model else request.model
         invoke_method = "sse-invoke" if request.stream else "invoke"
-        url = f"https://open.bigmodel.cn/api/paas/v3/model-api/{model}/{invoke_method}"
+        url = f"{self.api_base}model-api/{model}/{invoke_method}"
         token = generate_token(self.api_key)
         params = self.convert_params(request)
         if request.stream:
-            data = stream(url, {"Authorization": token}, params)
-            event_data = SSEClient(data)
-            for event in event_data.events():
-                logger.debug(f"chat_completions event: {event}")
-                yield ChatCompletionResponse(
-                    **self.convert_response_stream(event, model)
-                )
+            data = stream(
+                url, {"Authorization": token}, params, http_options=self.http_options
+            )
+            event_data = SSEClient(data.iter_bytes())
+            usage_counter = UsageCounter(model)
+            try:
+                for event in event_data.events():
+                    if is_sampled():
+                        logger.debug("chat_completions event: {}", truncate(event))
+                    yield ChatCompletionResponse(
+                        **self.convert_response_stream(event, model, usage_counter)
+                    )
+            finally:
+                data.close()
         else:
             global headers
             headers.update({"Authorization": token})
-            data = post(url, headers, params)
-            logger.debug(f"chat_completions data: {data}")
+            data = post(url, headers, params, http_options=self.http_options)
+            if debug_enabled():
+                logger.debug("chat_completions data: {}", truncate(data))
             yield ChatCompletionResponse(**self.convert_response(data, model))
 
     def convert_response(self, resp, model):
@@ -98,7 +109,9 @@ class ZhiPuApiModel(ModelAdapter):
             completion_tokens=completion_tokens,
         )
 
-    def convert_response_stream(self, event_data, model):
+    def convert_response_stream(
+        self, event_data, model, usage_counter: UsageCounter = None
+    ):
         completion = event_data.data
         finish_reason = "stop" if event_data.event == "finish" else None
         return self.completion_to_openai_stream_response(
@@ -106,6 +119,7 @@ class ZhiPuApiModel(ModelAdapter):
             model,
             finish_reason=finish_reason,
             id=f"chatcmpl-{event_data.id}",
+            usage_counter=usage_counter,
         )
 
     def convert_params(self, request: ChatCompletionRequest) -> Dict:
@@ -1,18 +1,62 @@
 import json
 import os
+import queue
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
 import requests as req
 from curl_cffi import requests
-import re
 from loguru import logger
+from adapters.base import UDFApiError
+from utils.sse_client import Event, SSEDecoder
 
 # 参考 https://github.com/KoushikNavuluri/Claude-API
 
+# 每个session执行流式请求的线程数，同一个cookie同时进行的请求超过后排队
+stream_workers = 4
+
+_sessions: Dict[str, Tuple[requests.Session, ThreadPoolExecutor]] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(cookie, proxies: dict = None) -> Tuple[requests.Session, ThreadPoolExecutor]:
+    """
+    同一个cookie（和代理）共用一个模拟浏览器的session，以及执行流式请求的固定线程池：
+    curl_cffi的session每个线程使用各自的curl handle，请求固定在这几个长期存在的线程上执行，
+    handle和其中的keep-alive连接才能被后续请求复用
+    """
+    key = json.dumps([cookie, proxies], sort_keys=True)
+    with _sessions_lock:
+        entry = _sessions.get(key)
+        if entry is None:
+            entry = (
+                requests.Session(impersonate="chrome110", proxies=proxies),
+                ThreadPoolExecutor(stream_workers, thread_name_prefix="claude-web"),
+            )
+            _sessions[key] = entry
+        return entry
+
+
+class _StreamClosed(Exception):
+    """调用方提前结束时由content_callback抛出，用来中断curl的传输"""
+
+
+def _completions(events: List[Event]) -> Iterator[str]:
+    for event in events:
+        try:
+            data = json.loads(event.data)
+        except json.JSONDecodeError:
+            raise UDFApiError(f"invalid claude web event: {event.data[:200]}", 502)
+        if "completion" in data:
+            yield data["completion"]
+
 
 class ClaudeWebClient:
     def __init__(self, cookie, proxies: dict):
         self.cookie = cookie
         self.proxies = proxies
+        self.session, self.executor = get_session(cookie, proxies)
         self.organization_id = self.get_organization_id()
 
     def get_organization_id(self):
@@ -31,8 +75,7 @@ class ClaudeWebClient:
             'Cookie': f'{self.cookie}'
         }
 
-        response = requests.get(url, headers=headers,
-                                impersonate="chrome110", proxies=self.proxies)
+        response = self.session.get(url, headers=headers)
         logger.debug(response.status_code, response.text)
         res = json.loads(response.text)
         uuid = res[0]['uuid']
@@ -69,8 +112,7 @@ class ClaudeWebClient:
             'Cookie': f'{self.cookie}'
         }
 
-        response = requests.get(url, headers=headers,
-                                impersonate="chrome110", proxies=self.proxies)
+        response = self.session.get(url, headers=headers)
         conversations = response.json()
 
         # Returns all conversation information in a list
@@ -81,6 +123,19 @@ class ClaudeWebClient:
 
     # Send Message to Claude
     def send_message(self, prompt, conversation_id, attachment=None, timeout=500):
+        return "".join(
+            self.send_message_stream(prompt, conversation_id, attachment, timeout)
+        )
+
+    def send_message_stream(
+        self, prompt, conversation_id, attachment=None, timeout=500
+    ) -> Iterator[str]:
+        """
+        边接收边解析append_message返回的事件流，逐块返回completion
+        curl_cffi 0.5.9没有stream参数，请求在session的线程池中执行，收到的数据通过content_callback
+        放入队列；调用方提前结束后，回调在收到下一块数据时抛出_StreamClosed中断传输，释放线程。
+        curl_cffi不使用回调的返回值，只能通过异常中断，cffi会把这个异常作为unraisable打印一次
+        """
         url = "https://claude.ai/api/append_message"
 
         # Upload attachment if provided
@@ -90,7 +145,7 @@ class ClaudeWebClient:
             if attachment_response:
                 attachments = [attachment_response]
             else:
-                return {"Error: Invalid file format. Please try again."}
+                raise UDFApiError("Invalid file format. Please try again.", 400)
 
         # Ensure attachments is an empty list when no attachment is provided
         if not attachment:
@@ -125,22 +180,47 @@ class ClaudeWebClient:
             'TE': 'trailers'
         }
 
-        response = requests.post(
-            url, headers=headers, data=payload, impersonate="chrome110", timeout=500, proxies=self.proxies)
-        decoded_data = response.content.decode("utf-8")
-        decoded_data = re.sub('\n+', '\n', decoded_data).strip()
-        data_strings = decoded_data.split('\n')
-        completions = []
-        for data_string in data_strings:
-            json_str = data_string[6:].strip()
-            data = json.loads(json_str)
-            if 'completion' in data:
-                completions.append(data['completion'])
-
-        answer = ''.join(completions)
-
-        # Returns answer
-        return answer
+        chunks = queue.Queue()
+        closed = threading.Event()
+
+        def on_content(chunk):
+            if closed.is_set():
+                raise _StreamClosed("claude web stream closed by client, abort transfer")
+            chunks.put(chunk)
+
+        def perform():
+            try:
+                response = self.session.post(
+                    url,
+                    headers=headers,
+                    data=payload,
+                    timeout=timeout,
+                    content_callback=on_content,
+                )
+                chunks.put(response)
+            except Exception as e:
+                chunks.put(e)
+
+        self.executor.submit(perform)
+        decoder = SSEDecoder()
+        # 非200时返回的不是事件流，保留开头的内容用于报错
+        head = b""
+        try:
+            while True:
+                item = chunks.get()
+                if isinstance(item, bytes):
+                    if len(head) < 4096:
+                        head += item
+                    yield from _completions(decoder.feed(item))
+                    continue
+                if isinstance(item, Exception):
+                    raise UDFApiError(f"claude web request failed: {item}", 502)
+                if item.status_code != 200:
+                    raise UDFApiError(head.decode("utf-8", "replace"), item.status_code)
+                yield from _completions(decoder.flush())
+                return
+        finally:
+            closed.set()
 
     # Deletes the conversation
     def delete_conversation(self, conversation_id):
@@ -163,8 +243,7 @@ class ClaudeWebClient:
             'TE': 'trailers'
         }
 
-        response = requests.delete(
-            url, headers=headers, data=payload, impersonate="chrome110", proxies=self.proxies)
+        response = self.session.delete(url, headers=headers, data=payload)
 
         # Returns True if deleted or False if any error in deleting
         if response.status_code == 204:
@@ -189,8 +268,7 @@ class ClaudeWebClient:
             'Cookie': f'{self.cookie}'
         }
 
-        response = requests.get(url, headers=headers,
-                                impersonate="chrome110", proxies=self.proxies)
+        response = self.session.get(url, headers=headers)
 
         # List all the conversations in JSON
         return response.json()
@@ -222,8 +300,7 @@ class ClaudeWebClient:
             'TE': 'trailers'
         }
 
-        response = requests.post(url, headers=headers,
-                                 data=payload, impersonate="chrome110", proxies=self.proxies)
+        response = self.session.post(url, headers=headers, data=payload)
 
         # Returns JSON of the newly created conversation information
         return response.json()
@@ -307,8 +384,7 @@ class ClaudeWebClient:
             'TE': 'trailers'
         }
 
-        response = requests.post(url, headers=headers,
-                                 data=payload, impersonate="chrome110", proxies=self.proxies)
+        response = self.session.post(url, headers=headers, data=payload)
 
         if response.status_code == 200:
             return True
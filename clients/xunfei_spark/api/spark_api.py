@@ -1,6 +1,10 @@
+import asyncio
 import json
-from typing import List
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterator, List
 from websockets.sync.client import connect as ws_connect
+from websockets.client import connect as aws_connect
 import hmac
 import base64
 import hashlib
@@ -8,8 +12,10 @@ import textwrap
 from urllib.parse import urlencode, urlparse
 from datetime import datetime
 from email.utils import formatdate
+from utils.log import debug_enabled, is_sampled, truncate
 from loguru import logger
 import uuid
+from utils.limiter import ConcurrencyLimiter
 
 
 #  https://www.xfyun.cn/doc/spark/Web.html#_1-%E6%8E%A5%E5%8F%A3%E8%AF%B4%E6%98%8E
@@ -88,19 +94,81 @@ def get_wss_url(api_url, api_secret, api_key):
     return url
 
 
+# 鉴权url中的date与服务端时间相差超过300秒会被拒绝，签名在有效期内缓存复用，默认60秒
+sign_ttl_seconds = 60
+_signed_urls: Dict[tuple, tuple] = {}
+_signed_urls_lock = threading.Lock()
+
+
+def get_cached_wss_url(api_url, api_secret, api_key, ttl=sign_ttl_seconds):
+    key = (api_url, api_key, api_secret)
+    now = time.monotonic()
+    cached = _signed_urls.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    url = get_wss_url(api_url, api_secret, api_key)
+    with _signed_urls_lock:
+        _signed_urls[key] = (now + ttl, url)
+    return url
+
+
+# 星火的并发额度按app_id计算，同一个app_id的所有配置共享一个限制
+_limiters: Dict[str, ConcurrencyLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_app_limiter(app_id: str, max_concurrency: int) -> ConcurrencyLimiter:
+    with _limiters_lock:
+        limiter = _limiters.get(app_id)
+        if limiter is None:
+            limiter = ConcurrencyLimiter(max_concurrency)
+            _limiters[app_id] = limiter
+        elif limiter.limit != max_concurrency:
+            logger.warning(
+                f"spark app_id:{app_id} max_concurrency conflict, use {limiter.limit}"
+            )
+        return limiter
+
+
 class SparkAPI(object):
+    """
+    星火的websocket连接每次只能回答一个问题，服务端返回status为2的结果后就会断开，
+    所以不复用连接，而是缓存签名url、确定性地关闭连接，并按app_id限制并发
+    """
+
     def __init__(
-        self, app_id: str, api_key: str, api_secret: str, api_model: str, **kwargs
+        self,
+        app_id: str,
+        api_key: str,
+        api_secret: str,
+        api_model: str,
+        api_base: str = None,
+        max_concurrency: int = None,
+        queue_timeout: float = 60,
+        open_timeout: float = 10,
+        recv_timeout: float = 300,
+        **kwargs,
     ):
         self.app_id = app_id
         self.api_key = api_key
         self.api_secret = api_secret
         self.api_model = api_model
+        self.api_base = api_base
+        self.queue_timeout = queue_timeout
+        self.open_timeout = open_timeout
+        self.recv_timeout = recv_timeout
+        self.limiter = (
+            get_app_limiter(app_id, max_concurrency) if max_concurrency else None
+        )
 
-    def create_wss_connection(self):
+    def wss_url(self):
         api_url = MODEL_MAP[self.api_model]["url"]
-        wss_url = get_wss_url(api_url, self.api_secret, self.api_key)
-        return ws_connect(wss_url)
+        if self.api_base:
+            api_url = self.api_base.rstrip("/") + urlparse(api_url).path
+        return get_cached_wss_url(api_url, self.api_secret, self.api_key)
+
+    def create_wss_connection(self):
+        return ws_connect(self.wss_url(), open_timeout=self.open_timeout)
 
     def build_query(self, messages, **kwargs):
         query = {
@@ -124,20 +192,56 @@ class SparkAPI(object):
         messages = [{"role": "user", "content": prompt}]
         return self.get_completion_from_messages(messages, **kwargs)
 
-    def get_resp_from_messages(self, messages: List[dict], **kwargs):
-        wss = self.create_wss_connection()
+    def get_resp_from_messages(self, messages: List[dict], **kwargs) -> Iterator[dict]:
+        query = self.build_query(messages, **kwargs)
+        if debug_enabled():
+            logger.debug("query: {}", truncate(query))
+        if self.limiter:
+            self.limiter.acquire(self.queue_timeout)
+        try:
+            with self.create_wss_connection() as wss:
+                wss.send(query)
+                cnt = 1
+                while True:
+                    res = json.loads(wss.recv(self.recv_timeout))
+                    if is_sampled():
+                        logger.debug("cnt:{}, res:{}", cnt, truncate(res))
+                    yield res
+                    cnt += 1
+                    if res["header"]["status"] == 2 or res["header"]["code"] != 0:
+                        break
+        finally:
+            if self.limiter:
+                self.limiter.release()
 
+    async def aget_resp_from_messages(
+        self, messages: List[dict], **kwargs
+    ) -> AsyncIterator[dict]:
+        """get_resp_from_messages的异步版本，等待上游时不占用线程"""
         query = self.build_query(messages, **kwargs)
-        logger.info(f"query: {query}")
-        wss.send(query)
-        cnt = 1
-        while True:
-            res = json.loads(wss.recv())
-            logger.info(f"cnt:{cnt}, res:{res}")
-            yield res
-            cnt += 1
-            if res["header"]["status"] == 2:
-                break
+        if debug_enabled():
+            logger.debug("query: {}", truncate(query))
+        if self.limiter:
+            await self.limiter.aacquire(self.queue_timeout)
+        try:
+            async with aws_connect(
+                self.wss_url(), open_timeout=self.open_timeout
+            ) as wss:
+                await wss.send(query)
+                cnt = 1
+                while True:
+                    res = json.loads(
+                        await asyncio.wait_for(wss.recv(), self.recv_timeout)
+                    )
+                    if is_sampled():
+                        logger.debug("cnt:{}, res:{}", cnt, truncate(res))
+                    yield res
+                    cnt += 1
+                    if res["header"]["status"] == 2 or res["header"]["code"] != 0:
+                        break
+        finally:
+            if self.limiter:
+                self.limiter.release()
 
     def get_completion_from_messages(self, messages: List[dict], **kwargs):
         """
@@ -1,9 +1,14 @@
+import asyncio
+import hashlib
 import json
-from typing import Dict, List
+import threading
+from typing import List
 
 from pydantic import BaseModel
 from loguru import logger
-from adapters.adapter_factory import init_adapter, clear_adapters
+from adapters.adapter_factory import swap_adapters
+from utils.shared_state import get_shared_state
+from utils.util import config_token_hash, hash_fingerprint
 import os
 
 class ModelConfig(BaseModel):
@@ -12,42 +17,65 @@ class ModelConfig(BaseModel):
     config: dict
 
 
-token_2_modelconfig: Dict[str, ModelConfig] = dict()
-config_path = "model-config.json"
+config_path = os.getenv("MODEL-CONFIG-PATH", "model-config.json")
 if not os.path.exists(config_path):
     config_path = "model-config-default.json"
 
+# 配置版本号保存在共享状态中，任意worker更新配置后加一，其他worker发现版本变化后重新加载配置文件
+config_version_key = "config_version"
+loaded_config_version = None
+# 已加载的配置文件内容的hash，文件变化但内容相同时（比如自己写入的）不重复加载
+loaded_config_hash = None
+_reload_lock = threading.Lock()
 
-def load_model_config():
-    with open(config_path) as f:
-        data = json.load(f)
-        for config in data:
-            model_config = ModelConfig(
-                token=config.get("token"),
-                type=config.get("type"),
-                config=config.get("config"),
-            )
-            token_2_modelconfig[config.get("token")] = model_config
-    init_all_adapter()
-    logger.info(
-        f"load model config from {config_path}, token_2_modelconfig:{token_2_modelconfig}"
-    )
+
+def parse_model_config(raw: bytes) -> List[ModelConfig]:
+    return [
+        ModelConfig(
+            token=config.get("token"),
+            type=config.get("type"),
+            config=config.get("config"),
+        )
+        for config in json.loads(raw)
+    ]
 
 
-def init_all_adapter():
-    clear_adapters()
-    for token, config in token_2_modelconfig.items():
-        init_adapter(token, config.type, **config.config)
+def read_config_file() -> List[ModelConfig]:
+    with open(config_path, "rb") as f:
+        return parse_model_config(f.read())
 
 
-def get_model_config(token):
-    return token_2_modelconfig.get(token, None)
+def load_model_config():
+    """
+    读取配置文件，在旧的适配器表旁边构建新的，然后一次性替换，期间的请求仍然使用旧的适配器
+    适配器表以token的sha256为key，加载完成后内存中不再保留token原文
+    """
+    global loaded_config_version, loaded_config_hash
+    with _reload_lock:
+        version = get_shared_state().get(config_version_key, 0)
+        with open(config_path, "rb") as f:
+            raw = f.read()
+        configs = {config_token_hash(c.token): c for c in parse_model_config(raw)}
+        swap_adapters(configs)
+        loaded_config_version = version
+        loaded_config_hash = hashlib.sha256(raw).hexdigest()
+    # 配置中包含token和上游的api_key，日志中只输出token的fingerprint和类型
+    logger.info(
+        f"load model config from {config_path}, tokens:{[(hash_fingerprint(k), c.type) for k, c in configs.items()]}"
+    )
 
 
 def get_all_model_config():
-    return [
-        config.model_dump(exclude_none=True) for config in token_2_modelconfig.values()
-    ]
+    """管理页面使用，从配置文件中读取"""
+    return [config.model_dump(exclude_none=True) for config in read_config_file()]
+
+
+def write_config_file(configs: List[ModelConfig]):
+    """先写临时文件再替换，其他进程和文件监听不会读到写了一半的配置"""
+    tmp_path = f"{config_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump([config.model_dump() for config in configs], f)
+    os.replace(tmp_path, config_path)
 
 
 def update_model_config(config: List[ModelConfig]):
@@ -56,17 +84,60 @@ def update_model_config(config: List[ModelConfig]):
     :param json_str:
     :return:
     """
+    state = get_shared_state()
+    # 和配置文件的当前内容合并，其他worker已经写入的修改不会被覆盖
+    token_2_modelconfig = {config_token_hash(c.token): c for c in read_config_file()}
     for config in config:
-        token = config.token
-        token_2_modelconfig[token] = config
-    with open(config_path, "w") as f:
-        json.dump([config.model_dump() for config in token_2_modelconfig.values()], f)
+        token_2_modelconfig[config_token_hash(config.token)] = config
+    write_config_file(list(token_2_modelconfig.values()))
     logger.info(f"update model config to {config_path}")
+    state.incr(config_version_key)
     load_model_config()
 
 
+def config_file_changed() -> bool:
+    with open(config_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest() != loaded_config_hash
+
+
+async def watch_config_file():
+    """
+    监听配置文件，内容变化时在线程池中重新加载，对应环境变量 CONFIG-WATCH
+    监听所在目录而不是文件本身，文件被替换（os.replace、编辑器保存）后仍然有效
+    """
+    from watchfiles import awatch
+
+    path = os.path.abspath(config_path)
+    loop = asyncio.get_running_loop()
+    async for _ in awatch(
+        os.path.dirname(path), watch_filter=lambda _, changed: changed == path
+    ):
+        try:
+            if await loop.run_in_executor(None, config_file_changed):
+                logger.info(f"config file changed: {config_path}")
+                await loop.run_in_executor(None, load_model_config)
+        except Exception as e:
+            logger.exception(f"reload model config failed: {e}")
+
+
+async def watch_config_version(interval_seconds: float = 1):
+    """
+    多worker部署时在每个worker中运行，定期检查共享的配置版本号，变化时在线程池中重新加载配置
+    """
+    state = get_shared_state()
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            # sqlite查询是阻塞的，和重新加载一样放到线程池中
+            version = await loop.run_in_executor(None, state.get, config_version_key, 0)
+            if version != loaded_config_version:
+                logger.info(f"config version changed: {loaded_config_version} -> {version}")
+                await loop.run_in_executor(None, load_model_config)
+        except Exception as e:
+            logger.exception(f"reload model config failed: {e}")
+
+
 if __name__ == "__main__":
     load_model_config()
-    print(get_model_config("123"))
     print(get_all_model_config())
-    print(get_model_config("GxqT3BlbkFJj"))
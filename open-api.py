@@ -1,27 +1,60 @@
+import asyncio
+import hmac
+import tempfile
 import uuid
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, JSONResponse, HTMLResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from fastapi.routing import APIRouter
 from pydantic import BaseModel
-from adapters.base import ModelAdapter, UDFApiError, serverError
-from adapters.protocol import ChatCompletionRequest, ChatCompletionResponse
-from typing import Iterator, List, Optional
-from adapters.adapter_factory import get_adapter
+from adapters.base import UDFApiError, serverError
+from adapters.metrics_adapter import error_status
+from adapters.protocol import (
+    ChatCompletionRequest,
+    ChatCompletionResponse,
+    StreamChunkEncoder,
+)
+from typing import AsyncIterator, List, Optional, Union
+from adapters.adapter_factory import (
+    AdapterGeneration,
+    Route,
+    current_generation,
+    resolve_route,
+)
 from loguru import logger
+from utils.admission import (
+    AdmissionScheduler,
+    AdmissionTimeout,
+    get_admission_scheduler,
+    request_priority,
+)
+from utils.log import debug_enabled, sample_request, setup_logging, truncate
+from utils.metrics import (
+    RequestObserver,
+    flush_metrics,
+    gateway_metrics,
+    metrics_dir_env,
+    render_metrics,
+)
 from config import (
     ModelConfig,
-    get_model_config,
     load_model_config,
     get_all_model_config,
     update_model_config,
+    watch_config_file,
+    watch_config_version,
 )
+from utils.shared_state import shared_state_path_env
+from utils.util import token_fingerprint
 import os
 from fastapi.staticfiles import StaticFiles
 
 router = APIRouter()
-admin_token = uuid.uuid1()
+admin_token = str(uuid.uuid1())
+# 配置后访问/metrics需要带上 Authorization: Bearer <token>
+metrics_token = os.getenv("METRICS-TOKEN")
 
 
 def create_app():
@@ -37,18 +70,28 @@ def create_app():
     return app
 
 
-def check_api_key(
+def check_metrics_token(
+    auth: Optional[HTTPAuthorizationCredentials] = Depends(
+        HTTPBearer(auto_error=False)
+    ),
+):
+    if not metrics_token:
+        return
+    if auth and hmac.compare_digest(auth.credentials.encode(), metrics_token.encode()):
+        return
+    raise HTTPException(status_code=401, detail="invalid metrics token")
+
+
+async def check_api_key(
     auth: Optional[HTTPAuthorizationCredentials] = Depends(
         HTTPBearer(auto_error=False)
     ),
 ):
-    logger.info(f"auth: {auth}")
     if auth and auth.credentials:
-        token = auth.credentials
-        adaptor = get_adapter_by_token(token)
-        if adaptor is not None:
-            return adaptor
-        logger.warning(f"invalid api key,{token}")
+        route = resolve_route(auth.credentials)
+        if route is not None:
+            return route
+        logger.warning(f"invalid api key,{token_fingerprint(auth.credentials)}")
     raise HTTPException(
         status_code=401,
         detail={
@@ -67,12 +110,11 @@ def check_admin_token(
         HTTPBearer(auto_error=False)
     ),
 ):
-    logger.info(f"auth: {auth}")
     if auth and auth.credentials:
         token = auth.credentials
-        if token == admin_token:
+        if hmac.compare_digest(token.encode(), admin_token.encode()):
             return
-        logger.warning(f"invalid admin token,{token}")
+        logger.warning(f"invalid admin token,{token_fingerprint(token)}")
     raise HTTPException(
         status_code=401,
         detail={
@@ -86,41 +128,130 @@ def check_admin_token(
     )
 
 
-def convert(first_resp: ChatCompletionResponse, resp: Iterator[ChatCompletionResponse]):
-    yield f"data: {first_resp.model_dump_json(exclude_none=True)}\n\n"
-    yield from (
-        f"data: {response.model_dump_json(exclude_none=True)}\n\n" for response in resp
-    )
-    yield "data: [DONE]\n\n"
+def sse_data(
+    response: Union[ChatCompletionResponse, bytes], encoder: StreamChunkEncoder
+):
+    # 透传模式下适配器直接返回组装好的sse帧
+    if isinstance(response, bytes):
+        return response
+    return encoder.encode(response)
+
+
+class RequestResources:
+    """
+    一个请求占用的配置版本、准入名额和上游迭代器，release只执行一次
+    stream请求由convert的finally和StreamingResponse的background共同调用：
+    客户端在开始迭代之前断开时convert不会执行，由background释放，不需要等到垃圾回收
+    """
+
+    __slots__ = ("generation", "observer", "admission", "resp", "released")
 
+    def __init__(self, generation: AdapterGeneration, observer: RequestObserver):
+        self.generation = generation
+        self.observer = observer
+        self.admission: Optional[AdmissionScheduler] = None
+        self.resp: Optional[AsyncIterator] = None
+        self.released = False
 
-def get_adapter_by_token(token: str):
-    model_config = get_model_config(token)
-    if model_config is not None:
-        return get_adapter(model_config.token)
+    async def release(self, status: int = 499):
+        """status为请求的最终状态，前面没有记录时（请求被取消、客户端断开）为499"""
+        if self.released:
+            return
+        self.released = True
+        self.observer.finish(status)
+        self.generation.release()
+        if self.admission:
+            self.admission.release()
+        if self.resp is not None:
+            await self.resp.aclose()
+
+
+async def convert(
+    first_resp: Union[ChatCompletionResponse, bytes],
+    resp: AsyncIterator[Union[ChatCompletionResponse, bytes]],
+    resources: RequestResources,
+):
+    status = 200
+    try:
+        encoder = StreamChunkEncoder()
+        yield sse_data(first_resp, encoder)
+        async for response in resp:
+            resources.observer.on_item(response)
+            yield sse_data(response, encoder)
+        yield "data: [DONE]\n\n"
+    except BaseException as e:
+        status = error_status(e)
+        raise
+    finally:
+        await resources.release(status)
 
 
 @router.post("/v1/chat/completions")
-def create_chat_completion(
-    request: ChatCompletionRequest, model: ModelAdapter = Depends(check_api_key)
+async def create_chat_completion(
+    request: ChatCompletionRequest,
+    route: Route = Depends(check_api_key),
+    x_priority: Optional[str] = Header(None),
+    x_request_timeout: Optional[float] = Header(None),
 ):
-    logger.info(f"request: {request},  model: {model}")
+    model = route.adapter
+    sample_request()
+    logger.info("request: model={}, stream={}, route={}", request.model, request.stream, route)
+    if debug_enabled():
+        logger.debug("request body: {}", truncate(request))
+    observer = gateway_metrics.observe(route.fingerprint, route.type, request.stream)
+    # 记录进行中的请求，配置重新加载后旧的适配器等这些请求结束再关闭
+    resources = RequestResources(current_generation().acquire(), observer)
+    streaming = False
     try:
-        resp = model.chat_completions(request)
+        scheduler = get_admission_scheduler()
+        if scheduler:
+            # 客户端的超时时间和token配置的排队超时取较小的
+            timeouts = [t for t in (x_request_timeout, route.queue_timeout) if t is not None]
+            await scheduler.acquire(
+                route.fingerprint,
+                request_priority(route.priority, x_priority),
+                route.weight,
+                min(timeouts) if timeouts else None,
+            )
+            resources.admission = scheduler
+        resp = resources.resp = model.achat_completions(request)
         if request.stream:
             # 为了让生成器中的异常，在这里被捕获，StreamingResponse中会吞掉异常
-            first_respose = next(resp)
+            first_respose = await anext(resp)
+            observer.on_item(first_respose)
+            streaming = True
             return StreamingResponse(
-                convert(first_respose, resp), media_type="text/event-stream"
+                convert(first_respose, resp, resources),
+                media_type="text/event-stream",
+                background=BackgroundTask(resources.release),
             )
         else:
-            openai_response = next(resp)
+            openai_response = await anext(resp)
+            await resp.aclose()
+            observer.on_item(openai_response)
+            observer.finish(200)
             return JSONResponse(content=openai_response.model_dump(exclude_none=True))
+    except AdmissionTimeout as e:
+        observer.finish(503)
+        return JSONResponse(content=str(e), status_code=503)
     except UDFApiError as ue:
-        return JSONResponse(content=ue._message, status_code=ue.http_status)
+        observer.finish(ue.http_status)
+        return JSONResponse(content=ue.content(), status_code=ue.http_status, headers=ue.headers)
     except Exception as e:
         logger.exception(e)
+        observer.finish(500)
         return JSONResponse(content=str(e), status_code=500)
+    finally:
+        if not streaming:
+            # 请求被取消（客户端断开）时前面都没有记录，记为499
+            await resources.release()
+
+
+@router.get("/metrics")
+def metrics(token=Depends(check_metrics_token)):
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 @router.get("/verify")
@@ -149,18 +280,73 @@ def update_config(request: List[ModelConfig], token=Depends(check_admin_token)):
     return {"success": True}
 
 
-def run(port=8090, log_level="info", prefix=""):
-    import uvicorn
-
+def build_app(prefix=""):
     app = create_app()
     app.include_router(router, prefix=prefix)
     app.mount("/static", StaticFiles(directory="dist"), name="static")
-    uvicorn.run(app, host="0.0.0.0", port=port, log_level=log_level)
 
+    if os.getenv("CONFIG-WATCH", "").lower() in ("1", "true"):
 
-if __name__ == "__main__":
+        @app.on_event("startup")
+        async def start_config_file_watcher():
+            app.state.config_file_watcher = asyncio.create_task(watch_config_file())
+
+    return app
+
+
+def create_worker_app():
+    """
+    多worker模式下每个worker进程调用，各自加载配置，并监听其他worker的配置更新
+    admin token、共享状态文件等由主进程通过环境变量传入
+    """
+    global admin_token
+    admin_token = os.environ["ADMIN-TOKEN"]
+    setup_logging()
     load_model_config()
+    app = build_app(os.getenv("API-PREFIX", ""))
+
+    @app.on_event("startup")
+    async def start_config_watcher():
+        interval = float(os.getenv("CONFIG-POLL-SECONDS", "1"))
+        app.state.config_watcher = asyncio.create_task(watch_config_version(interval))
+        app.state.metrics_flusher = asyncio.create_task(
+            flush_metrics(float(os.getenv("METRICS-FLUSH-SECONDS", "5")))
+        )
+
+    return app
+
+
+def run(port=8090, log_level="info", prefix="", workers=1):
+    import uvicorn
+
+    setup_logging()
+    if workers > 1:
+        # 所有worker共享同一个admin token和状态文件
+        os.environ["ADMIN-TOKEN"] = admin_token
+        os.environ["API-PREFIX"] = prefix
+        os.environ.setdefault(
+            shared_state_path_env,
+            os.path.join(tempfile.gettempdir(), f"openai-style-api-{port}.db"),
+        )
+        os.environ.setdefault(
+            metrics_dir_env,
+            os.path.join(tempfile.gettempdir(), f"openai-style-api-{port}-metrics"),
+        )
+        uvicorn.run(
+            "open-api:create_worker_app",
+            factory=True,
+            host="0.0.0.0",
+            port=port,
+            log_level=log_level,
+            workers=workers,
+        )
+    else:
+        load_model_config()
+        uvicorn.run(build_app(prefix), host="0.0.0.0", port=port, log_level=log_level)
+
+
+if __name__ == "__main__":
     env_token = os.getenv("ADMIN-TOKEN")
     if env_token:
         admin_token = env_token
-    run()
+    run(port=int(os.getenv("PORT", "8090")), workers=int(os.getenv("WORKERS", "1")))
@@ -0,0 +1,79 @@
+"""
+stream chunk编码的微基准：对比 model_dump_json 和 StreamChunkEncoder 每个chunk的耗时（都包含适配器组装dict和pydantic校验），
+运行前先校验两种方式输出的sse帧完全一致
+
+    python tests/bench_chunk.py --chunks 100000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from adapters.base import ModelAdapter  # noqa: E402
+from adapters.protocol import (  # noqa: E402
+    ChatCompletionResponse,
+    StreamChunkEncoder,
+)
+
+adapter = ModelAdapter()
+contents = ["你好", " hello", ' "quoted"\n', "tab\there\\", "\x00\x1f控制字符", "emoji 😀", ""]
+
+
+def build(i: int, n: int) -> dict:
+    last = i == n - 1
+    kwargs = {"prompt_tokens": 12, "completion_tokens": n} if last else {}
+    return adapter.completion_to_openai_stream_response(
+        "" if last else contents[i % len(contents)],
+        "gpt-3.5-turbo",
+        id="chatcmpl-bench",
+        created=1700000000,
+        finish_reason="stop" if last else None,
+        **kwargs,
+    )
+
+
+def legacy(data: dict) -> str:
+    response = ChatCompletionResponse(**data)
+    return f"data: {response.model_dump_json(exclude_none=True)}\n\n"
+
+
+def encoded(encoder: StreamChunkEncoder, data: dict) -> str:
+    return encoder.encode(ChatCompletionResponse(**data))
+
+
+def check(n: int):
+    encoder = StreamChunkEncoder()
+    for i in range(n):
+        data = build(i, n)
+        expected = legacy(data)
+        assert encoded(encoder, data) == expected, expected
+    # 多个choice时退回model_dump_json
+    data = build(0, n)
+    data["choices"] = data["choices"] * 2
+    assert encoded(encoder, data) == legacy(data)
+
+
+def timed(name: str, func, n: int):
+    start = time.perf_counter()
+    for i in range(n):
+        func(build(i, n))
+    elapsed = time.perf_counter() - start
+    print(f"  {name:<28} {elapsed / n * 1e6:7.2f}us/chunk  {n / elapsed:10.0f} chunks/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=100000)
+    args = parser.parse_args()
+    check(100)
+    encoder = StreamChunkEncoder()
+    print(f"{args.chunks} chunks, including building the dict:")
+    timed("baseline (build dict only)", lambda data: data, args.chunks)
+    timed("validate + model_dump_json", legacy, args.chunks)
+    timed("validate + StreamChunkEncoder", lambda data: encoded(encoder, data), args.chunks)
+
+
+if __name__ == "__main__":
+    main()
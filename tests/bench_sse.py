@@ -0,0 +1,105 @@
+"""
+sse解析的微基准：对比旧的按行拼接bytes的实现和增量的SSEDecoder，输入为几MB的stream
+
+    python tests/bench_sse.py --size-mb 4 --chunk-size 64
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.sse_client import iter_sse_data, iter_sse_events  # noqa: E402
+
+
+def legacy_read(chunks):
+    """旧版SSEClient._read，每一行都拼接到bytes上"""
+    data = b""
+    for chunk in chunks:
+        for line in chunk.splitlines(True):
+            data += line
+            if data.endswith((b"\r\r", b"\n\n", b"\r\n\r\n")):
+                yield data
+                data = b""
+    if data:
+        yield data
+
+
+def legacy_events(chunks):
+    """旧版SSEClient.events，按行解码并通过__dict__设置字段"""
+    for chunk in legacy_read(chunks):
+        event = {"id": None, "event": "", "data": "", "retry": None, "meta": {}}
+        for line in chunk.splitlines():
+            line = line.decode("utf-8")
+            if not line.strip() or line.startswith(":"):
+                continue
+            data = line.split(":", 1)
+            field = data[0]
+            if field not in event:
+                continue
+            value = data[1][1:] if len(data) > 1 and data[1].startswith(" ") else (data[1] if len(data) > 1 else "")
+            if field == "data":
+                event[field] += value + "\n"
+            else:
+                event[field] = value
+        if not event["data"]:
+            continue
+        yield event
+
+
+def many_events_stream(size: int) -> bytes:
+    """大量小事件，类似openai的stream"""
+    frame = (
+        "data: "
+        + json.dumps(
+            {
+                "id": "chatcmpl-xxx",
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {"content": "你好 hello"}}],
+            },
+            ensure_ascii=False,
+        )
+        + "\n\n"
+    ).encode()
+    return frame * (size // len(frame) + 1)
+
+
+def large_event_stream(size: int) -> bytes:
+    """单个很大的多行事件，旧实现在这种情况下是平方复杂度"""
+    line = b"data: " + b"x" * 58 + b"\n"
+    return line * (size // len(line) + 1) + b"\n"
+
+
+def split(data: bytes, chunk_size: int):
+    return [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def timed(name, func, chunks):
+    start = time.perf_counter()
+    count = sum(1 for _ in func(chunks))
+    elapsed = time.perf_counter() - start
+    size = sum(len(c) for c in chunks)
+    print(f"  {name:<16} {elapsed * 1000:9.1f}ms  {size / elapsed / 1024 / 1024:8.1f}MB/s  items:{count}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--chunk-size", type=int, default=64)
+    args = parser.parse_args()
+    size = int(args.size_mb * 1024 * 1024)
+    for name, data in (
+        ("many small events", many_events_stream(size)),
+        ("one large event", large_event_stream(size)),
+    ):
+        chunks = split(data, args.chunk_size)
+        print(f"{name}: {len(data) / 1024 / 1024:.1f}MB in {len(chunks)} chunks")
+        timed("legacy events", legacy_events, chunks)
+        timed("iter_sse_events", iter_sse_events, chunks)
+        timed("iter_sse_data", iter_sse_data, chunks)
+
+
+if __name__ == "__main__":
+    main()
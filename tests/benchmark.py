@@ -0,0 +1,254 @@
+"""
+端到端压测：并发请求网关的 /v1/chat/completions，统计吞吐、首包延迟（TTFT）、token间隔和总耗时的分位数
+
+压测已经启动的网关：
+    python tests/benchmark.py --url http://127.0.0.1:8090 --token xxx --concurrency 50 --requests 1000 --stream
+
+--spawn 指定上游类型时，自动启动 mock_upstream.py 和网关，使用临时生成的model-config.json，不依赖任何外部服务：
+    python tests/benchmark.py --spawn proxy --concurrency 100 --requests 2000 --stream
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+bench_token = "bench-token"
+
+
+def mock_model_config(upstream_type: str, mock_url: str) -> list:
+    """各类型指向mock上游的配置"""
+    configs = {
+        "openai": {"api_base": f"{mock_url}/v1/", "api_key": "sk-mock", "model": "gpt-3.5-turbo"},
+        "proxy": {"api_base": f"{mock_url}/v1/", "api_key": "sk-mock", "model": "gpt-3.5-turbo"},
+        "proxy-passthrough": {
+            "api_base": f"{mock_url}/v1/",
+            "api_key": "sk-mock",
+            "model": "gpt-3.5-turbo",
+            "passthrough": True,
+        },
+        "azure": {
+            "api_base": f"{mock_url}/",
+            "deployment_id": "gpt-35-turbo",
+            "api_version": "2023-05-15",
+            "api_key": "mock",
+        },
+        "claude": {"api_base": f"{mock_url}/v1/", "api_key": "mock", "model": "claude-2"},
+        "qwen": {"api_base": f"{mock_url}/api/v1/", "api_key": "mock", "model": "qwen-turbo"},
+        "zhipu-api": {
+            "api_base": f"{mock_url}/api/paas/v3/",
+            "api_key": "mock.secret",
+            "model": "chatglm_lite",
+        },
+        "gemini": {"api_base": f"{mock_url}/v1beta/", "api_key": "mock"},
+        "skylark": {"api_base": f"{mock_url}/api/v1/", "api_key": "ak:sk", "model": "skylark-chat"},
+        "xunfei-spark-api": {
+            "api_base": mock_url.replace("http", "ws", 1) + "/",
+            "app_id": "mock",
+            "api_key": "mock",
+            "api_secret": "mock",
+            "api_model_version": "v2.0",
+        },
+    }
+    adapter_type = "proxy" if upstream_type == "proxy-passthrough" else upstream_type
+    return [{"token": bench_token, "type": adapter_type, "config": configs[upstream_type]}]
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Result:
+    def __init__(self):
+        self.ok = True
+        self.status = 200
+        self.ttft = None
+        self.total = None
+        self.inter_token = []
+
+
+async def one_request(client: httpx.AsyncClient, url: str, token: str, stream: bool) -> Result:
+    result = Result()
+    body = {
+        "model": "gpt-3.5-turbo",
+        "messages": [{"role": "user", "content": "Hello!"}],
+        "stream": stream,
+    }
+    headers = {"Authorization": f"Bearer {token}"}
+    start = time.perf_counter()
+    try:
+        if not stream:
+            resp = await client.post(url, json=body, headers=headers)
+            result.status = resp.status_code
+            result.ok = resp.status_code == 200
+            result.ttft = result.total = time.perf_counter() - start
+            return result
+        async with client.stream("POST", url, json=body, headers=headers) as resp:
+            result.status = resp.status_code
+            if resp.status_code != 200:
+                await resp.aread()
+                result.ok = False
+                return result
+            last = None
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                now = time.perf_counter()
+                if line[5:].strip() == "[DONE]":
+                    break
+                if last is None:
+                    result.ttft = now - start
+                else:
+                    result.inter_token.append(now - last)
+                last = now
+        result.total = time.perf_counter() - start
+    except httpx.HTTPError:
+        result.ok = False
+        result.status = 0
+    return result
+
+
+async def run_benchmark(url: str, token: str, concurrency: int, requests: int, stream: bool):
+    endpoint = url.rstrip("/") + "/v1/chat/completions"
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    results = []
+    counter = iter(range(requests))
+
+    async def worker(client):
+        for _ in counter:
+            results.append(await one_request(client, endpoint, token, stream))
+
+    async with httpx.AsyncClient(limits=limits, timeout=300) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    report(results, elapsed)
+    return results
+
+
+def report(results, elapsed: float):
+    ok = [r for r in results if r.ok]
+    errors = {}
+    for r in results:
+        if not r.ok:
+            errors[r.status] = errors.get(r.status, 0) + 1
+    ttft = [r.ttft for r in ok if r.ttft is not None]
+    total = [r.total for r in ok if r.total is not None]
+    inter_token = [t for r in ok for t in r.inter_token]
+    print(f"requests: {len(results)}, ok: {len(ok)}, errors: {errors}, elapsed: {elapsed:.2f}s")
+    print(f"throughput: {len(ok) / elapsed:.1f} req/s")
+    for name, values in (("ttft", ttft), ("inter-token", inter_token), ("total", total)):
+        if not values:
+            continue
+        print(
+            f"{name:<12} p50 {percentile(values, 50) * 1000:8.1f}ms"
+            f"  p90 {percentile(values, 90) * 1000:8.1f}ms"
+            f"  p99 {percentile(values, 99) * 1000:8.1f}ms"
+            f"  max {max(values) * 1000:8.1f}ms"
+        )
+
+
+def wait_for_port(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"port {port} not ready")
+
+
+def spawn(args):
+    """启动mock上游和网关，返回子进程列表和网关地址"""
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump(mock_model_config(args.spawn, mock_url), config_file)
+    config_file.close()
+    mock = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(repo_dir, "tests", "mock_upstream.py"),
+            "--port", str(args.mock_port),
+            "--ttft", str(args.ttft),
+            "--tokens", str(args.tokens),
+            "--token-rate", str(args.token_rate),
+            "--error-rate", str(args.error_rate),
+        ]
+    )
+    env = dict(os.environ, PORT=str(args.gateway_port))
+    env["MODEL-CONFIG-PATH"] = config_file.name
+    gateway = subprocess.Popen(
+        [sys.executable, "open-api.py"],
+        cwd=repo_dir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    processes = [mock, gateway]
+    try:
+        wait_for_port(args.mock_port)
+        wait_for_port(args.gateway_port)
+    except Exception:
+        stop(processes)
+        raise
+    return processes, f"http://127.0.0.1:{args.gateway_port}", config_file.name
+
+
+def stop(processes):
+    for p in processes:
+        p.terminate()
+    for p in processes:
+        try:
+            p.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="openai-style-api benchmark")
+    parser.add_argument("--url", default="http://127.0.0.1:8090")
+    parser.add_argument("--token", default=bench_token)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument(
+        "--spawn",
+        choices=["openai", "proxy", "proxy-passthrough", "azure", "claude", "qwen", "zhipu-api", "gemini", "skylark", "xunfei-spark-api"],
+        help="启动mock上游和网关后再压测",
+    )
+    parser.add_argument("--mock-port", type=int, default=18090)
+    parser.add_argument("--gateway-port", type=int, default=18091)
+    parser.add_argument("--ttft", type=float, default=0.05)
+    parser.add_argument("--tokens", type=int, default=32)
+    parser.add_argument("--token-rate", type=float, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    processes = []
+    url = args.url
+    config_path = None
+    if args.spawn:
+        processes, url, config_path = spawn(args)
+    try:
+        asyncio.run(
+            run_benchmark(url, args.token, args.concurrency, args.requests, args.stream)
+        )
+    finally:
+        stop(processes)
+        if config_path:
+            os.unlink(config_path)
+
+
+if __name__ == "__main__":
+    main()
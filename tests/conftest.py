@@ -0,0 +1,56 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(tests_dir)
+sys.path.insert(0, repo_dir)
+sys.path.insert(0, tests_dir)
+
+import mock_upstream
+from benchmark import wait_for_port
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="session")
+def mock_url():
+    """在后台线程启动mock上游，整个测试过程共用"""
+    port = free_port()
+    server = mock_upstream.start_in_thread(port)
+    yield f"http://127.0.0.1:{port}"
+    server.should_exit = True
+
+
+@pytest.fixture
+def gateway(tmp_path):
+    """按给定的model-config启动网关子进程，返回网关地址"""
+    processes = []
+
+    def start(configs: list, **env) -> str:
+        config_path = tmp_path / "model-config.json"
+        config_path.write_text(json.dumps(configs))
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, "open-api.py"],
+            cwd=repo_dir,
+            env=dict(os.environ, PORT=str(port), **{"MODEL-CONFIG-PATH": str(config_path)}, **env),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        processes.append(process)
+        wait_for_port(port)
+        return f"http://127.0.0.1:{port}"
+
+    yield start
+    for process in processes:
+        process.terminate()
+        process.wait(timeout=10)
@@ -0,0 +1,477 @@
+"""
+本地mock上游，模拟 openai、azure、claude、通义千问、智谱、gemini、火山方舟 的接口和sse格式，以及讯飞星火的websocket接口，
+可配置首包延迟、token速率和错误注入，用于端到端测试和压测，不依赖任何外部服务
+
+    python tests/mock_upstream.py --port 18090 --ttft 0.2 --tokens 64 --token-rate 50 --error-rate 0.01
+
+对应的model-config.json中把各类型的 api_base 指向 http://127.0.0.1:18090/ 下的路径，参考 benchmark.py 中的 mock_model_config
+请求头 x-mock-ttft、x-mock-tokens、x-mock-token-rate、x-mock-error-rate、x-mock-error-status 可以覆盖单次请求的配置
+GET /mock/stats 返回收到的请求数
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request, WebSocket
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+class MockConfig:
+    def __init__(self):
+        self.ttft = 0.05  # 首包延迟，秒
+        self.tokens = 32  # 每个响应的token数
+        self.token_rate = 200  # 每秒生成的token数，0表示不限速
+        self.error_rate = 0.0  # 按概率返回错误
+        self.error_status = 500
+        self.requests = 0  # 收到的请求数，测试中用来检查缓存、合并等是否减少了上游调用
+
+
+mock_config = MockConfig()
+app = FastAPI()
+
+
+@app.get("/mock/stats")
+async def mock_stats():
+    return {"requests": mock_config.requests}
+
+
+class Behavior:
+    """单次请求的行为，默认取mock_config，可以被请求头覆盖"""
+
+    def __init__(self, request):
+        mock_config.requests += 1
+        headers = request.headers
+        self.ttft = float(headers.get("x-mock-ttft", mock_config.ttft))
+        self.tokens = int(headers.get("x-mock-tokens", mock_config.tokens))
+        self.token_rate = float(headers.get("x-mock-token-rate", mock_config.token_rate))
+        self.error_rate = float(headers.get("x-mock-error-rate", mock_config.error_rate))
+        self.error_status = int(
+            headers.get("x-mock-error-status", mock_config.error_status)
+        )
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def words(self):
+        return [f"tok{i} " for i in range(self.tokens)]
+
+    async def tokens_paced(self):
+        """按token速率逐个返回token"""
+        await asyncio.sleep(self.ttft)
+        interval = 1 / self.token_rate if self.token_rate > 0 else 0
+        for word in self.words():
+            yield word
+            if interval:
+                await asyncio.sleep(interval)
+
+    async def full_text(self) -> str:
+        await asyncio.sleep(self.ttft)
+        if self.token_rate > 0:
+            await asyncio.sleep(self.tokens / self.token_rate)
+        return "".join(self.words())
+
+
+def error_response(behavior: Behavior):
+    return JSONResponse(
+        status_code=behavior.error_status,
+        content={
+            "error": {
+                "message": "mock upstream error",
+                "type": "server_error",
+                "param": None,
+                "code": "mock_error",
+            }
+        },
+    )
+
+
+def sse(gen):
+    return StreamingResponse(gen, media_type="text/event-stream")
+
+
+def prompt_tokens_of(body: dict) -> int:
+    return len(json.dumps(body, ensure_ascii=False)) // 4
+
+
+# ---------------- openai / azure ----------------
+
+
+async def openai_completions(request: Request):
+    behavior = Behavior(request)
+    body = await request.json()
+    if behavior.should_fail():
+        return error_response(behavior)
+    model = body.get("model", "gpt-3.5-turbo")
+    id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    prompt_tokens = prompt_tokens_of(body)
+    if not body.get("stream"):
+        return {
+            "id": id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": await behavior.full_text()},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": behavior.tokens,
+                "total_tokens": prompt_tokens + behavior.tokens,
+            },
+        }
+
+    def chunk(delta, finish_reason=None):
+        return "data: " + json.dumps(
+            {
+                "id": id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+        ) + "\n\n"
+
+    async def gen():
+        first = True
+        async for word in behavior.tokens_paced():
+            delta = {"content": word}
+            if first:
+                delta["role"] = "assistant"
+                first = False
+            yield chunk(delta)
+        yield chunk({}, "stop")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield "data: " + json.dumps(
+                {
+                    "id": id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": behavior.tokens,
+                        "total_tokens": prompt_tokens + behavior.tokens,
+                    },
+                }
+            ) + "\n\n"
+        yield "data: [DONE]\n\n"
+
+    return sse(gen())
+
+
+@app.post("/v1/chat/completions")
+async def openai_chat(request: Request):
+    return await openai_completions(request)
+
+
+@app.post("/openai/deployments/{deployment_id}/chat/completions")
+async def azure_chat(deployment_id: str, request: Request):
+    return await openai_completions(request)
+
+
+# ---------------- claude ----------------
+
+
+@app.post("/v1/complete")
+async def claude_complete(request: Request):
+    behavior = Behavior(request)
+    body = await request.json()
+    if behavior.should_fail():
+        return error_response(behavior)
+    model = body.get("model") or "claude-2"
+    if not body.get("stream"):
+        return {
+            "type": "completion",
+            "completion": await behavior.full_text(),
+            "stop_reason": "stop_sequence",
+            "model": model,
+        }
+
+    def event(completion, stop_reason=None):
+        data = {
+            "type": "completion",
+            "completion": completion,
+            "stop_reason": stop_reason,
+            "model": model,
+        }
+        return f"event: completion\ndata: {json.dumps(data)}\n\n"
+
+    async def gen():
+        async for word in behavior.tokens_paced():
+            yield event(word)
+        yield event("", "stop_sequence")
+
+    return sse(gen())
+
+
+# ---------------- 通义千问 ----------------
+
+
+@app.post("/api/v1/services/aigc/text-generation/generation")
+async def qwen_generation(request: Request):
+    behavior = Behavior(request)
+    body = await request.json()
+    request_id = uuid.uuid4().hex
+    input_tokens = prompt_tokens_of(body)
+    incremental = body.get("parameters", {}).get("incremental_output", False)
+    stream = request.headers.get("x-dashscope-sse") == "enable"
+    if behavior.should_fail():
+        if stream:
+
+            async def error_gen():
+                error = {"code": "InternalError", "message": "mock upstream error", "request_id": request_id}
+                yield f"id:1\nevent:error\n:HTTP_STATUS/{behavior.error_status}\ndata:{json.dumps(error)}\n\n"
+
+            return sse(error_gen())
+        return error_response(behavior)
+
+    def output(content, finish_reason, output_tokens):
+        return {
+            "output": {
+                "choices": [
+                    {
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": finish_reason,
+                    }
+                ]
+            },
+            "usage": {
+                "total_tokens": input_tokens + output_tokens,
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+            },
+            "request_id": request_id,
+        }
+
+    if not stream:
+        return output(await behavior.full_text(), "stop", behavior.tokens)
+
+    async def gen():
+        # 默认每个事件返回累积的全部内容，incremental_output为true时只返回增量
+        content = ""
+        index = 0
+        async for word in behavior.tokens_paced():
+            index += 1
+            content += word
+            data = output(word if incremental else content, "null", index)
+            yield f"id:{index}\nevent:result\n:HTTP_STATUS/200\ndata:{json.dumps(data, ensure_ascii=False)}\n\n"
+        data = output("" if incremental else content, "stop", index)
+        yield f"id:{index + 1}\nevent:result\n:HTTP_STATUS/200\ndata:{json.dumps(data, ensure_ascii=False)}\n\n"
+
+    return sse(gen())
+
+
+# ---------------- 智谱 ----------------
+
+
+@app.post("/api/paas/v3/model-api/{model}/{invoke_method}")
+async def zhipu_invoke(model: str, invoke_method: str, request: Request):
+    behavior = Behavior(request)
+    body = await request.json()
+    if behavior.should_fail():
+        return error_response(behavior)
+    request_id = uuid.uuid4().hex
+    prompt_tokens = prompt_tokens_of(body)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": behavior.tokens,
+        "total_tokens": prompt_tokens + behavior.tokens,
+    }
+    if invoke_method == "invoke":
+        return {
+            "code": 200,
+            "msg": "操作成功",
+            "success": True,
+            "data": {
+                "request_id": request_id,
+                "task_id": request_id,
+                "task_status": "SUCCESS",
+                "choices": [{"role": "assistant", "content": await behavior.full_text()}],
+                "usage": usage,
+            },
+        }
+
+    async def gen():
+        async for word in behavior.tokens_paced():
+            yield f"event:add\nid:{request_id}\ndata:{word}\n\n"
+        meta = {"task_status": "SUCCESS", "usage": usage, "task_id": request_id, "request_id": request_id}
+        yield f"event:finish\nid:{request_id}\ndata:\nmeta:{json.dumps(meta)}\n\n"
+
+    return sse(gen())
+
+
+# ---------------- gemini ----------------
+
+
+@app.post("/v1beta/models/{model_method}")
+async def gemini_generate(model_method: str, request: Request):
+    behavior = Behavior(request)
+    body = await request.json()
+    if behavior.should_fail():
+        return error_response(behavior)
+    method = model_method.split(":")[-1]
+    prompt_tokens = prompt_tokens_of(body)
+
+    def response(text, finish_reason=None, completion_tokens=None):
+        candidate = {
+            "content": {"parts": [{"text": text}], "role": "model"},
+            "index": 0,
+        }
+        if finish_reason:
+            candidate["finishReason"] = finish_reason
+        data = {"candidates": [candidate]}
+        if completion_tokens is not None:
+            data["usageMetadata"] = {
+                "promptTokenCount": prompt_tokens,
+                "candidatesTokenCount": completion_tokens,
+                "totalTokenCount": prompt_tokens + completion_tokens,
+            }
+        return data
+
+    if method == "generateContent":
+        return response(await behavior.full_text(), "STOP", behavior.tokens)
+
+    async def gen():
+        words = []
+        async for word in behavior.tokens_paced():
+            words.append(word)
+            yield f"data: {json.dumps(response(word))}\r\n\r\n"
+        yield f"data: {json.dumps(response('', 'STOP', len(words)))}\r\n\r\n"
+
+    return sse(gen())
+
+
+# ---------------- 火山方舟（云雀） ----------------
+
+
+@app.post("/api/v1/chat")
+async def maas_chat(request: Request):
+    behavior = Behavior(request)
+    body = await request.json()
+    req_id = uuid.uuid4().hex
+    if "HMAC-SHA256" not in request.headers.get("authorization", ""):
+        return JSONResponse(
+            status_code=401,
+            content={"req_id": req_id, "error": {"code_n": 1709701, "code": "AuthenticationError", "message": "unsigned"}},
+        )
+    if behavior.should_fail():
+        return error_response(behavior)
+    prompt_tokens = prompt_tokens_of(body)
+
+    def response(content, finish_reason=None, completion_tokens=None):
+        data = {
+            "req_id": req_id,
+            "choice": {"message": {"role": "assistant", "content": content}, "finish_reason": finish_reason},
+        }
+        if completion_tokens is not None:
+            data["usage"] = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+        return data
+
+    if not body.get("stream"):
+        return response(await behavior.full_text(), "stop", behavior.tokens)
+
+    async def gen():
+        count = 0
+        async for word in behavior.tokens_paced():
+            count += 1
+            yield f"data:{json.dumps(response(word))}\n\n"
+        yield f"data:{json.dumps(response('', 'stop', count))}\n\n"
+        yield "data:[DONE]\n\n"
+
+    return sse(gen())
+
+
+# ---------------- 讯飞星火 ----------------
+
+
+@app.websocket("/{version}/chat")
+async def spark_chat(version: str, websocket: WebSocket):
+    # 和星火一样每个连接只回答一个问题，最后一帧status为2，之后由服务端关闭连接
+    behavior = Behavior(websocket)
+    await websocket.accept()
+    body = json.loads(await websocket.receive_text())
+    sid = f"cht{uuid.uuid4().hex}"
+    if behavior.should_fail():
+        header = {"code": 10013, "message": "mock upstream error", "sid": sid, "status": 2}
+        await websocket.send_text(json.dumps({"header": header}))
+        await websocket.close()
+        return
+    prompt_tokens = prompt_tokens_of(body)
+
+    def frame(content, seq, status, completion_tokens=None):
+        data = {
+            "header": {"code": 0, "message": "Success", "sid": sid, "status": status},
+            "payload": {
+                "choices": {
+                    "status": status,
+                    "seq": seq,
+                    "text": [{"content": content, "role": "assistant", "index": 0}],
+                }
+            },
+        }
+        if completion_tokens is not None:
+            data["payload"]["usage"] = {
+                "text": {
+                    "question_tokens": prompt_tokens,
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                }
+            }
+        return json.dumps(data, ensure_ascii=False)
+
+    seq = 0
+    async for word in behavior.tokens_paced():
+        await websocket.send_text(frame(word, seq, 0 if seq == 0 else 1))
+        seq += 1
+    await websocket.send_text(frame("", seq, 2, seq))
+    await websocket.close()
+
+
+def start_in_thread(port: int, host: str = "127.0.0.1") -> uvicorn.Server:
+    """在后台线程启动mock上游，测试中使用"""
+    server = uvicorn.Server(
+        uvicorn.Config(app, host=host, port=port, log_level="error", lifespan="off")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mock llm upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18090)
+    parser.add_argument("--ttft", type=float, default=mock_config.ttft)
+    parser.add_argument("--tokens", type=int, default=mock_config.tokens)
+    parser.add_argument("--token-rate", type=float, default=mock_config.token_rate)
+    parser.add_argument("--error-rate", type=float, default=mock_config.error_rate)
+    parser.add_argument("--error-status", type=int, default=mock_config.error_status)
+    args = parser.parse_args()
+    mock_config.ttft = args.ttft
+    mock_config.tokens = args.tokens
+    mock_config.token_rate = args.token_rate
+    mock_config.error_rate = args.error_rate
+    mock_config.error_status = args.error_status
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import asyncio
+import importlib.util
+import json
+import os
+
+import pytest
+
+from adapters import adapter_factory
+from config import ModelConfig
+from utils import admission
+from utils.admission import AdmissionScheduler
+from utils.util import config_token_hash
+
+
+@pytest.mark.asyncio
+async def test_last_tag_pruned():
+    scheduler = AdmissionScheduler(1)
+    await scheduler.acquire("a")
+    waiters = [asyncio.create_task(scheduler.acquire(token)) for token in ("a", "a", "b")]
+    await asyncio.sleep(0)
+    assert set(scheduler._last_tag) == {(1, "a"), (1, "b")}
+    # 超时和取消也会出队
+    timed_out = asyncio.create_task(scheduler.acquire("c", timeout=0.01))
+    cancelled = asyncio.create_task(scheduler.acquire("d"))
+    await asyncio.sleep(0.05)
+    cancelled.cancel()
+    await asyncio.gather(timed_out, cancelled, return_exceptions=True)
+    assert set(scheduler._last_tag) == {(1, "a"), (1, "b")}
+    for _ in waiters:
+        scheduler.release()
+    await asyncio.gather(*waiters)
+    assert scheduler._last_tag == {}
+    scheduler.release()
+    assert scheduler.active == 0 and scheduler.waiting == 0
+
+
+def load_gateway():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "open-api.py")
+    spec = importlib.util.spec_from_file_location("open_api", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.asyncio
+async def test_stream_released_when_client_disconnects_before_body(mock_url, monkeypatch):
+    monkeypatch.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    scheduler = AdmissionScheduler(1)
+    monkeypatch.setattr(admission, "_scheduler", scheduler)
+    config = ModelConfig(
+        token="admission-token",
+        type="proxy",
+        config={"api_base": f"{mock_url}/v1/", "api_key": "sk-mock", "model": "gpt-3.5-turbo"},
+    )
+    generation = adapter_factory.swap_adapters({config_token_hash(config.token): config})
+    app = load_gateway().build_app()
+    body = json.dumps(
+        {"model": "gpt-3.5-turbo", "stream": True, "messages": [{"role": "user", "content": "hi"}]}
+    ).encode()
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        # 请求体读完后客户端立即断开
+        return {"type": "http.disconnect"}
+
+    sent = []
+
+    async def send(message):
+        sent.append(message["type"])
+        # 发送响应头时让出事件循环，断开检测先执行，body还没有开始迭代
+        await asyncio.sleep(0)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/v1/chat/completions",
+        "raw_path": b"/v1/chat/completions",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"authorization", b"Bearer admission-token"),
+        ],
+        "client": ("127.0.0.1", 1),
+        "server": ("127.0.0.1", 80),
+    }
+    await app(scope, receive, send)
+    assert "http.response.body" not in sent
+    assert generation.inflight == 0
+    assert scheduler.active == 0
+
+
+async def admit_order(scheduler: AdmissionScheduler, requests: list) -> list:
+    """名额占满后按顺序提交requests（(token, priority, weight)），逐个释放，返回放行顺序"""
+    order = []
+
+    async def request(name, priority, weight):
+        await scheduler.acquire(name, priority, weight)
+        order.append(name)
+
+    tasks = []
+    for name, priority, weight in requests:
+        tasks.append(asyncio.create_task(request(name, priority, weight)))
+        await asyncio.sleep(0)
+    for _ in requests:
+        scheduler.release()
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return order
+
+
+@pytest.mark.asyncio
+async def test_strict_priority():
+    scheduler = AdmissionScheduler(1)
+    await scheduler.acquire("holder")
+    order = await admit_order(
+        scheduler, [("batch", 2, 1), ("default", 1, 1), ("interactive", 0, 1), ("default2", 1, 1)]
+    )
+    assert order == ["interactive", "default", "default2", "batch"]
+
+
+@pytest.mark.asyncio
+async def test_fair_queuing_between_tokens():
+    scheduler = AdmissionScheduler(1)
+    await scheduler.acquire("holder")
+    # a一次提交4个请求，b后提交的请求不需要排在a全部请求之后
+    order = await admit_order(scheduler, [("a", 1, 1)] * 4 + [("b", 1, 1)] * 2)
+    assert order == ["a", "b", "a", "b", "a", "a"]
+
+
+@pytest.mark.asyncio
+async def test_weighted_fair_queuing():
+    scheduler = AdmissionScheduler(1)
+    await scheduler.acquire("holder")
+    order = await admit_order(scheduler, [("a", 1, 1)] * 3 + [("b", 1, 2)] * 6)
+    # weight为2的b每轮放行两个
+    assert order[:6].count("b") == 4
+
+
+@pytest.mark.asyncio
+async def test_deadline_drop():
+    scheduler = AdmissionScheduler(1)
+    await scheduler.acquire("holder")
+    with pytest.raises(admission.AdmissionTimeout):
+        await scheduler.acquire("late", timeout=0.01)
+    assert scheduler.waiting == 0
+    # 丢弃的请求不会占用名额
+    scheduler.release()
+    await scheduler.acquire("next")
+    assert scheduler.active == 1
@@ -0,0 +1,208 @@
+import time
+
+import httpx
+import pytest
+
+from adapters.base import ModelAdapter, UDFApiError
+from adapters.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakerAdapter
+from adapters.protocol import (
+    ChatCompletionRequest,
+    ChatCompletionResponse,
+    ChatCompletionResponseStreamChoice,
+    ChatMessage,
+    DeltaMessage,
+)
+
+
+def chunk(content: str, finish_reason: str = None) -> ChatCompletionResponse:
+    return ChatCompletionResponse(
+        model="m",
+        object="chat.completion.chunk",
+        choices=[
+            ChatCompletionResponseStreamChoice(
+                index=0, delta=DeltaMessage(content=content), finish_reason=finish_reason
+            )
+        ],
+    )
+
+
+def request(stream: bool) -> ChatCompletionRequest:
+    return ChatCompletionRequest(
+        model="m", messages=[ChatMessage(role="user", content="hi")], stream=stream
+    )
+
+
+class Upstream(ModelAdapter):
+    """按顺序返回items，遇到异常对象时抛出"""
+
+    def __init__(self, *items):
+        self.items = items
+
+    def chat_completions(self, request):
+        for item in self.items:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    async def achat_completions(self, request):
+        for item in self.chat_completions(request):
+            yield item
+
+
+class RecordingBreaker(CircuitBreaker):
+    def __init__(self, **kwargs):
+        super().__init__("test", **kwargs)
+        self.outcomes = []
+
+    def on_success(self):
+        self.outcomes.append("success")
+        super().on_success()
+
+    def on_failure(self):
+        self.outcomes.append("failure")
+        super().on_failure()
+
+    def on_release(self):
+        self.outcomes.append("release")
+        super().on_release()
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=3)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.on_failure()
+    assert breaker.state == CLOSED
+    breaker.on_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+
+def test_success_resets_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=3, min_requests=100)
+    for _ in range(10):
+        breaker.on_failure()
+        breaker.on_failure()
+        breaker.on_success()
+    assert breaker.state == CLOSED
+
+
+def test_opens_on_error_ratio():
+    breaker = CircuitBreaker(
+        "test", failure_threshold=100, error_ratio=0.5, window_size=10, min_requests=10
+    )
+    for _ in range(5):
+        breaker.on_success()
+        breaker.on_failure()
+    assert breaker.state == OPEN
+
+
+def test_half_open_probe():
+    breaker = CircuitBreaker("test", failure_threshold=1, open_seconds=0.05, half_open_max_calls=1)
+    breaker.on_failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    # 只放行一个探测请求
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.on_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_half_open_failure_reopens():
+    breaker = CircuitBreaker("test", failure_threshold=1, open_seconds=0.05)
+    breaker.on_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.on_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+
+def test_half_open_release_frees_probe():
+    breaker = CircuitBreaker("test", failure_threshold=1, open_seconds=0.05)
+    breaker.on_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.on_release()
+    assert breaker.allow()
+
+
+def test_is_failure():
+    breaker = CircuitBreaker("test")
+    assert breaker.is_failure(UDFApiError("", 500))
+    assert breaker.is_failure(UDFApiError("", 429))
+    assert breaker.is_failure(UDFApiError("", 504))
+    assert breaker.is_failure(httpx.ConnectError("refused"))
+    assert breaker.is_failure(TimeoutError())
+    assert not breaker.is_failure(UDFApiError("", 400))
+    assert not breaker.is_failure(UDFApiError("", 401))
+    assert not breaker.is_failure(KeyError("choices"))
+    assert not breaker.is_failure(ValueError())
+
+
+def test_non_stream_closed_after_result():
+    breaker = RecordingBreaker()
+    resp = CircuitBreakerAdapter(Upstream(chunk("hi", "stop")), breaker).chat_completions(
+        request(False)
+    )
+    next(resp)
+    resp.close()
+    assert breaker.outcomes == ["success"]
+
+
+def test_stream_success_recorded_once():
+    breaker = RecordingBreaker()
+    adapter = CircuitBreakerAdapter(Upstream(chunk("a"), chunk("b"), chunk("", "stop")), breaker)
+    assert len(list(adapter.chat_completions(request(True)))) == 3
+    assert breaker.outcomes == ["success"]
+
+
+def test_stream_failure_after_first_chunk_recorded_once():
+    breaker = RecordingBreaker()
+    adapter = CircuitBreakerAdapter(Upstream(chunk("a"), UDFApiError("reset", 502)), breaker)
+    with pytest.raises(UDFApiError):
+        list(adapter.chat_completions(request(True)))
+    assert breaker.outcomes == ["failure"]
+
+
+def test_adapter_error_not_counted():
+    breaker = RecordingBreaker()
+    adapter = CircuitBreakerAdapter(Upstream(KeyError("choices")), breaker)
+    with pytest.raises(KeyError):
+        list(adapter.chat_completions(request(True)))
+    assert breaker.outcomes == ["release"]
+
+
+def test_client_disconnect_not_counted():
+    breaker = RecordingBreaker()
+    adapter = CircuitBreakerAdapter(Upstream(chunk("a"), chunk("b"), chunk("", "stop")), breaker)
+    resp = adapter.chat_completions(request(True))
+    next(resp)
+    resp.close()
+    assert breaker.outcomes == ["release"]
+
+
+@pytest.mark.asyncio
+async def test_async_outcomes():
+    breaker = RecordingBreaker()
+    adapter = CircuitBreakerAdapter(Upstream(chunk("hi", "stop")), breaker)
+    resp = adapter.achat_completions(request(False))
+    await anext(resp)
+    await resp.aclose()
+    adapter = CircuitBreakerAdapter(Upstream(chunk("a"), httpx.ReadTimeout("slow")), breaker)
+    with pytest.raises(httpx.ReadTimeout):
+        async for _ in adapter.achat_completions(request(True)):
+            pass
+    assert breaker.outcomes == ["success", "failure"]
+
+
+def test_open_rejects_with_503():
+    breaker = CircuitBreaker("test", failure_threshold=1)
+    breaker.on_failure()
+    adapter = CircuitBreakerAdapter(Upstream(chunk("hi", "stop")), breaker)
+    with pytest.raises(UDFApiError) as info:
+        next(adapter.chat_completions(request(False)))
+    assert info.value.http_status == 503
@@ -0,0 +1,107 @@
+import pytest
+
+from adapters import failover
+from adapters.base import UDFApiError
+from adapters.failover import FailoverPolicy, afailover_stream, failover_stream
+
+
+def test_backoff_bounds():
+    policy = FailoverPolicy(backoff_seconds=0.1, max_backoff_seconds=0.5)
+    for attempt, base in [(1, 0.1), (2, 0.2), (3, 0.4), (4, 0.5), (10, 0.5)]:
+        delays = [policy.backoff(attempt) for _ in range(200)]
+        # 指数退避，抖动范围为[0.5, 1]倍，不超过max_backoff_seconds
+        assert all(base * 0.5 <= d <= base for d in delays)
+
+
+def test_retriable():
+    policy = FailoverPolicy(retry_on_status=[503])
+    assert policy.retriable(UDFApiError("", 503))
+    assert not policy.retriable(UDFApiError("", 500))
+    assert not policy.retriable(KeyError())
+
+
+class Streams:
+    """按token依次返回预设的items，遇到异常对象时抛出，记录每次等待的时间"""
+
+    def __init__(self, monkeypatch, *streams):
+        self.streams = list(streams)
+        self.sleeps = []
+        self.closed = []
+        monkeypatch.setattr(failover.time, "sleep", self.sleeps.append)
+
+        async def sleep(delay):
+            self.sleeps.append(delay)
+
+        monkeypatch.setattr(failover.asyncio, "sleep", sleep)
+
+    def open_stream(self, tried):
+        token = f"t{len(tried)}"
+        items = self.streams[len(tried)]
+
+        def gen():
+            for item in items:
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+
+        return token, gen()
+
+    def aopen_stream(self, tried):
+        token = f"t{len(tried)}"
+        items = self.streams[len(tried)]
+
+        async def agen():
+            try:
+                for item in items:
+                    if isinstance(item, BaseException):
+                        raise item
+                    yield item
+            finally:
+                self.closed.append(token)
+
+        return token, agen()
+
+
+def policy(**kwargs) -> FailoverPolicy:
+    return FailoverPolicy(max_attempts=3, backoff_seconds=0.1, **kwargs)
+
+
+def test_retry_before_first_item(monkeypatch):
+    streams = Streams(monkeypatch, [UDFApiError("", 503)], [UDFApiError("", 429)], ["a", "b"])
+    assert list(failover_stream(policy(), streams.open_stream)) == ["a", "b"]
+    assert len(streams.sleeps) == 2
+    assert 0.05 <= streams.sleeps[0] <= 0.1 and 0.1 <= streams.sleeps[1] <= 0.2
+
+
+def test_gives_up_after_max_attempts(monkeypatch):
+    streams = Streams(monkeypatch, *[[UDFApiError("", 503)]] * 3)
+    with pytest.raises(UDFApiError):
+        list(failover_stream(policy(), streams.open_stream))
+    assert len(streams.sleeps) == 2
+
+
+def test_non_retriable_not_retried(monkeypatch):
+    streams = Streams(monkeypatch, [UDFApiError("", 400)], ["a"])
+    with pytest.raises(UDFApiError):
+        list(failover_stream(policy(), streams.open_stream))
+    assert streams.sleeps == []
+
+
+def test_no_retry_after_first_item(monkeypatch):
+    streams = Streams(monkeypatch, ["a", UDFApiError("", 503)], ["b"])
+    resp = failover_stream(policy(), streams.open_stream)
+    assert next(resp) == "a"
+    with pytest.raises(UDFApiError):
+        next(resp)
+    assert streams.sleeps == []
+
+
+@pytest.mark.asyncio
+async def test_async_retry_and_close(monkeypatch):
+    streams = Streams(monkeypatch, [UDFApiError("", 502)], ["a", "b", "c"])
+    resp = afailover_stream(policy(), streams.aopen_stream)
+    assert [await anext(resp), await anext(resp)] == ["a", "b"]
+    # 客户端提前结束时关闭上游
+    await resp.aclose()
+    assert streams.closed == ["t0", "t1"]
+    assert len(streams.sleeps) == 1
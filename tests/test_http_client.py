@@ -0,0 +1,63 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from adapters import base
+from utils import http_client
+
+PARAMS = {"messages": [{"role": "user", "content": "你好"}], "stream": True}
+
+
+def capture(requests: list):
+    def handler(request: httpx.Request):
+        requests.append(request)
+        return httpx.Response(200, content=b"data: [DONE]\n\n")
+
+    return httpx.MockTransport(handler)
+
+
+def test_stream_body_matches_json_dumps(monkeypatch):
+    requests = []
+    client = httpx.Client(transport=capture(requests))
+    monkeypatch.setattr(base, "get_http_client", lambda *args, **kwargs: client)
+    base.stream("http://upstream/chat", {"Authorization": "x"}, PARAMS).close()
+    # 签名的内容是json.dumps(params)，发送的请求体必须与之一致
+    assert requests[0].content == json.dumps(PARAMS).encode()
+    assert requests[0].headers["Content-Type"] == "application/json"
+
+
+@pytest.mark.asyncio
+async def test_astream_body_matches_json_dumps(monkeypatch):
+    requests = []
+    client = httpx.AsyncClient(transport=capture(requests))
+    monkeypatch.setattr(base, "get_async_http_client", lambda *args, **kwargs: client)
+    resp = await base.astream("http://upstream/chat", {"content-type": "text/plain"}, PARAMS)
+    await resp.aclose()
+    assert requests[0].content == json.dumps(PARAMS).encode()
+    # 调用方指定的Content-Type不会被覆盖，也不会重复
+    assert requests[0].headers.get_list("content-type") == ["text/plain"]
+
+
+def test_async_clients_of_closed_loops_dropped():
+    loops = []
+
+    async def get():
+        loops.append(asyncio.get_running_loop())
+        return http_client.get_async_http_client("http://upstream/")
+
+    first = asyncio.run(get())
+    assert asyncio.run(get()) is not first
+    # 第一个循环已关闭，它的连接池在第二个循环创建连接池时被清理
+    cached = [loop for loop, _ in http_client._async_clients.values()]
+    assert loops[0] not in cached and loops[1] in cached
+
+
+@pytest.mark.asyncio
+async def test_closed_async_client_replaced():
+    client = http_client.get_async_http_client("http://upstream/")
+    assert http_client.get_async_http_client("http://upstream/") is client
+    await client.aclose()
+    replaced = http_client.get_async_http_client("http://upstream/")
+    assert replaced is not client and not replaced.is_closed
@@ -0,0 +1,70 @@
+import pytest
+
+from adapters import adapter_factory
+from adapters.protocol import ChatCompletionRequest, ChatMessage, frame_usage
+from adapters.proxy import ProxyAdapter
+from adapters.rate_limit import RateLimitAdapter, stream_usage
+from utils.metrics import RequestMetrics
+
+
+def request(stream: bool = True) -> ChatCompletionRequest:
+    return ChatCompletionRequest(
+        model="gpt-3.5-turbo", messages=[ChatMessage(role="user", content="hi")], stream=stream
+    )
+
+
+def proxy(mock_url: str, **kwargs) -> ProxyAdapter:
+    return ProxyAdapter(
+        api_base=f"{mock_url}/v1/", api_key="sk-mock", model="gpt-3.5-turbo", passthrough=True, **kwargs
+    )
+
+
+def test_frame_usage():
+    assert frame_usage(b'data: {"choices":[],"usage":{"prompt_tokens":3,"completion_tokens":5}}\n\n').completion_tokens == 5
+    assert frame_usage(b'data: {"choices":[{"delta":{}}],"usage":null}\n\n') is None
+    assert frame_usage(b'data: {"choices":[{"delta":{"content":"x"}}]}\n\n') is None
+    assert frame_usage(b'data: {"usage": broken\n\n') is None
+
+
+def test_passthrough_usage_from_last_frame(mock_url):
+    adapter = proxy(mock_url, stream_options={"include_usage": True})
+    frames = list(adapter.chat_completions(request()))
+    assert all(isinstance(f, bytes) for f in frames)
+    assert stream_usage(None, frames[-1]).completion_tokens == 32
+    metrics = RequestMetrics("test_passthrough", "test")
+    observer = metrics.observe("token", "proxy", True)
+    for frame in frames:
+        observer.on_item(frame)
+    observer.finish(200)
+    assert metrics.completion_tokens.labels("token", "proxy").value == 32
+
+
+def test_stream_options_only_sent_with_stream(mock_url):
+    adapter = proxy(mock_url, stream_options={"include_usage": True})
+    assert "stream_options" not in adapter.convert_param(request(stream=False))
+    assert adapter.convert_param(request())["stream_options"] == {"include_usage": True}
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_charges_passthrough_usage(mock_url):
+    adapter = RateLimitAdapter(proxy(mock_url, stream_options={"include_usage": True}), "test-passthrough", tpm=100000)
+    charged = []
+    adapter.charge = lambda tokens, usage: charged.append(usage)
+    async for _ in adapter.achat_completions(request()):
+        pass
+    assert charged[0].completion_tokens == 32
+
+
+def inner(model):
+    while hasattr(model, "adapter"):
+        model = model.adapter
+    return model
+
+
+def test_tpm_disables_passthrough_without_include_usage(mock_url):
+    base = {"api_base": f"{mock_url}/v1/", "api_key": "sk-mock", "passthrough": True, "rate_limit": {"tpm": 1000}}
+    assert not inner(adapter_factory.create_adapter("a" * 64, "proxy", **base)).passthrough
+    kept = adapter_factory.create_adapter(
+        "b" * 64, "proxy", stream_options={"include_usage": True}, **base
+    )
+    assert inner(kept).passthrough
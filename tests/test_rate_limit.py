@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+import pytest
+
+from adapters.base import ModelAdapter, UDFApiError
+from adapters.protocol import ChatCompletionRequest, ChatMessage
+from adapters.rate_limit import RateLimitAdapter
+from utils.shared_state import LocalState, SqliteState
+
+
+@pytest.fixture(params=["local", "sqlite"])
+def state(request, tmp_path):
+    if request.param == "local":
+        return LocalState()
+    return SqliteState(str(tmp_path / "state.db"))
+
+
+def test_bucket_starts_full(state):
+    for _ in range(3):
+        assert state.take("k", 1, 1, 3) == 0
+    assert state.take("k", 1, 1, 3) > 0
+
+
+def test_bucket_wait_without_taking(state):
+    # 每秒补充10个，最多10个
+    assert state.take("k", 10, 10, 10) == 0
+    wait = state.take("k", 5, 10, 10)
+    assert 0.4 < wait <= 0.5
+    # 等待时不扣除，再次查询的等待时间不会变长
+    assert state.take("k", 5, 10, 10) <= wait
+
+
+def test_bucket_refill(state):
+    assert state.take("k", 2, 20, 2) == 0
+    assert state.take("k", 1, 20, 2) > 0
+    time.sleep(0.1)
+    assert state.take("k", 1, 20, 2) == 0
+
+
+def test_bucket_force_goes_negative(state):
+    assert state.take("k", 5, 1, 5) == 0
+    assert state.take("k", 10, 1, 5, force=True) == 0
+    # 欠了10个，需要等待约11秒才能取到1个
+    assert state.take("k", 1, 1, 5) > 10
+    # 退回后恢复
+    state.take("k", -11, 1, 5, force=True)
+    assert state.take("k", 1, 1, 5) == 0
+
+
+def test_buckets_independent(state):
+    assert state.take("a", 1, 1, 1) == 0
+    assert state.take("b", 1, 1, 1) == 0
+    assert state.take("a", 1, 1, 1) > 0
+
+
+def test_sqlite_shared_between_connections(tmp_path):
+    path = str(tmp_path / "state.db")
+    first, second = SqliteState(path), SqliteState(path)
+    assert first.take("k", 2, 1, 2) == 0
+    assert second.take("k", 1, 1, 2) > 0
+
+
+class Upstream(ModelAdapter):
+    async def achat_completions(self, request):
+        await asyncio.sleep(0.05)
+        yield b"data: {}\n\n"
+
+
+def request(content: str = "hi") -> ChatCompletionRequest:
+    return ChatCompletionRequest(
+        model="x", messages=[ChatMessage(role="user", content=content)], stream=True
+    )
+
+
+async def consume(adapter: RateLimitAdapter, content: str = "hi"):
+    return [item async for item in adapter.achat_completions(request(content))]
+
+
+@pytest.mark.asyncio
+async def test_rpm_error_body_and_retry_after():
+    adapter = RateLimitAdapter(Upstream(), "test-rpm", rpm=2)
+    await consume(adapter)
+    await consume(adapter)
+    with pytest.raises(UDFApiError) as info:
+        await consume(adapter)
+    error = info.value
+    assert error.http_status == 429
+    assert error.content()["error"]["type"] == "requests"
+    assert error.content()["error"]["code"] == "rate_limit_exceeded"
+    # 每30秒补充一个
+    assert 28 <= int(error.headers["Retry-After"]) <= 30
+
+
+@pytest.mark.asyncio
+async def test_tpm_request_too_large():
+    adapter = RateLimitAdapter(Upstream(), "test-tpm", tpm=10)
+    with pytest.raises(UDFApiError) as info:
+        await consume(adapter, "x" * 200)
+    assert info.value.content()["error"]["type"] == "tokens"
+    assert info.value.headers is None
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit():
+    adapter = RateLimitAdapter(Upstream(), "test-concurrency", max_concurrency=2)
+    results = await asyncio.gather(*[consume(adapter) for _ in range(3)], return_exceptions=True)
+    errors = [r for r in results if isinstance(r, UDFApiError)]
+    assert len(errors) == 1 and errors[0].headers == {"Retry-After": "1"}
+    # 结束后释放名额
+    await consume(adapter)
+
+
+@pytest.mark.asyncio
+async def test_queue_until_refill():
+    adapter = RateLimitAdapter(Upstream(), "test-queue", rpm=600, queue_timeout_seconds=1)
+    adapter.state = LocalState()
+    for _ in range(600):
+        adapter.state.take(adapter.rpm_key, 1, 10, 600)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await consume(adapter)
+    # 每秒补充10个，排队约0.1秒后放行
+    assert 0.05 < loop.time() - start < 0.5
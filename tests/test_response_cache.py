@@ -0,0 +1,62 @@
+import httpx
+
+import mock_upstream
+
+
+def chat(url: str, **kwargs) -> httpx.Response:
+    body = {
+        "model": "gpt-3.5-turbo",
+        "messages": [{"role": "user", "content": "你好"}],
+        "temperature": 0,
+        **kwargs,
+    }
+    return httpx.post(
+        f"{url}/v1/chat/completions",
+        json=body,
+        headers={"Authorization": "Bearer cache-token"},
+        timeout=30,
+    )
+
+
+def cache_config(mock_url: str) -> list:
+    return [
+        {
+            "token": "cache-token",
+            "type": "proxy",
+            "config": {
+                "api_base": f"{mock_url}/v1/",
+                "api_key": "sk-mock",
+                "model": "gpt-3.5-turbo",
+                "cache": {"ttl_seconds": 60},
+            },
+        }
+    ]
+
+
+def test_non_stream_cached(mock_url, gateway):
+    url = gateway(cache_config(mock_url))
+    before = mock_upstream.mock_config.requests
+    first = chat(url)
+    second = chat(url)
+    assert first.status_code == 200 and second.status_code == 200
+    assert first.json() == second.json()
+    assert mock_upstream.mock_config.requests - before == 1
+
+
+def test_stream_cached(mock_url, gateway):
+    url = gateway(cache_config(mock_url))
+    before = mock_upstream.mock_config.requests
+    first = chat(url, stream=True)
+    second = chat(url, stream=True)
+    assert first.status_code == 200 and second.status_code == 200
+    assert first.text == second.text
+    assert "[DONE]" in second.text
+    assert mock_upstream.mock_config.requests - before == 1
+
+
+def test_non_deterministic_not_cached(mock_url, gateway):
+    url = gateway(cache_config(mock_url))
+    before = mock_upstream.mock_config.requests
+    chat(url, temperature=0.7)
+    chat(url, temperature=0.7)
+    assert mock_upstream.mock_config.requests - before == 2
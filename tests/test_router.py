@@ -0,0 +1,29 @@
+from adapters.router_adapter import BackendStats, RouterAdapter
+from utils.util import hash_token
+
+
+def router(**kwargs) -> RouterAdapter:
+    return RouterAdapter(
+        lambda token: None, router_strategy="least-latency", token_pool=["a", "b"], **kwargs
+    )
+
+
+def test_failing_backend_without_ttft_not_preferred():
+    adapter = router(max_error_rate=1.0)
+    healthy, failing = adapter.stats[hash_token("a")], adapter.stats[hash_token("b")]
+    healthy.on_first(0.5)
+    healthy.on_success(1.0)
+    # 每次都在首包之前失败，没有延迟数据
+    for _ in range(3):
+        failing.on_error()
+    for _ in range(20):
+        assert adapter.select_least_latency([hash_token("a"), hash_token("b")]) == hash_token("a")
+
+
+def test_score_falls_back_to_total_then_default():
+    stats = BackendStats()
+    assert stats.score(2.0) == 2.0
+    stats.on_success(1.5)
+    assert stats.score(2.0) == 1.5
+    stats.on_first(0.2)
+    assert stats.score(2.0) == 0.2
@@ -0,0 +1,47 @@
+from adapters import adapter_factory
+from config import ModelConfig
+from utils.util import config_token_hash, hash_token
+
+
+def proxy(model: str) -> dict:
+    return {"api_base": "http://127.0.0.1:1/v1/", "api_key": "sk-upstream", "model": model}
+
+
+def swap(configs):
+    return adapter_factory.swap_adapters({config_token_hash(c.token): c for c in configs})
+
+
+def test_routes_keyed_by_hash():
+    generation = swap(
+        [
+            ModelConfig(token="leaf-secret", type="proxy", config=proxy("a")),
+            ModelConfig(
+                token="sha256:" + hash_token("hashed-secret").upper(), type="proxy", config=proxy("b")
+            ),
+            ModelConfig(
+                token="router-secret",
+                type="router",
+                config={"router_strategy": "round-robin", "token_pool": ["leaf-secret", "hashed-secret"]},
+            ),
+        ]
+    )
+    leaf = adapter_factory.resolve_route("leaf-secret")
+    assert leaf.adapter is generation.adapters[hash_token("leaf-secret")]
+    assert adapter_factory.resolve_route("hashed-secret") is not None
+    # 不能直接用hash鉴权
+    assert adapter_factory.resolve_route(hash_token("leaf-secret")) is None
+    assert adapter_factory.resolve_route("sha256:" + hash_token("leaf-secret")) is None
+    # 内存中不保留token原文
+    router = adapter_factory.resolve_route("router-secret").adapter
+    assert router.token_pool == [hash_token("leaf-secret"), hash_token("hashed-secret")]
+    keys = set(generation.adapters) | set(generation.routes) | set(generation.digests)
+    assert not keys & {"leaf-secret", "router-secret", "hashed-secret"}
+    assert not hasattr(leaf, "key")
+
+
+def test_unchanged_config_reused():
+    t1 = ModelConfig(token="t1", type="proxy", config=proxy("a"))
+    first = swap([t1, ModelConfig(token="t2", type="proxy", config=proxy("b"))])
+    second = swap([t1, ModelConfig(token="t2", type="proxy", config=proxy("c"))])
+    assert second.adapters[hash_token("t1")] is first.adapters[hash_token("t1")]
+    assert second.adapters[hash_token("t2")] is not first.adapters[hash_token("t2")]
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from adapters.base import ModelAdapter
+from adapters.protocol import ChatCompletionRequest, ChatMessage
+from adapters.single_flight import SingleFlightAdapter
+
+
+class Upstream(ModelAdapter):
+    def __init__(self):
+        self.calls = 0
+
+    async def achat_completions(self, request):
+        self.calls += 1
+        for i in range(3):
+            await asyncio.sleep(0.01)
+            yield i
+
+
+def request() -> ChatCompletionRequest:
+    return ChatCompletionRequest(
+        model="m", messages=[ChatMessage(role="user", content="hi")], stream=True, temperature=0
+    )
+
+
+async def consume(adapter: SingleFlightAdapter):
+    return [item async for item in adapter.achat_completions(request())]
+
+
+@pytest.mark.asyncio
+async def test_identical_requests_coalesced():
+    upstream = Upstream()
+    adapter = SingleFlightAdapter(upstream, "token")
+    results = await asyncio.gather(*[consume(adapter) for _ in range(3)])
+    assert results == [[0, 1, 2]] * 3
+    assert upstream.calls == 1
+    assert adapter.flights == {}
+
+
+@pytest.mark.asyncio
+async def test_join_after_last_subscriber_left():
+    upstream = Upstream()
+    adapter = SingleFlightAdapter(upstream, "token")
+    resp = adapter.achat_completions(request())
+    assert await anext(resp) == 0
+    # 最后一个订阅者离开后上游task被取消，紧接着到达的相同请求不能订阅到CancelledError
+    await resp.aclose()
+    assert adapter.flights == {}
+    assert await consume(adapter) == [0, 1, 2]
+    assert upstream.calls == 2
@@ -0,0 +1,91 @@
+import pytest
+
+from utils.sse_client import SSEDecoder, aiter_sse_data, aiter_sse_events, iter_sse_data, iter_sse_events
+
+STREAM = (
+    b": keep-alive\n"
+    b"id: 1\n"
+    b"event: add\n"
+    b"data: {\"a\":\n"
+    b"data:  1}\n"
+    b"\n"
+    b"retry: 100\n"
+    b"\n"
+    b"data: \xe4\xbd\xa0\xe5\xa5\xbd\n"
+    b"\n"
+)
+
+
+def decode(chunks):
+    decoder = SSEDecoder()
+    events = []
+    for chunk in chunks:
+        events += decoder.feed(chunk)
+    return events + decoder.flush()
+
+
+def summary(events):
+    return [(e.id, e.event, e.data) for e in events]
+
+
+def test_fields_and_multiline_data():
+    assert summary(decode([STREAM])) == [
+        ("1", "add", '{"a":\n 1}'),
+        (None, "message", "你好"),
+    ]
+
+
+@pytest.mark.parametrize("line_end", [b"\n", b"\r\n", b"\r"])
+def test_split_anywhere(line_end):
+    stream = STREAM.replace(b"\n", line_end)
+    expected = summary(decode([stream]))
+    assert expected == summary(decode([STREAM]))
+    # 逐字节切分，多字节字符和\r\n都会被拆开
+    assert summary(decode([stream[i : i + 1] for i in range(len(stream))])) == expected
+    for size in (2, 3, 7):
+        assert summary(decode([stream[i : i + size] for i in range(0, len(stream), size)])) == expected
+
+
+def test_crlf_split_between_chunks():
+    decoder = SSEDecoder()
+    assert decoder.lines(b"data: a\r") == []
+    assert decoder.lines(b"\ndata: b\r\n") == [b"data: a", b"data: b"]
+    # 完整的\r\n在chunk结尾时不需要等下一个chunk
+    assert decoder.lines(b"\r\n") == [b""]
+    assert decoder.feed(b"data: c\r\n") == []
+    assert summary(decoder.feed(b"\r\n")) == [(None, "message", "c")]
+
+
+def test_flush_unterminated_event():
+    decoder = SSEDecoder()
+    assert summary(decoder.feed(b"data: a\n\ndata: b")) == [(None, "message", "a")]
+    assert summary(decoder.flush()) == [(None, "message", "b")]
+    assert decoder.flush() == []
+
+
+def test_event_without_data_not_dispatched():
+    assert decode([b"event: ping\n\nid: 2\n\n"]) == []
+
+
+def test_iter_sse_events():
+    chunks = [STREAM[:10], STREAM[10:]]
+    assert summary(iter_sse_events(iter(chunks))) == summary(decode([STREAM]))
+
+
+def test_iter_sse_data():
+    chunks = [b'data: {"x": 1}\r', b"\n\ndata:[DONE]", b"\n: comment\nevent: e\ndata: tail"]
+    assert list(iter_sse_data(iter(chunks))) == [b'{"x": 1}', b"[DONE]", b"tail"]
+
+
+async def agen(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.asyncio
+async def test_async_versions():
+    chunks = [STREAM[i : i + 5] for i in range(0, len(STREAM), 5)]
+    events = [e async for e in aiter_sse_events(agen(chunks))]
+    assert summary(events) == summary(decode([STREAM]))
+    data = [d async for d in aiter_sse_data(agen(chunks))]
+    assert data == list(iter_sse_data(iter(chunks)))
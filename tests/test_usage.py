@@ -0,0 +1,39 @@
+from adapters.protocol import ChatCompletionRequest, ChatMessage
+from adapters.qwen import QWenAdapter
+from utils.metrics import RequestMetrics
+
+
+def qwen_stream(mock_url: str, incremental_output: bool):
+    adapter = QWenAdapter(
+        api_base=f"{mock_url}/api/v1/",
+        api_key="mock",
+        model="qwen-turbo",
+        incremental_output=incremental_output,
+    )
+    request = ChatCompletionRequest(
+        model="qwen-turbo", messages=[ChatMessage(role="user", content="你好")], stream=True
+    )
+    return list(adapter.chat_completions(request))
+
+
+def test_qwen_stream_usage_is_cumulative(mock_url):
+    for incremental_output in (False, True):
+        chunks = qwen_stream(mock_url, incremental_output)
+        completion_tokens = [c.usage.completion_tokens for c in chunks]
+        assert completion_tokens == sorted(completion_tokens)
+        assert chunks[-1].usage.completion_tokens == 32
+        assert all(c.usage.prompt_tokens == chunks[0].usage.prompt_tokens for c in chunks)
+        assert "".join(c.choices[0].delta.content for c in chunks) == "".join(
+            f"tok{i} " for i in range(32)
+        )
+
+
+def test_observer_counts_final_usage(mock_url):
+    metrics = RequestMetrics("test_usage", "test")
+    observer = metrics.observe("token", "qwen", True)
+    chunks = qwen_stream(mock_url, False)
+    for chunk in chunks:
+        observer.on_item(chunk)
+    observer.finish(200)
+    assert metrics.completion_tokens.labels("token", "qwen").value == 32
+    assert metrics.prompt_tokens.labels("token", "qwen").value == chunks[-1].usage.prompt_tokens
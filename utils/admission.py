@@ -0,0 +1,155 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from typing import Optional
+
+from utils.metrics import Counter, Gauge, Histogram
+
+# 网关同时处理的请求数上限（每个worker），超过后按优先级排队；不配置或为0时不排队
+admission_max_concurrency_env = "ADMISSION-MAX-CONCURRENCY"
+# 排队的默认超时秒数，token的config或请求头 X-Request-Timeout 可以单独指定
+admission_queue_timeout_env = "ADMISSION-QUEUE-TIMEOUT"
+
+# 优先级，数值小的先处理；高优先级有请求排队时低优先级不会被放行
+priority_classes = {"interactive": 0, "default": 1, "batch": 2}
+priority_names = {v: k for k, v in priority_classes.items()}
+default_priority = priority_classes["default"]
+
+queue_depth = Gauge(
+    "openai_style_api_admission_queue_depth", "requests waiting for admission", ("priority",)
+)
+queue_wait = Histogram(
+    "openai_style_api_admission_wait_seconds", "time requests waited for admission", ("priority",)
+)
+queue_dropped = Counter(
+    "openai_style_api_admission_dropped_total",
+    "requests dropped after waiting past their deadline",
+    ("priority",),
+)
+
+
+class AdmissionTimeout(Exception):
+    pass
+
+
+class _Ticket:
+    __slots__ = ("priority", "key", "tag", "future", "enqueued_at", "timer")
+
+    def __init__(self, priority: int, key: tuple, tag: float, future: asyncio.Future):
+        self.priority = priority
+        # (priority, token)，对应_last_tag中的key
+        self.key = key
+        self.tag = tag
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.timer = None
+
+
+class AdmissionScheduler:
+    """
+    请求进入适配器之前的准入队列，只在事件循环中使用：
+    - 同时处理的请求数达到上限后，新请求排队；有请求结束时把名额直接交给队列中的下一个
+    - 不同优先级之间严格按优先级放行
+    - 同一优先级内按token做加权公平排队（self-clocked fair queuing）：每个请求的虚拟完成时间为
+      max(当前虚拟时间, 该token上一个请求的完成时间) + 1/weight，每次放行完成时间最小的请求，
+      批量任务一次性提交大量请求时，其他token的请求不需要排在它们全部后面
+    - 排队超过deadline（客户端的超时时间）的请求直接丢弃，不再占用上游
+    _last_tag只保存还有请求在排队的token：token的最后一个请求出队（放行、超时、取消）后删除，
+    之后该token的请求从当前虚拟时间开始计算
+    """
+
+    def __init__(self, max_concurrency: int, queue_timeout: float = 60):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self._heap = []
+        self._virtual_time = {}
+        self._last_tag = {}
+        self._seq = itertools.count()
+
+    async def acquire(self, token: str, priority: int = default_priority, weight: float = 1, timeout: float = None):
+        if self.active < self.max_concurrency and not self.waiting:
+            self.active += 1
+            return
+        loop = asyncio.get_running_loop()
+        key = (priority, token)
+        tag = max(self._virtual_time.get(priority, 0.0), self._last_tag.get(key, 0.0)) + 1 / weight
+        self._last_tag[key] = tag
+        ticket = _Ticket(priority, key, tag, loop.create_future())
+        heapq.heappush(self._heap, (priority, tag, next(self._seq), ticket))
+        timeout = self.queue_timeout if timeout is None else timeout
+        ticket.timer = loop.call_later(timeout, self._expire, ticket, timeout)
+        self._enqueued(ticket)
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            # 客户端断开等原因取消，如果名额已经交给了这个请求，转交给下一个
+            if ticket.future.done() and not ticket.future.cancelled():
+                if ticket.future.exception() is None:
+                    self.release()
+            else:
+                self._dequeued(ticket)
+            raise
+        finally:
+            ticket.timer.cancel()
+
+    def release(self):
+        while self._heap:
+            priority, tag, _, ticket = heapq.heappop(self._heap)
+            if ticket.future.done():
+                continue
+            self._virtual_time[priority] = tag
+            self._dequeued(ticket)
+            queue_wait.labels(priority_names[priority]).observe(
+                time.monotonic() - ticket.enqueued_at
+            )
+            ticket.future.set_result(None)
+            return
+        self.active -= 1
+
+    def _expire(self, ticket: _Ticket, timeout: float):
+        if ticket.future.done():
+            return
+        self._dequeued(ticket)
+        queue_dropped.labels(priority_names[ticket.priority]).inc()
+        ticket.future.set_exception(
+            AdmissionTimeout(f"request dropped after waiting {timeout}s in the admission queue")
+        )
+
+    def _enqueued(self, ticket: _Ticket):
+        self.waiting += 1
+        queue_depth.labels(priority_names[ticket.priority]).inc()
+
+    def _dequeued(self, ticket: _Ticket):
+        self.waiting -= 1
+        queue_depth.labels(priority_names[ticket.priority]).dec()
+        # 该token没有更晚入队的请求时，其完成时间不会再被使用
+        if self._last_tag.get(ticket.key) == ticket.tag:
+            del self._last_tag[ticket.key]
+
+
+_scheduler = None
+
+
+def get_admission_scheduler() -> Optional[AdmissionScheduler]:
+    global _scheduler
+    if _scheduler is None:
+        max_concurrency = int(os.getenv(admission_max_concurrency_env, "0"))
+        if max_concurrency <= 0:
+            return None
+        _scheduler = AdmissionScheduler(
+            max_concurrency, float(os.getenv(admission_queue_timeout_env, "60"))
+        )
+    return _scheduler
+
+
+def request_priority(priority: int, header: Optional[str]) -> int:
+    """请求头 X-Priority 只能把请求降到比token配置更低的优先级"""
+    if header:
+        value = priority_classes.get(header.strip().lower())
+        if value is not None and value > priority:
+            return value
+    return priority
@@ -0,0 +1,133 @@
+import asyncio
+import importlib.util
+import json
+import os
+import threading
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+# 每个上游host一个连接池，连接keep-alive复用，避免每次请求都重新进行TCP+TLS握手
+# 可通过环境变量 HTTP-POOL-SIZE 调整默认连接池大小，也可在适配器config中用 pool_size 单独配置
+http_pool_size = int(os.getenv("HTTP-POOL-SIZE", "100"))
+http_keepalive_expiry = 60
+http_connect_timeout = 10
+# 安装了h2时默认开启http2，上游不支持时会通过ALPN自动降级到http1.1，可在适配器config中用 http2 关闭
+http2_available = importlib.util.find_spec("h2") is not None
+
+_clients: Dict[Tuple, httpx.Client] = {}
+# 事件循环 -> 该循环上的异步连接池；保存循环本身，id不会在条目存在期间被复用
+_async_clients: Dict[int, Tuple[asyncio.AbstractEventLoop, Dict[Tuple, httpx.AsyncClient]]] = {}
+_lock = threading.Lock()
+
+
+def convert_proxies(proxies: Optional[dict]) -> Optional[dict]:
+    """
+    requests风格的proxies（{"https": "http://localhost:7890"}）转为httpx的格式（{"https://": "http://localhost:7890"}）
+    """
+    if not proxies:
+        return None
+    return {
+        (k if k.endswith("://") else f"{k}://"): v for k, v in proxies.items() if v
+    }
+
+
+def _client_args(proxies: Optional[dict], pool_size: int, http2: bool) -> dict:
+    return {
+        "limits": httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=http_keepalive_expiry,
+        ),
+        "http2": http2 and http2_available,
+        "proxies": convert_proxies(proxies),
+    }
+
+
+def _pool_key(url: str, proxies: Optional[dict], pool_size: int, http2: bool):
+    parts = urlsplit(url)
+    proxies_key = json.dumps(proxies, sort_keys=True) if proxies else None
+    return (parts.scheme, parts.netloc, proxies_key, pool_size, http2)
+
+
+def get_http_client(
+    url: str, proxies: Optional[dict] = None, pool_size: int = None, http2: bool = True
+) -> httpx.Client:
+    """按 host + 代理 获取共享的同步连接池"""
+    pool_size = pool_size or http_pool_size
+    key = _pool_key(url, proxies, pool_size, http2)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = httpx.Client(**_client_args(proxies, pool_size, http2))
+                _clients[key] = client
+    return client
+
+
+def get_async_http_client(
+    url: str, proxies: Optional[dict] = None, pool_size: int = None, http2: bool = True
+) -> httpx.AsyncClient:
+    """
+    按 host + 代理 获取共享的异步连接池，异步连接池与事件循环绑定
+    出现新的事件循环时清理已关闭的循环（asyncio.run、测试等）的连接池，不会随短期的循环累积
+    """
+    pool_size = pool_size or http_pool_size
+    loop = asyncio.get_running_loop()
+    key = _pool_key(url, proxies, pool_size, http2)
+    entry = _async_clients.get(id(loop))
+    client = entry[1].get(key) if entry is not None else None
+    if client is None or client.is_closed:
+        with _lock:
+            entry = _async_clients.get(id(loop))
+            if entry is None:
+                for loop_id, (other, _) in list(_async_clients.items()):
+                    if other.is_closed():
+                        del _async_clients[loop_id]
+                entry = _async_clients[id(loop)] = (loop, {})
+            client = entry[1].get(key)
+            if client is None or client.is_closed:
+                client = httpx.AsyncClient(**_client_args(proxies, pool_size, http2))
+                entry[1][key] = client
+    return client
+
+
+def request_timeout(timeout: float) -> httpx.Timeout:
+    return httpx.Timeout(timeout, connect=min(http_connect_timeout, timeout))
+
+
+class CountingByteStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """包装流式响应的原始字节流，关闭时把读取的字节数计入counter"""
+
+    def __init__(self, stream, counter):
+        self._stream = stream
+        self._counter = counter
+        self._bytes = 0
+
+    def __iter__(self):
+        for chunk in self._stream:
+            self._bytes += len(chunk)
+            yield chunk
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            self._bytes += len(chunk)
+            yield chunk
+
+    def _flush(self):
+        self._counter.inc(self._bytes)
+        self._bytes = 0
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._flush()
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._flush()
@@ -0,0 +1,111 @@
+import asyncio
+import threading
+from collections import deque
+
+
+class ConcurrencyTimeout(Exception):
+    pass
+
+
+class _Waiter:
+    """排队中的请求，同步调用方用threading.Event等待，异步调用方用所在事件循环的future等待"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.loop = loop
+        self.event = threading.Event() if loop is None else loop.create_future()
+
+    def wake(self) -> bool:
+        if self.loop is None:
+            self.event.set()
+            return True
+        try:
+            self.loop.call_soon_threadsafe(self._set)
+            return True
+        except RuntimeError:
+            # 事件循环已经关闭，跳过这个等待者
+            return False
+
+    def _set(self):
+        if not self.event.done():
+            self.event.set_result(None)
+
+
+class ConcurrencyLimiter:
+    """
+    线程和事件循环之间共享的并发上限，同步接口和异步接口占用同一份额度
+    释放时直接把名额交给队首的等待者，先到先得；等待超时抛出ConcurrencyTimeout
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _try_acquire(self, loop=None):
+        with self._lock:
+            if self._active < self.limit:
+                self._active += 1
+                return None
+            waiter = _Waiter(loop)
+            self._waiters.append(waiter)
+            return waiter
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """放弃等待，返回False表示名额已经交给了这个等待者"""
+        with self._lock:
+            try:
+                self._waiters.remove(waiter)
+                return True
+            except ValueError:
+                return False
+
+    def acquire(self, timeout: float = None):
+        waiter = self._try_acquire()
+        if waiter is None or waiter.event.wait(timeout):
+            return
+        if self._abandon(waiter):
+            raise ConcurrencyTimeout(f"waiting for concurrency slot timeout: {timeout}s")
+
+    async def aacquire(self, timeout: float = None):
+        waiter = self._try_acquire(asyncio.get_running_loop())
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(waiter.event, timeout)
+        except asyncio.TimeoutError:
+            if self._abandon(waiter):
+                raise ConcurrencyTimeout(f"waiting for concurrency slot timeout: {timeout}s")
+        except asyncio.CancelledError:
+            if not self._abandon(waiter):
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                if self._waiters.popleft().wake():
+                    return
+            self._active -= 1
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    async def __aenter__(self):
+        await self.aacquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
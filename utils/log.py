@@ -0,0 +1,84 @@
+import os
+import random
+import re
+import sys
+from contextvars import ContextVar
+
+from loguru import logger
+
+# 日志级别，默认INFO；DEBUG时才输出http请求详情和逐chunk的日志
+log_level_env = "LOG-LEVEL"
+# DEBUG级别下逐chunk日志的请求采样率，0~1，默认全部输出
+log_sample_rate_env = "LOG-SAMPLE-RATE"
+# 请求体、响应体等大字段在日志中保留的最大字符数
+log_max_chars_env = "LOG-MAX-CHARS"
+
+# 日志中隐藏值的header（小写）
+sensitive_headers = frozenset(
+    {"authorization", "proxy-authorization", "api-key", "x-api-key", "cookie"}
+)
+_sensitive_query_pattern = re.compile(r"([?&](?:key|api_key|access_token|authorization)=)[^&]*")
+
+# 未调用setup_logging时loguru默认的sink为DEBUG级别
+_debug_enabled = True
+_sample_rate = 1.0
+_max_chars = 2000
+_sampled: ContextVar[bool] = ContextVar("log_sampled", default=True)
+
+
+def setup_logging(level: str = None, sample_rate: float = None, max_chars: int = None):
+    """
+    替换loguru默认的sink：按配置的级别输出到stderr，enqueue后由后台线程写出，请求线程不等待io
+    不输出异常栈中的变量值，避免打印请求体和密钥
+    """
+    global _debug_enabled, _sample_rate, _max_chars
+    level = (level or os.getenv(log_level_env, "INFO")).upper()
+    _sample_rate = float(
+        sample_rate if sample_rate is not None else os.getenv(log_sample_rate_env, "1")
+    )
+    _max_chars = int(max_chars or os.getenv(log_max_chars_env, "2000"))
+    logger.remove()
+    logger.add(sys.stderr, level=level, enqueue=True, diagnose=False)
+    _debug_enabled = logger.level(level).no <= logger.level("DEBUG").no
+
+
+def debug_enabled() -> bool:
+    """热路径上先判断再拼接日志内容，未开启DEBUG时不做任何格式化"""
+    return _debug_enabled
+
+
+def sample_request() -> bool:
+    """请求开始时调用，决定当前请求（同一个上下文中）的逐chunk日志是否输出"""
+    sampled = _debug_enabled and (_sample_rate >= 1 or random.random() < _sample_rate)
+    _sampled.set(sampled)
+    return sampled
+
+
+def is_sampled() -> bool:
+    """当前请求的逐chunk日志是否输出"""
+    return _debug_enabled and _sampled.get()
+
+
+def truncate(value, limit: int = None) -> str:
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode("utf-8", "replace")
+    elif not isinstance(value, str):
+        value = str(value)
+    limit = limit or _max_chars
+    if len(value) > limit:
+        return f"{value[:limit]}...({len(value)} chars)"
+    return value
+
+
+def mask_headers(headers: dict) -> dict:
+    if not headers:
+        return headers
+    return {
+        k: "***" if v is not None and k.lower() in sensitive_headers else v
+        for k, v in headers.items()
+    }
+
+
+def mask_url(url: str) -> str:
+    """隐藏放在query中的密钥，如gemini的key参数"""
+    return _sensitive_query_pattern.sub(r"\1***", url)
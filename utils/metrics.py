@@ -0,0 +1,334 @@
+import asyncio
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Sequence
+from urllib.parse import urlsplit
+
+from loguru import logger
+
+from adapters.protocol import frame_usage
+
+# 多worker部署时各worker定期把自己的指标写到这个目录，/metrics合并所有worker的数据后输出
+metrics_dir_env = "METRICS-DIR"
+
+# 首包和总耗时的分桶（秒），大模型的请求从几十毫秒到几分钟不等
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# chunk间隔的分桶（秒）
+chunk_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class _Value:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def snapshot(self):
+        return self.value
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # 最后一个为+Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return self.counts + [self.sum]
+
+
+class Metric:
+    """
+    一个指标及其按label值区分的子项，labels()返回的子项可以保存下来重复使用，
+    热路径上只做一次加锁的加法，不需要每次查找
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry or default_registry).register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        return _Value()
+
+    def snapshot(self) -> list:
+        return [[list(k), child.snapshot()] for k, child in list(self._children.items())]
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def render(self, samples: dict) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in samples.items():
+            lines.append(f"{self.name}{self._labels(values)} {_format_value(value)}")
+        return lines
+
+    def _labels(self, values, extra: str = "") -> str:
+        pairs = [f'{k}="{_escape(v)}"' for k, v in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets=latency_buckets, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def render(self, samples: dict) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in samples.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), value):
+                cumulative += count
+                le = bound if bound == "+Inf" else _format_value(bound)
+                labels = self._labels(values, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(values)} {_format_value(value[-1])}")
+            lines.append(f"{self.name}_count{self._labels(values)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def snapshot(self) -> Dict[str, list]:
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def render(self, others: Sequence[dict] = ()) -> str:
+        """输出prometheus文本格式，others为其他worker的snapshot，相同label的值相加"""
+        lines = []
+        for metric in self.metrics:
+            samples = {tuple(k): v for k, v in metric.snapshot()}
+            for other in others:
+                for k, v in other.get(metric.name, []):
+                    k = tuple(k)
+                    samples[k] = metric.merge(samples[k], v) if k in samples else v
+            lines.extend(metric.render(samples))
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+default_registry = Registry()
+
+
+class RequestMetrics:
+    """一组请求指标，按token（fingerprint）和适配器type统计"""
+
+    def __init__(self, prefix: str, subject: str):
+        labels = ("token", "type")
+        self.requests = Counter(
+            f"{prefix}_requests_total", f"{subject} requests by final status", labels + ("status",)
+        )
+        self.duration = Histogram(
+            f"{prefix}_request_duration_seconds", f"{subject} request total latency", labels
+        )
+        self.ttft = Histogram(
+            f"{prefix}_ttft_seconds", f"{subject} stream time to first chunk", labels
+        )
+        self.inter_chunk = Histogram(
+            f"{prefix}_inter_chunk_seconds", f"{subject} stream interval between chunks", labels, chunk_buckets
+        )
+        self.inflight_streams = Gauge(
+            f"{prefix}_inflight_streams", f"{subject} streams in progress", labels
+        )
+        self.prompt_tokens = Counter(
+            f"{prefix}_prompt_tokens_total", f"{subject} prompt tokens from response usage", labels
+        )
+        self.completion_tokens = Counter(
+            f"{prefix}_completion_tokens_total", f"{subject} completion tokens from response usage", labels
+        )
+
+    def observe(self, token: str, type: str, stream: bool) -> "RequestObserver":
+        return RequestObserver(self, token, type, stream)
+
+
+class RequestObserver:
+    """
+    一次请求的计时，逐个chunk调用on_item，结束时调用finish（重复调用只记录第一次）
+    usage取最后一个带usage的chunk：适配器约定stream中chunk的usage为累积值（或只在最后一块返回），
+    上游在每个chunk中都返回累计值时不会重复计数；透传模式的chunk是sse帧bytes，结束时只解析最后一帧中的usage
+    """
+
+    __slots__ = (
+        "metrics",
+        "labels",
+        "stream",
+        "start",
+        "last",
+        "usage",
+        "last_frame",
+        "finished",
+        "_inter_chunk",
+    )
+
+    def __init__(self, metrics: RequestMetrics, token: str, type: str, stream: bool):
+        self.metrics = metrics
+        self.labels = (token, type)
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.last = None
+        self.usage = None
+        self.last_frame = None
+        self.finished = False
+        self._inter_chunk = None
+        if stream:
+            self._inter_chunk = metrics.inter_chunk.labels(*self.labels)
+            metrics.inflight_streams.labels(*self.labels).inc()
+
+    def on_item(self, item):
+        now = time.perf_counter()
+        if self.last is not None:
+            self._inter_chunk.observe(now - self.last)
+        elif self.stream:
+            self.metrics.ttft.labels(*self.labels).observe(now - self.start)
+        self.last = now
+        if isinstance(item, bytes):
+            self.last_frame = item
+            return
+        usage = getattr(item, "usage", None)
+        if usage is not None:
+            self.usage = usage
+
+    def finish(self, status):
+        if self.finished:
+            return
+        self.finished = True
+        metrics = self.metrics
+        metrics.requests.labels(*self.labels, str(status)).inc()
+        metrics.duration.labels(*self.labels).observe(time.perf_counter() - self.start)
+        if self.stream:
+            metrics.inflight_streams.labels(*self.labels).dec()
+        usage = self.usage
+        if usage is None and self.last_frame is not None:
+            usage = frame_usage(self.last_frame)
+        if usage is not None:
+            metrics.prompt_tokens.labels(*self.labels).inc(usage.prompt_tokens)
+            metrics.completion_tokens.labels(*self.labels).inc(usage.completion_tokens)
+
+
+gateway_metrics = RequestMetrics("openai_style_api", "gateway")
+upstream_metrics = RequestMetrics("openai_style_api_upstream", "upstream")
+upstream_bytes = Counter(
+    "openai_style_api_upstream_bytes_total", "bytes received from upstream http responses", ("host",)
+)
+
+
+@functools.lru_cache(maxsize=256)
+def upstream_host(url: str) -> str:
+    return urlsplit(url).netloc
+
+
+def render_metrics() -> str:
+    """当前worker的指标，多worker时合并其他worker最近写出的snapshot"""
+    path = os.getenv(metrics_dir_env)
+    others = []
+    if path and os.path.isdir(path):
+        own = f"{os.getpid()}.json"
+        # 超过该时间没有更新的snapshot视为worker已经退出
+        expire = time.time() - 3 * _flush_interval
+        for name in os.listdir(path):
+            file = os.path.join(path, name)
+            if name == own or not name.endswith(".json"):
+                continue
+            try:
+                if os.path.getmtime(file) < expire:
+                    continue
+                with open(file) as f:
+                    others.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return default_registry.render(others)
+
+
+_flush_interval = 5.0
+
+
+def write_snapshot(path: str):
+    os.makedirs(path, exist_ok=True)
+    file = os.path.join(path, f"{os.getpid()}.json")
+    tmp = f"{file}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(default_registry.snapshot(), f)
+    os.replace(tmp, file)
+
+
+async def flush_metrics(interval: float = _flush_interval):
+    """多worker模式下定期写出当前worker的指标"""
+    global _flush_interval
+    _flush_interval = interval
+    path = os.environ[metrics_dir_env]
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, write_snapshot, path)
+        except Exception as e:
+            logger.warning(f"write metrics snapshot failed: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,145 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from loguru import logger
+
+# 多worker部署时各进程共享的状态文件，由主进程设置后传给worker；不配置时状态只在当前进程内
+shared_state_path_env = "SHARED-STATE-PATH"
+
+
+def refill(tokens: float, updated: float, now: float, rate: float, capacity: float) -> float:
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+def take_tokens(tokens: float, amount: float, rate: float, force: bool):
+    """返回扣除后的令牌数和需要等待的秒数，等待时不扣除"""
+    if force or tokens >= amount:
+        return tokens - amount, 0.0
+    return tokens, (amount - tokens) / rate
+
+
+class LocalState:
+    """进程内的状态，单进程部署时使用"""
+
+    # 读写不涉及io，事件循环中可以直接调用
+    blocking = False
+
+    def __init__(self):
+        self._values = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: float = None) -> Optional[float]:
+        return self._values.get(key, default)
+
+    def set(self, key: str, value: float):
+        with self._lock:
+            self._values[key] = value
+
+    def incr(self, key: str, amount: float = 1) -> float:
+        with self._lock:
+            value = self._values.get(key, 0) + amount
+            self._values[key] = value
+            return value
+
+    def take(self, key: str, amount: float, rate: float, capacity: float, force: bool = False) -> float:
+        """
+        令牌桶：每秒补充rate个令牌，最多capacity个，初始为满
+        令牌足够时扣除amount并返回0，否则不扣除，返回还需要等待的秒数；force时直接扣除，可以扣成负数
+        """
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = refill(tokens, updated, now, rate, capacity)
+            tokens, wait = take_tokens(tokens, amount, rate, force)
+            self._buckets[key] = (tokens, now)
+            return wait
+
+
+class SqliteState:
+    """
+    基于sqlite的跨进程状态，多个worker打开同一个文件
+    使用WAL并关闭fsync，只保存计数器、版本号这类丢失后可以重建的数据
+    """
+
+    # 读写需要等待文件锁，事件循环中应放到线程池执行
+    blocking = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, timeout=5, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shared_state (key TEXT PRIMARY KEY, value REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS token_bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+        )
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: float = None) -> Optional[float]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM shared_state WHERE key = ?", (key,)
+            ).fetchone()
+        return default if row is None else row[0]
+
+    def set(self, key: str, value: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO shared_state (key, value) VALUES (?, ?)",
+                (key, value),
+            )
+
+    def incr(self, key: str, amount: float = 1) -> float:
+        with self._lock:
+            return self._conn.execute(
+                "INSERT INTO shared_state (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value RETURNING value",
+                (key, amount),
+            ).fetchone()[0]
+
+    def take(self, key: str, amount: float, rate: float, capacity: float, force: bool = False) -> float:
+        """LocalState.take的跨进程版本，在一个写事务中完成读取、补充和扣除"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._conn.execute(
+                    "SELECT tokens, updated FROM token_bucket WHERE key = ?", (key,)
+                ).fetchone()
+                tokens = capacity if row is None else refill(row[0], row[1], now, rate, capacity)
+                tokens, wait = take_tokens(tokens, amount, rate, force)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO token_bucket (key, tokens, updated) VALUES (?, ?, ?)",
+                    (key, tokens, now),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return wait
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_shared_state():
+    global _state
+    if _state is None:
+        with _state_lock:
+            if _state is None:
+                path = os.getenv(shared_state_path_env)
+                if path:
+                    logger.info(f"shared state: {path}")
+                    _state = SqliteState(path)
+                else:
+                    _state = LocalState()
+    return _state
@@ -1,7 +1,12 @@
 # -*- coding:utf-8 -*-
 import logging
+import re
+from typing import AsyncIterator, Iterator, List
 
-_FIELD_SEPARATOR = ":"
+_DATA_PREFIX = b"data:"
+# 行结束符：\r\n、\r 或 \n
+_LINE_END = re.compile(rb"\r\n?|\n")
+_CR = 13
 
 # Reference claim: https://github.com/mpetazzoni/sseclient
 
@@ -24,79 +29,8 @@ class SSEClient(object):
         self._event_source = event_source
         self._char_enc = char_enc
 
-    def _read(self):
-        """Read the incoming event source stream and yield event chunks.
-        Unfortunately it is possible for some servers to decide to break an
-        event into multiple HTTP chunks in the response. It is thus necessary
-        to correctly stitch together consecutive response chunks and find the
-        SSE delimiter (empty new line) to yield full, correct event chunks."""
-        data = b""
-        for chunk in self._event_source:
-            for line in chunk.splitlines(True):
-                data += line
-                if data.endswith((b"\r\r", b"\n\n", b"\r\n\r\n")):
-                    yield data
-                    data = b""
-        if data:
-            yield data
-
     def events(self):
-        for chunk in self._read():
-            event = Event()
-            # Split before decoding so splitlines() only uses \r and \n
-            for line in chunk.splitlines():
-                # Decode the line.
-                line = line.decode(self._char_enc)
-
-                # Lines starting with a separator are comments and are to be
-                # ignored.
-                if not line.strip() or line.startswith(_FIELD_SEPARATOR):
-                    continue
-
-                data = line.split(_FIELD_SEPARATOR, 1)
-                field = data[0]
-
-                # Ignore unknown fields.
-                if field not in event.__dict__:
-                    self._logger.debug(
-                        "Saw invalid field %s while parsing " "Server Side Event", field
-                    )
-                    continue
-
-                if len(data) > 1:
-                    # From the spec:
-                    # "If value starts with a single U+0020 SPACE character,
-                    # remove it from value."
-                    if data[1].startswith(" "):
-                        value = data[1][1:]
-                    else:
-                        value = data[1]
-                else:
-                    # If no value is present after the separator,
-                    # assume an empty value.
-                    value = ""
-
-                # The data field may come over multiple lines and their values
-                # are concatenated with each other.
-                if field == "data":
-                    event.__dict__[field] += value + "\n"
-                else:
-                    event.__dict__[field] = value
-
-            # Events with no data are not dispatched.
-            if not event.data:
-                continue
-
-            # If the data field ends with a newline, remove it.
-            if event.data.endswith("\n"):
-                event.data = event.data[0:-1]
-
-            # Empty event names default to 'message'
-            event.event = event.event or "message"
-
-            # Dispatch the event
-            self._logger.debug("Dispatching %s...", event)
-            yield event
+        return iter_sse_events(self._event_source, self._char_enc)
 
     def close(self):
         """Manually close the event source stream."""
@@ -123,4 +57,178 @@ class Event(object):
             s += ", no data"
         if self.retry:
             s += ", retry in {0}ms".format(self.retry)
-        return s
\ No newline at end of file
+        return s
+
+
+class SSEDecoder(object):
+    """
+    增量的sse解析器，上游的chunk追加到bytearray中，记录已经扫描过的位置，
+    每个字节只扫描一次，只对完整的行做解码，长stream和被拆成很多小chunk的事件都是线性耗时
+    """
+
+    _fields = (b"id", b"event", b"retry", b"meta")
+
+    def __init__(self, char_enc="utf-8"):
+        self._char_enc = char_enc
+        self._buf = bytearray()
+        self._scan = 0  # _buf中该位置之前已经确认没有行结束符
+        self._cr = False  # stream中是否出现过\r，没有时只需要按\n切分
+        self._reset()
+
+    def _reset(self):
+        self._data = []
+        self._values = {}
+
+    def lines(self, chunk: bytes) -> List[bytes]:
+        """追加chunk，返回其中完整的行（不含行结束符），不完整的部分留到下次"""
+        buf = self._buf
+        buf += chunk
+        if b"\r" not in chunk and not self._cr:
+            return self._split_lf(buf)
+        # 出现过\r时按\r\n、\r、\n三种行结束符处理
+        self._cr = True
+        lines = []
+        start = 0
+        pos = self._scan
+        search = _LINE_END.search
+        while True:
+            m = search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            end = m.end()
+            if end == len(buf) and end - m.start() == 1 and buf[m.start()] == _CR:
+                # 结尾单独的\r可能和下一个chunk开头的\n是同一个行结束符
+                pos = m.start()
+                break
+            lines.append(bytes(buf[start : m.start()]))
+            start = pos = end
+        if start:
+            del buf[:start]
+        self._scan = pos - start
+        return lines
+
+    def _split_lf(self, buf: bytearray) -> List[bytes]:
+        end = buf.rfind(b"\n", self._scan)
+        if end < 0:
+            self._scan = len(buf)
+            return []
+        lines = bytes(buf[:end]).split(b"\n")
+        del buf[: end + 1]
+        self._scan = 0
+        return lines
+
+    def flush_lines(self) -> List[bytes]:
+        """stream结束时返回剩余的不完整行"""
+        line = bytes(self._buf)
+        self._buf.clear()
+        self._scan = 0
+        if not line:
+            return []
+        if line[-1] == _CR:
+            line = line[:-1]
+        return [line]
+
+    def feed(self, chunk: bytes) -> List["Event"]:
+        """追加chunk，返回其中完整的事件"""
+        return self._events(self.lines(chunk))
+
+    def flush(self) -> List["Event"]:
+        """stream结束时，没有以空行结尾的最后一个事件同样返回"""
+        events = self._events(self.flush_lines())
+        event = self._dispatch()
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _events(self, lines: List[bytes]) -> List["Event"]:
+        events = []
+        for line in lines:
+            if not line:
+                event = self._dispatch()
+                if event is not None:
+                    events.append(event)
+                continue
+            # 以冒号开头的是注释，空白行忽略
+            if line[0] == 58 or not line.strip():
+                continue
+            field, _, value = line.partition(b":")
+            # From the spec:
+            # "If value starts with a single U+0020 SPACE character,
+            # remove it from value."
+            if value[:1] == b" ":
+                value = value[1:]
+            if field == b"data":
+                # The data field may come over multiple lines and their values
+                # are concatenated with each other.
+                self._data.append(value)
+            elif field in self._fields:
+                self._values[field] = value
+        return events
+
+    def _dispatch(self):
+        # Events with no data are not dispatched.
+        if not self._data:
+            self._reset()
+            return None
+        enc = self._char_enc
+        values = self._values
+        event = Event(data=b"\n".join(self._data).decode(enc))
+        if b"id" in values:
+            event.id = values[b"id"].decode(enc)
+        # Empty event names default to 'message'
+        event.event = values.get(b"event", b"").decode(enc) or "message"
+        if b"retry" in values:
+            event.retry = values[b"retry"].decode(enc)
+        if b"meta" in values:
+            event.meta = values[b"meta"].decode(enc)
+        self._reset()
+        return event
+
+
+def iter_sse_events(chunks: Iterator[bytes], char_enc="utf-8") -> Iterator[Event]:
+    """解析上游的sse字节流，返回Event"""
+    decoder = SSEDecoder(char_enc)
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.flush()
+
+
+async def aiter_sse_events(
+    chunks: AsyncIterator[bytes], char_enc="utf-8"
+) -> AsyncIterator[Event]:
+    """iter_sse_events的异步版本"""
+    decoder = SSEDecoder(char_enc)
+    async for chunk in chunks:
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.flush():
+        yield event
+
+
+def _data_lines(lines: List[bytes]) -> List[bytes]:
+    return [
+        line[len(_DATA_PREFIX) :].strip()
+        for line in lines
+        if line.startswith(_DATA_PREFIX)
+    ]
+
+
+def iter_sse_data(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """
+    按行切分上游的sse字节流，返回每个data字段的原始字节，不做解码和json解析，用于透传
+    """
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        yield from _data_lines(decoder.lines(chunk))
+    yield from _data_lines(decoder.flush_lines())
+
+
+async def aiter_sse_data(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """iter_sse_data的异步版本"""
+    decoder = SSEDecoder()
+    async for chunk in chunks:
+        for data in _data_lines(decoder.lines(chunk)):
+            yield data
+    for data in _data_lines(decoder.flush_lines()):
+        yield data
@@ -1,8 +1,95 @@
+import functools
+import hashlib
+from typing import List, Optional
+
 import tiktoken
+from tiktoken.model import MODEL_PREFIX_TO_ENCODING, MODEL_TO_ENCODING
+
+default_encoding_name = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = default_encoding_name):
+    """按编码名懒加载encoder，每种编码只加载一次"""
+    return tiktoken.get_encoding(encoding_name)
+
+
+@functools.lru_cache(maxsize=256)
+def encoding_name_for_model(model: Optional[str]) -> str:
+    """根据模型名选择编码，tiktoken不认识的模型（claude、qwen等）使用默认编码"""
+    if model:
+        if model in MODEL_TO_ENCODING:
+            return MODEL_TO_ENCODING[model]
+        for prefix, encoding_name in MODEL_PREFIX_TO_ENCODING.items():
+            if model.startswith(prefix):
+                return encoding_name
+    return default_encoding_name
 
 
-def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
+def num_tokens_from_string(
+    string: str, encoding_name: str = None, model: str = None
+) -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
+    encoding = get_encoding(encoding_name or encoding_name_for_model(model))
     num_tokens = len(encoding.encode(string))
     return num_tokens
+
+
+def estimate_tokens(string: str) -> int:
+    """
+    不做tokenize的粗略估算，用于限流等只需要数量级的场景：英文约4个字符一个token，中文等非ascii字符约一个字符一个token
+    """
+    if not string:
+        return 0
+    chars = len(string)
+    # 中文等非ascii字符在utf-8中为2~4个字节
+    non_ascii = min(chars, (len(string.encode("utf-8")) - chars) // 2)
+    return (chars - non_ascii + 3) // 4 + non_ascii
+
+
+class UsageCounter:
+    """
+    流式响应的usage统计，逐块累积completion文本，只在最后一块时统一计算一次token数，
+    避免每个chunk都做一次tokenize
+    """
+
+    def __init__(self, model: str = None, encoding_name: str = None):
+        self.encoding_name = encoding_name or encoding_name_for_model(model)
+        self.completions: List[str] = []
+
+    def add(self, completion: str):
+        if completion:
+            self.completions.append(completion)
+
+    def completion_tokens(self) -> int:
+        return num_tokens_from_string(
+            "".join(self.completions), encoding_name=self.encoding_name
+        )
+
+
+hashed_token_prefix = "sha256:"
+
+
+def hash_token(token: str) -> str:
+    """请求中的bearer token的sha256，鉴权时总是重新计算，客户端不能直接提交hash"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def config_token_hash(token: str) -> str:
+    """
+    配置中token的sha256，鉴权索引和日志中只使用hash；以 sha256: 开头的token视为已经hash过，
+    配置文件中可以只保存hash，不保存明文
+    """
+    if token.startswith(hashed_token_prefix):
+        return token[len(hashed_token_prefix):].lower()
+    return hash_token(token)
+
+
+def hash_fingerprint(token_hash: str) -> str:
+    """已经hash过的token（适配器表、路由中的key）在日志、指标中的短hash"""
+    return token_hash[:8]
+
+
+def token_fingerprint(token: str) -> str:
+    """日志中用来区分token的短hash"""
+    return hash_fingerprint(config_token_hash(str(token)))